@@ -0,0 +1,570 @@
+"""
+Benchmarks of the finch engine, and a check for performance regressions.
+Every workload paints a fixed image with a fixed brush set and random seed, so runs can be compared.
+
+Run with: python -m finch.bench --output bench.json
+Compare with an earlier run: python -m finch.bench --baseline bench.json
+Compare the optimized kernels with their references: python -m finch.bench --kernels
+Only compare runs of the same idle machine. Repeats hide short hiccups,
+but the speed of shared machines can drift for minutes at a time, which calls for a higher --threshold.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import random
+from dataclasses import dataclass
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import cv2
+import numpy as np
+
+from finch.brush import BRUSH_STAMP_CACHE, Brush
+from finch.brush_bank import BrushSet, get_brush_bank
+from finch.composite import MAX_ALPHA, composite_color_float_reference, composite_color_inplace
+from finch.context import FIXED_RANDOM_SEED, EngineContext, RunSettings
+from finch.evolution import evolve_specimen_inplace, get_rounded_score, propose_brushes
+from finch.fitness import IncrementalFitness
+from finch.gif import StreamingGifWriter
+from finch.image_gradient import get_image_gradient
+from finch.instrumentation import get_peak_rss_mib
+from finch.primitive_types import Image, Point
+from finch.redraw import _get_blank_4k_image, _redraw_painting, _redraw_painting_serial, redraw_painting_at_4k
+from finch.run import ROOT_DIR, FinchResult, get_initial_specimen, run_finch_generator
+from finch.sample_weighted_position_from_image import WeightedPositionSampler
+from finch.scale import normalize_image_size
+from finch.specimen import Specimen
+from finch.stroke_log import StrokeLog
+
+
+BENCH_FORMAT_VERSION = 2
+SYNTHETIC_IMAGE_SIZE = 256
+BUNDLED_IMAGE_PATHS : list[ Path ] = [ ROOT_DIR / '_doc/_thumbnail.png' ]
+# The number of calls that is timed for each of the stages of a generation
+N_STAGE_CALLS = 1000
+# Timings are repeated, and the fastest repeat is reported, since noise only ever makes things slower
+N_REPEATS = 3
+# Some noise only changes between processes, such as the memory layout,
+# so every workload also runs in this many fresh processes, and the best value of all of them is reported
+N_PROCESSES = 3
+# These are only measured once per process, since the evolution is too slow to repeat, so they are reported but not compared
+UNCOMPARED_METRIC_NAMES = {
+    'evolution_seconds',
+    'generations_per_second',
+    'accepted_strokes_per_second',
+    'first_frame_seconds',
+    'end_to_end_seconds',
+}
+# Timings that are shorter than this are dominated by noise, so they are reported but not compared
+MIN_COMPARED_SECONDS = 0.05
+# A metric regresses if it is this much worse than the baseline, relative to the baseline
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+# Like production, but without the result cache, which would skip the painting
+BENCH_SETTINGS = RunSettings( make_gif = True, log_scores = False )
+# The kernels are compared with their references on their own, see run_kernel_benchmarks
+KERNEL_BRUSH_SIZES : list[ int ] = [ 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000 ]
+N_KERNEL_REPEATS = 20
+REDRAW_N_BRUSHES = 5000
+REDRAW_IMAGE_SIZE = 640
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Workload:
+    name : str
+    image : Image
+    brush_set : BrushSet
+
+
+def _make_gradient_image( size : int ) -> Image:
+    # Smooth color ramps, which converge with few large brushes
+    ys, xs = np.mgrid[ 0:size, 0:size ] / max( 1, size - 1 )
+    image = np.stack( [ xs, ys, 1 - ( xs + ys ) / 2 ], axis = 2 ) * 255
+    return image.astype( np.uint8 )
+
+
+def _make_shapes_image( size : int ) -> Image:
+    # Hard edges and small details, which need many small brushes
+    rng = np.random.default_rng( FIXED_RANDOM_SEED )
+    image = np.full( ( size, size, 3 ), 255, dtype = np.uint8 )
+    for _ in range( 40 ):
+        color = tuple( int( c ) for c in rng.integers( 0, 256, size = 3 ) )
+        center = tuple( int( c ) for c in rng.integers( 0, size, size = 2 ) )
+        extent = int( rng.integers( size // 32, size // 4 ) )
+        if rng.random() < 0.5:
+            cv2.circle( image, center, extent, color, thickness = -1 )
+        else:
+            corner = ( center[ 0 ] + extent, center[ 1 ] + extent )
+            cv2.rectangle( image, center, corner, color, thickness = -1 )
+    return image
+
+
+def get_workloads( include_synthetic : bool = True, include_bundled : bool = True ) -> list[ Workload ]:
+    images = {}
+    if include_synthetic:
+        images[ 'gradient' ] = _make_gradient_image( SYNTHETIC_IMAGE_SIZE )
+        images[ 'shapes' ] = _make_shapes_image( SYNTHETIC_IMAGE_SIZE )
+    if include_bundled:
+        for image_path in BUNDLED_IMAGE_PATHS:
+            image = cv2.imread( str( image_path ), cv2.IMREAD_COLOR )
+            if image is None:
+                logger.warning( f'Could not read bundled image {image_path}, skipping it.' )
+                continue
+            images[ image_path.stem.strip( '_' ) ] = normalize_image_size( image )
+
+    return [
+        Workload( name = f'{image_name}__{brush_set.name.lower()}', image = image, brush_set = brush_set )
+        for image_name, image in images.items()
+        for brush_set in BrushSet
+    ]
+
+
+def _time_calls( function : Callable[ [ int ], None ], n_calls : int, n_repeats : int ) -> float:
+    """
+    Returns the number of calls per second in the fastest repeat, the function gets the index of the call.
+    """
+    best_seconds = float( 'inf' )
+    for _ in range( n_repeats ):
+        start_time = time.perf_counter()
+        for call_index in range( n_calls ):
+            function( call_index )
+        best_seconds = min( best_seconds, time.perf_counter() - start_time )
+    return n_calls / max( best_seconds, 1e-9 )
+
+
+def _time_repeats( function : Callable[ [], object ], n_repeats : int ) -> tuple[ float, object ]:
+    """
+    Returns the duration of the fastest repeat, in seconds, and the result of the last one.
+    """
+    best_seconds = float( 'inf' )
+    for _ in range( n_repeats ):
+        start_time = time.perf_counter()
+        result = function()
+        best_seconds = min( best_seconds, time.perf_counter() - start_time )
+    return best_seconds, result
+
+
+def _bench_stages( workload : Workload, n_calls : int, n_repeats : int ) -> dict[ str, float ]:
+    """
+    Times the stages of a single generation on their own, on a blank canvas,
+    so that a regression can be attributed to a stage.
+    """
+    context = EngineContext.create( brush_set = workload.brush_set, settings = BENCH_SETTINGS )
+    target_image = workload.image
+    target_gradient = get_image_gradient( target_image )
+    specimen = get_initial_specimen( target_image = target_image, context = context )
+    incremental_fitness = IncrementalFitness( specimen_image = specimen.cached_image, target_image = target_image )
+    position_sampler = WeightedPositionSampler( weight_image = incremental_fitness.diff_image, rng = context.np_rng )
+
+    brushes = propose_brushes(
+        n_brushes = n_calls,
+        fitness = incremental_fitness.fitness,
+        target_image = target_image,
+        target_gradient = target_gradient,
+        position_sampler = position_sampler,
+        context = context,
+    )
+    mutations = {}
+
+    def sample( call_index : int ) -> None:
+        position_sampler.sample()
+
+    def draw( call_index : int ) -> None:
+        mutation = specimen.draw_brush( brushes[ call_index ] )
+        specimen.rollback( mutation )
+        mutations[ call_index ] = mutation
+
+    def evaluate_fitness( call_index : int ) -> None:
+        incremental_fitness.evaluate_roi( specimen.cached_image, mutations[ call_index ].roi )
+
+    return {
+        'sample_calls_per_second' : _time_calls( sample, n_calls, n_repeats ),
+        'draw_calls_per_second' : _time_calls( draw, n_calls, n_repeats ),
+        'fitness_calls_per_second' : _time_calls( evaluate_fitness, n_calls, n_repeats ),
+    }
+
+
+def _bench_pipeline( workload : Workload, n_repeats : int ) -> dict[ str, float ]:
+    """
+    Paints the image until it converges, and times the evolution and every step that follows it.
+    The steps that follow the evolution are repeated.
+    """
+    context = EngineContext.create( brush_set = workload.brush_set, settings = BENCH_SETTINGS )
+    target_image = workload.image
+    target_gradient = get_image_gradient( target_image )
+    specimen = get_initial_specimen( target_image = target_image, context = context )
+    initial_rounded_score = get_rounded_score( IncrementalFitness( specimen.cached_image, target_image ).fitness )
+
+    frames = [ ( specimen.cached_image.copy(), initial_rounded_score ) ]
+    start_time = time.perf_counter()
+    for progress in evolve_specimen_inplace(
+        specimen = specimen,
+        target_image = target_image,
+        target_gradient = target_gradient,
+        context = context,
+    ):
+        if not progress.is_final:
+            frames.append( ( specimen.cached_image.copy(), progress.rounded_score ) )
+    evolution_seconds = time.perf_counter() - start_time
+    n_generations = progress.generation_index
+    n_accepted_strokes = len( specimen.brushes )
+
+    def redraw_4k() -> Image:
+        # Every repeat starts without cached stamps, like the first painting of a process
+        BRUSH_STAMP_CACHE.clear()
+        return redraw_painting_at_4k( specimen = specimen )
+
+    redraw_4k_seconds, result_4k = _time_repeats( redraw_4k, n_repeats )
+
+    # Frames are encoded after the evolution, so that only the GIF is timed and not the evolution
+    def encode_gif() -> bytes:
+        gif_writer = StreamingGifWriter(
+            palette_image = target_image,
+            first_score = initial_rounded_score,
+            last_score = progress.rounded_score,
+        )
+        for frame_image, rounded_score in frames:
+            gif_writer.add_frame( frame_image, rounded_score )
+        return gif_writer.finish( specimen.cached_image )
+
+    gif_seconds, _ = _time_repeats( encode_gif, n_repeats )
+
+    png_encode_seconds, ( success, _ ) = _time_repeats( lambda: cv2.imencode( '.png', result_4k ), n_repeats )
+    if not success:
+        raise ValueError( 'Failed to encode the 4K result.' )
+
+    return {
+        'n_generations' : n_generations,
+        'n_accepted_strokes' : n_accepted_strokes,
+        'final_score' : progress.rounded_score,
+        'evolution_seconds' : evolution_seconds,
+        'generations_per_second' : n_generations / max( evolution_seconds, 1e-9 ),
+        'accepted_strokes_per_second' : n_accepted_strokes / max( evolution_seconds, 1e-9 ),
+        'redraw_4k_seconds' : redraw_4k_seconds,
+        'gif_seconds' : gif_seconds,
+        'png_encode_seconds' : png_encode_seconds,
+    }
+
+
+def _bench_end_to_end( workload : Workload ) -> dict[ str, float ]:
+    """
+    Times the painting like it is served, from the first generation to the encoded results.
+    """
+    BRUSH_STAMP_CACHE.clear()
+    start_time = time.perf_counter()
+    first_frame_seconds = None
+    for item in run_finch_generator( target_image = workload.image, brush_set = workload.brush_set, settings = BENCH_SETTINGS ):
+        if first_frame_seconds is None:
+            first_frame_seconds = time.perf_counter() - start_time
+        if isinstance( item, FinchResult ):
+            result = item
+    return {
+        'first_frame_seconds' : first_frame_seconds,
+        'end_to_end_seconds' : time.perf_counter() - start_time,
+        # With the default output options, the 4K image is a PNG and the animation a GIF
+        'result_4k_png_mib' : round( len( result.image_4k ) / ( 1024 * 1024 ), 3 ),
+        'result_gif_mib' : round( len( result.animation ) / ( 1024 * 1024 ), 3 ) if result.animation is not None else None,
+    }
+
+
+def run_workload(
+        workload : Workload,
+        n_stage_calls : int = N_STAGE_CALLS,
+        n_repeats : int = N_REPEATS,
+        end_to_end : bool = True,
+) -> dict[ str, float ]:
+    logger.info( f'Running workload {workload.name}.' )
+    # Loading the textures is not part of any of the timed stages
+    get_brush_bank( workload.brush_set )
+    metrics = {}
+    metrics.update( _bench_stages( workload, n_stage_calls, n_repeats ) )
+    metrics.update( _bench_pipeline( workload, n_repeats ) )
+    if end_to_end:
+        metrics.update( _bench_end_to_end( workload ) )
+    # Every workload runs in its own process, see run_benchmarks, so this is the peak of this workload
+    metrics[ 'peak_rss_mib' ] = get_peak_rss_mib()
+    return metrics
+
+
+def _get_best_value( metric_name : str, values : list[ Optional[ float ] ] ) -> Optional[ float ]:
+    # Counts and scores are the same in every process, the painting is deterministic
+    values = [ value for value in values if value is not None ]
+    if not values:
+        return None
+    if metric_name.endswith( '_per_second' ):
+        return max( values )
+    if metric_name.endswith( '_seconds' ) or metric_name.endswith( '_mib' ):
+        return min( values )
+    return values[ 0 ]
+
+
+def run_workload_in_processes(
+        workload : Workload,
+        n_stage_calls : int = N_STAGE_CALLS,
+        n_repeats : int = N_REPEATS,
+        n_processes : int = N_PROCESSES,
+        end_to_end : bool = True,
+) -> dict[ str, float ]:
+    """
+    Runs the workload in fresh processes, one after another, and returns the best value of every metric.
+    """
+    runs = []
+    for _ in range( n_processes ):
+        with ProcessPoolExecutor( max_workers = 1, mp_context = multiprocessing.get_context( 'spawn' ) ) as executor:
+            runs.append( executor.submit( run_workload, workload, n_stage_calls, n_repeats, end_to_end ).result() )
+    return {
+        metric_name : _get_best_value( metric_name, [ run.get( metric_name ) for run in runs ] )
+        for metric_name in runs[ 0 ]
+    }
+
+
+def run_benchmarks(
+        workloads : list[ Workload ],
+        n_stage_calls : int = N_STAGE_CALLS,
+        n_repeats : int = N_REPEATS,
+        n_processes : int = N_PROCESSES,
+        end_to_end : bool = True,
+) -> dict:
+    return {
+        'format_version' : BENCH_FORMAT_VERSION,
+        'n_stage_calls' : n_stage_calls,
+        'n_repeats' : n_repeats,
+        'n_processes' : n_processes,
+        'environment' : {
+            'python' : platform.python_version(),
+            'numpy' : np.__version__,
+            'opencv' : cv2.__version__,
+            'machine' : platform.machine(),
+            'processor' : platform.processor(),
+            'n_cpus' : os.cpu_count(),
+        },
+        'workloads' : {
+            workload.name : run_workload_in_processes( workload, n_stage_calls, n_repeats, n_processes, end_to_end )
+            for workload in workloads
+        },
+    }
+
+
+def _bench_compositing( brush_sizes : list[ int ], n_repeats : int ) -> list[ dict[ str, float ] ]:
+    """
+    Times the fixed point compositing against the floating point reference, for square brushes of the given sizes.
+    """
+    rng = np.random.default_rng( FIXED_RANDOM_SEED )
+    color = ( 12, 127, 250 )
+
+    results = []
+    for brush_size in brush_sizes:
+        background = rng.integers( 0, 256, ( brush_size, brush_size, 3 ), dtype = np.uint8 )
+        alpha = rng.integers( 0, MAX_ALPHA + 1, ( brush_size, brush_size ), dtype = np.uint16 )
+
+        result = { 'brush_size' : brush_size }
+        images = {}
+        for name, kernel in [
+            ( 'float', composite_color_float_reference ),
+            ( 'fixed', composite_color_inplace ),
+        ]:
+            images[ name ] = background.copy()
+            kernel( images[ name ], alpha, color )
+            seconds, _ = _time_repeats( lambda: kernel( background.copy(), alpha, color ), n_repeats )
+            result[ f'{name}_ms' ] = seconds * 1000
+        result[ 'max_difference' ] = int( np.max( np.abs( images[ 'float' ].astype( int ) - images[ 'fixed' ].astype( int ) ) ) )
+        results.append( result )
+    return results
+
+
+def _bench_redraw( n_brushes : int, image_size : int ) -> dict[ str, dict[ str, float ] ]:
+    """
+    Times the tiled and the culled 4K redraw against the serial reference, and counts the pixels that differ from it.
+    """
+    rng = random.Random( FIXED_RANDOM_SEED )
+    brush_bank = get_brush_bank( BrushSet.Canvas )
+
+    # Like a real painting, brushes get smaller over time
+    brushes = StrokeLog()
+    for brush_index in range( n_brushes ):
+        brushes.append( Brush(
+            color = ( rng.randrange( 256 ), rng.randrange( 256 ), rng.randrange( 256 ) ),
+            texture_index = brush_bank.random_texture_index( rng ),
+            position = Point( rng.randrange( image_size ), rng.randrange( image_size ) ),
+            angle = rng.uniform( -180, 180 ),
+            size = max( 1, int( image_size * ( 1 - brush_index / n_brushes ) ** 3 ) ),
+        ) )
+    specimen = Specimen(
+        cached_image = np.zeros( ( image_size, image_size, 3 ), dtype = np.uint8 ),
+        brush_bank = brush_bank,
+        brushes = brushes,
+    )
+
+    results = {}
+    serial_image = None
+    for name, redraw in [
+        ( 'serial', lambda result_image, scale: _redraw_painting_serial( brushes, scale, result_image, brush_bank ) ),
+        ( 'tiled', lambda result_image, scale: _redraw_painting( brushes, scale, result_image, brush_bank ) ),
+        ( 'culled', lambda result_image, scale: redraw_painting_at_4k( specimen ) ),
+    ]:
+        # Every redraw starts without cached stamps, like the first painting of a process
+        BRUSH_STAMP_CACHE.clear()
+        result_image, scale = _get_blank_4k_image( specimen )
+        start_time = time.perf_counter()
+        result_image = redraw( result_image, scale )
+        seconds = time.perf_counter() - start_time
+        if serial_image is None:
+            serial_image = result_image
+
+        differences = np.abs( result_image.astype( int ) - serial_image.astype( int ) )
+        results[ name ] = {
+            'seconds' : seconds,
+            'n_different_pixels' : int( np.count_nonzero( np.any( differences > 0, axis = 2 ) ) ),
+            'max_difference' : int( np.max( differences ) ),
+        }
+    return results
+
+
+def run_kernel_benchmarks(
+        brush_sizes : list[ int ] = KERNEL_BRUSH_SIZES,
+        n_repeats : int = N_KERNEL_REPEATS,
+        n_redraw_brushes : int = REDRAW_N_BRUSHES,
+        redraw_image_size : int = REDRAW_IMAGE_SIZE,
+) -> dict:
+    """
+    Compares the optimized kernels with the references they replaced, both in speed and in their results.
+    These are not compared with a baseline.
+    """
+    return {
+        'compositing' : _bench_compositing( brush_sizes, n_repeats ),
+        'redraw' : _bench_redraw( n_redraw_brushes, redraw_image_size ),
+    }
+
+
+def _is_higher_better( metric_name : str ) -> Optional[ bool ]:
+    # Counts and scores describe the result, not the performance, so they are not compared
+    if metric_name in UNCOMPARED_METRIC_NAMES:
+        return None
+    if metric_name.endswith( '_per_second' ):
+        return True
+    if metric_name.endswith( '_seconds' ) or metric_name.endswith( '_mib' ):
+        return False
+    return None
+
+
+def _get_timed_seconds( metric_name : str, value : float, n_stage_calls : int ) -> Optional[ float ]:
+    if metric_name.endswith( '_calls_per_second' ):
+        return n_stage_calls / value if value else None
+    if metric_name.endswith( '_seconds' ):
+        return value
+    return None
+
+
+def find_regressions( results : dict, baseline : dict, threshold : float = DEFAULT_REGRESSION_THRESHOLD ) -> list[ str ]:
+    """
+    Returns a description of every metric that is worse than the baseline by more than the threshold.
+    Workloads and metrics that are missing from either side are ignored, and so are metrics that are only measured once,
+    or whose timings are too short on either side, see MIN_COMPARED_SECONDS.
+    """
+    regressions = []
+    for workload_name, metrics in results[ 'workloads' ].items():
+        baseline_metrics = baseline[ 'workloads' ].get( workload_name )
+        if baseline_metrics is None:
+            continue
+        for metric_name, value in metrics.items():
+            higher_is_better = _is_higher_better( metric_name )
+            baseline_value = baseline_metrics.get( metric_name )
+            if higher_is_better is None or value is None or not baseline_value:
+                continue
+            timed_seconds = [
+                _get_timed_seconds( metric_name, value, results[ 'n_stage_calls' ] ),
+                _get_timed_seconds( metric_name, baseline_value, baseline[ 'n_stage_calls' ] ),
+            ]
+            if any( seconds is not None and seconds < MIN_COMPARED_SECONDS for seconds in timed_seconds ):
+                continue
+            relative_change = ( value - baseline_value ) / baseline_value
+            if ( -relative_change if higher_is_better else relative_change ) > threshold:
+                regressions.append(
+                    f'{workload_name} {metric_name}: {value:.4g}, baseline {baseline_value:.4g} ({relative_change:+.1%})'
+                )
+    return regressions
+
+
+def _parse_arguments( arguments : Optional[ list[ str ] ] = None ) -> argparse.Namespace:
+    parser = argparse.ArgumentParser( prog = 'python -m finch.bench', description = __doc__.strip().splitlines()[ 0 ] )
+    parser.add_argument( '--output', type = Path, help = 'Write the results to this JSON file.' )
+    parser.add_argument( '--baseline', type = Path, help = 'Compare the results with this earlier JSON output.' )
+    parser.add_argument(
+        '--threshold', type = float, default = DEFAULT_REGRESSION_THRESHOLD,
+        help = 'Relative change at which a metric counts as a regression.'
+    )
+    parser.add_argument( '--workloads', nargs = '*', help = 'Only run workloads whose name contains one of these.' )
+    parser.add_argument( '--no-synthetic', action = 'store_true', help = 'Skip the generated images.' )
+    parser.add_argument( '--no-bundled', action = 'store_true', help = 'Skip the images in the repository.' )
+    parser.add_argument( '--no-end-to-end', action = 'store_true', help = 'Skip the full painting runs.' )
+    parser.add_argument( '--stage-calls', type = int, default = N_STAGE_CALLS, help = 'Calls per timed stage.' )
+    parser.add_argument( '--repeats', type = int, default = N_REPEATS, help = 'Repeats per timing, the fastest one is reported.' )
+    parser.add_argument(
+        '--processes', type = int, default = N_PROCESSES,
+        help = 'Fresh processes per workload, the best value of all of them is reported.'
+    )
+    parser.add_argument(
+        '--kernels', action = 'store_true',
+        help = 'Compare the compositing and redraw kernels with their references instead of running the workloads.'
+    )
+    parser.add_argument( '--redraw-brushes', type = int, default = REDRAW_N_BRUSHES, help = 'Brushes of the redraw kernels.' )
+    parser.add_argument( '--redraw-size', type = int, default = REDRAW_IMAGE_SIZE, help = 'Image size of the redraw kernels.' )
+    return parser.parse_args( arguments )
+
+
+def main( arguments : Optional[ list[ str ] ] = None ) -> int:
+    logging.basicConfig( level = logging.WARNING, format = '%(levelname)s %(name)s: %(message)s' )
+    logger.setLevel( logging.INFO )
+    args = _parse_arguments( arguments )
+
+    if args.kernels:
+        results = run_kernel_benchmarks( n_redraw_brushes = args.redraw_brushes, redraw_image_size = args.redraw_size )
+        print( json.dumps( results, indent = 2 ) )
+        if args.output is not None:
+            args.output.write_text( json.dumps( results, indent = 2 ) )
+        return 0
+
+    workloads = get_workloads( include_synthetic = not args.no_synthetic, include_bundled = not args.no_bundled )
+    if args.workloads:
+        workloads = [ workload for workload in workloads if any( name in workload.name for name in args.workloads ) ]
+    if not workloads:
+        logger.error( 'No workloads to run.' )
+        return 2
+
+    results = run_benchmarks(
+        workloads,
+        n_stage_calls = args.stage_calls,
+        n_repeats = args.repeats,
+        n_processes = max( 1, args.processes ),
+        end_to_end = not args.no_end_to_end,
+    )
+    print( json.dumps( results, indent = 2 ) )
+    if args.output is not None:
+        args.output.write_text( json.dumps( results, indent = 2 ) )
+        logger.info( f'Wrote results to {args.output}' )
+
+    if args.baseline is None:
+        return 0
+    baseline = json.loads( args.baseline.read_text() )
+    if baseline.get( 'format_version' ) != BENCH_FORMAT_VERSION:
+        logger.error( f'Baseline {args.baseline} has another format version, run it again with this version.' )
+        return 2
+    regressions = find_regressions( results, baseline, threshold = args.threshold )
+    for regression in regressions:
+        logger.error( f'Regression: {regression}' )
+    if regressions:
+        return 1
+    logger.info( f'No regressions compared to {args.baseline}.' )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -1,24 +1,22 @@
 from dataclasses import dataclass
-from enum import Enum, auto
-import random
 
 import cv2
 import numpy as np
-from pathlib import Path
-from typing import Optional, List
+from typing import Optional
 
-from finch.primitive_types import Color, Point, FitnessScore
+from finch.brush_bank import BrushBank, BrushSet
+from finch.brush_stamp_cache import BrushStampCache
+from finch.composite import composite_color_inplace
+from finch.primitive_types import Color, Point, FitnessScore, Roi
 
 
-ROOT_DIR                        = Path( __file__ ).parent.parent
-DEFAULT_BRUSH_DIRECTORY         = ROOT_DIR / 'finch/brushes'
-
-
-class BrushSet(Enum):
-    Canvas = auto()
-    Oil = auto()
-    Sketch = auto()
-    Watercolor = auto()
+# Rendered brush stamps are cached per brush set, texture, size and angle.
+# Sizes and angles are quantized to increase the number of stamps that can be reused.
+# Brush sizes are integers already, so a size step of 1 keeps them exact,
+# an angle step of 0 disables quantization of the angle.
+STAMP_SIZE_QUANTIZATION_STEP : int = 1
+STAMP_ANGLE_QUANTIZATION_STEP_DEGREES : float = 1.0
+STAMP_CACHE_MAX_SIZE_BYTES : int = 256 * 1024 * 1024
 
 
 @dataclass
@@ -58,85 +56,128 @@ def get_brush_size_for_fitness( fitness : FitnessScore, image_height : int, imag
     return brush_size
 
 
-PRELOADED_BUSH_TEXTURES : Optional[List ] = None
+def get_brush_size_for_detail( brush_size : int, gradient_magnitude : float, edge_size_reduction : float ) -> int:
+    # Brushes on strong edges are made smaller, by up to the given fraction for the strongest edge of the image,
+    # so that details are painted with finer strokes than flat regions
+    return max( 1, int( brush_size * ( 1 - edge_size_reduction * gradient_magnitude ) ) )
 
 
-def _set_global_brush_textures( brush_textures : List[np.ndarray ] ) -> None:
-    global PRELOADED_BUSH_TEXTURES
-    PRELOADED_BUSH_TEXTURES = brush_textures
+BRUSH_STAMP_CACHE = BrushStampCache( max_size_bytes = STAMP_CACHE_MAX_SIZE_BYTES )
 
 
-def get_global_brush_textures() -> List[np.ndarray]:
-    return PRELOADED_BUSH_TEXTURES
+def _quantize_stamp_size( size : int ) -> int:
+    if STAMP_SIZE_QUANTIZATION_STEP <= 1:
+        return size
+    return max( 1, round( size / STAMP_SIZE_QUANTIZATION_STEP ) * STAMP_SIZE_QUANTIZATION_STEP )
 
 
-def _preload_brush_textures_from_path( directory_name : Path ) -> None:
-    texture_paths = []
-    for extension in [ '.jpg', '.png' ]:
-        texture_paths.extend( list( directory_name.rglob( f'*{extension}' ) ) )
-    textures = [ cv2.imread( str(texture_path) ) for texture_path in texture_paths ]
-    textures = [ cv2.cvtColor( texture, cv2.COLOR_BGR2GRAY ) for texture in textures ]
-    _set_global_brush_textures( textures )
+def _quantize_stamp_angle( angle : float ) -> float:
+    if STAMP_ANGLE_QUANTIZATION_STEP_DEGREES <= 0:
+        return angle
+    quantized_angle = round( angle / STAMP_ANGLE_QUANTIZATION_STEP_DEGREES ) * STAMP_ANGLE_QUANTIZATION_STEP_DEGREES
+    return quantized_angle % 360
 
 
-def _brush_set_to_directory_path(brush_set: BrushSet) -> str:
-    directory_name = {
-        BrushSet.Oil : 'oil',
-        BrushSet.Sketch : 'sketch',
-        BrushSet.Canvas : 'canvas',
-        BrushSet.Watercolor : 'watercolor'
-    }[brush_set]
-    directory_path = DEFAULT_BRUSH_DIRECTORY / directory_name
-    return directory_path
+def _render_brush_stamp( brush_texture_original : np.ndarray, size : int, angle : float ) -> np.ndarray:
+    brush_texture_scaled = cv2.resize( brush_texture_original, (size, size) )
+    brush_height, brush_width = brush_texture_scaled.shape[:2]
 
+    transformation_matrix = cv2.getRotationMatrix2D( (brush_width/2, brush_height/2), angle, 1 )
+    brush_texture_rotated = cv2.warpAffine( brush_texture_scaled, transformation_matrix, (brush_width, brush_height))
 
-def preload_brush_textures_for_brush_set( brush_set : BrushSet ) -> None:
-    brush_directory_path = _brush_set_to_directory_path( brush_set )
-    _preload_brush_textures_from_path( brush_directory_path )
+    # The texture values are used directly as fixed point alpha, see finch.composite
+    alpha = brush_texture_rotated.astype( np.uint16 )
+    return alpha
 
 
-def random_brush_texture_index():
-    return random.choice( range( len( get_global_brush_textures() ) ) )
+def get_brush_stamp_key( brush : Brush, brush_bank : BrushBank ) -> tuple:
+    """
+    Returns the key of the stamp of the brush, brushes with equal keys share their stamp.
+    """
+    return ( brush_bank.brush_set, brush.texture_index, _quantize_stamp_size( brush.size ), _quantize_stamp_angle( brush.angle ) )
 
 
-def draw_brush_on_image( brush : Brush, image : np.ndarray ) -> np.ndarray:
-    image_height, image_width = image.shape[:2]
+def get_brush_stamp_nbytes( brush : Brush ) -> int:
+    # Stamps are square, see _render_brush_stamp
+    size = _quantize_stamp_size( brush.size )
+    return size * size * np.dtype( np.uint16 ).itemsize
 
-    brush_texture_original = get_global_brush_textures()[brush.texture_index ]
-    brush_texture_scaled = cv2.resize( brush_texture_original, (brush.size, brush.size) )
-    brush_height, brush_width = brush_texture_scaled.shape[:2]
-
-    transformation_matrix = cv2.getRotationMatrix2D( (brush_width/2, brush_height/2), brush.angle, 1 )
-    brush_texture_rotated = cv2.warpAffine( brush_texture_scaled, transformation_matrix, (brush_width, brush_height))
 
-    alpha = brush_texture_rotated.astype( float ) / 255.0
-    alpha_3 = np.dstack( (alpha, alpha, alpha) )
+def get_brush_stamp( brush : Brush, brush_bank : BrushBank ) -> np.ndarray:
+    """
+    Returns the alpha mask of the brush, scaled and rotated, with values between 0 and 255.
+    """
+    key = get_brush_stamp_key( brush, brush_bank )
+    _, texture_index, size, angle = key
+    return BRUSH_STAMP_CACHE.get(
+        key, lambda: _render_brush_stamp( brush_bank.textures[ texture_index ], size, angle )
+    )
 
-    foreground = np.full_like(brush_texture_rotated, brush.color, shape=(*brush_texture_rotated.shape, 3))
 
+def _get_brush_draw_origin( brush : Brush ) -> tuple[ int, int ]:
     # Where to start drawing, in Canvas Space
-    draw_y = int( brush.position.y - brush_width / 2 )
-    draw_x = int( brush.position.x - brush_height / 2 )
+    # note that brush width and height are expected to be equal
+    size = _quantize_stamp_size( brush.size )
+    draw_y = int( brush.position.y - size / 2 )
+    draw_x = int( brush.position.x - size / 2 )
+    return draw_y, draw_x
+
+
+def get_brush_roi( brush : Brush, image_height : int, image_width : int ) -> Roi:
+    """
+    Returns the region of the canvas that is affected when drawing the brush,
+    clipped to the borders of the canvas.
+    """
+    draw_y, draw_x = _get_brush_draw_origin( brush )
+    size = _quantize_stamp_size( brush.size )
+    return Roi(
+        y_min = max( draw_y, 0 ),
+        y_max = min( draw_y + size, image_height ),
+        x_min = max( draw_x, 0 ),
+        x_max = min( draw_x + size, image_width ),
+    )
+
+
+def get_brush_stamp_subsection( alpha : np.ndarray, brush : Brush, roi : Roi ) -> np.ndarray:
+    """
+    Returns the part of the stamp of the brush that covers the roi, in Canvas Space.
+    The roi is expected to be within the roi of the brush.
+    """
+    # We have to adjust the roi to the size of the brush matrix
+    draw_y, draw_x = _get_brush_draw_origin( brush )
+    return alpha[
+        roi.y_min - draw_y : roi.y_max - draw_y,
+        roi.x_min - draw_x : roi.x_max - draw_x
+    ]
+
+
+def draw_brush_on_image(
+        brush : Brush,
+        image : np.ndarray,
+        brush_bank : BrushBank,
+        clip_roi : Optional[ Roi ] = None,
+        stamp : Optional[ np.ndarray ] = None,
+) -> np.ndarray:
+    """
+    Draws the brush on the image.
+    If a clip ROI is given, only the part of the brush within it is drawn,
+    which gives exactly the same pixels within the clip ROI as drawing the full brush.
+    If a stamp is given, it is drawn instead of looking up the stamp of the brush, see get_brush_stamp.
+    """
+    image_height, image_width = image.shape[:2]
 
     # Adjust ROI to make sure we do not cross the borders of the canvas space
-    y_min = max( draw_y, 0 )
-    y_max = min( draw_y + brush_height, image_height )
-    x_min = max( draw_x, 0 )
-    x_max = min( draw_x + brush_width, image_width )
+    roi = get_brush_roi( brush, image_height, image_width )
+    if clip_roi is not None:
+        roi = roi.intersection( clip_roi )
+        if roi.is_empty():
+            return image
 
-    # background is the original image, foreground is the brush on top
-    background_subsection = image[y_min:y_max, x_min:x_max]
+    alpha = stamp if stamp is not None else get_brush_stamp( brush, brush_bank )
 
-    # We have to adjust the roi to the size of the brush matrix
-    foreground_subsection = foreground[
-        y_min - draw_y : y_max - draw_y,
-        x_min - draw_x : x_max - draw_x
-    ]
-    alpha_subsection = alpha_3[
-        y_min - draw_y : y_max - draw_y,
-        x_min - draw_x : x_max - draw_x
-    ]
+    # background is the original image, foreground is the brush on top
+    background_subsection = image[ roi.slices() ]
+    alpha_subsection = get_brush_stamp_subsection( alpha, brush, roi )
 
-    composite = background_subsection * (1 - alpha_subsection) + foreground_subsection * alpha_subsection
-    image[ y_min:y_max, x_min:x_max ] = composite
+    composite_color_inplace( background_subsection, alpha_subsection, brush.color )
     return image
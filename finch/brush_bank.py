@@ -0,0 +1,200 @@
+import logging
+
+from dataclasses import dataclass
+from enum import Enum, auto
+import json
+import os
+from pathlib import Path
+import random
+import threading
+from typing import Optional
+
+import cv2
+import numpy as np
+
+
+ROOT_DIR                        = Path( __file__ ).parent.parent
+DEFAULT_BRUSH_DIRECTORY         = ROOT_DIR / 'finch/brushes'
+
+TEXTURE_EXTENSIONS = [ '.jpg', '.png' ]
+
+# All textures of all brush sets can be packed into a single array, which is memory mapped when it is loaded,
+# so that processes on the same machine share its pages instead of each decoding the textures.
+# Build it with: python -m finch.brush_bank
+# If it is missing or out of date, the textures are decoded instead.
+PACKED_BRUSH_BANK_PATH          = DEFAULT_BRUSH_DIRECTORY / 'brush_bank.npy'
+PACKED_BRUSH_BANK_INDEX_PATH    = DEFAULT_BRUSH_DIRECTORY / 'brush_bank.json'
+PACKED_BRUSH_BANK_FORMAT_VERSION = 1
+
+
+logger = logging.getLogger(__name__)
+
+
+class BrushSet(Enum):
+    Canvas = auto()
+    Oil = auto()
+    Sketch = auto()
+    Watercolor = auto()
+
+
+@dataclass( eq = False )
+class BrushBank:
+    """
+    The textures of a brush set, as grayscale images.
+    Banks are read only once they are loaded, so a single bank can be shared by concurrent paintings.
+    """
+    brush_set : BrushSet
+    textures : tuple[ np.ndarray, ... ]
+
+    def __len__( self ) -> int:
+        return len( self.textures )
+
+    def random_texture_index( self, rng : random.Random ) -> int:
+        return rng.choice( range( len( self.textures ) ) )
+
+    def random_texture_indices( self, rng : random.Random, n : int ) -> list[ int ]:
+        return [ self.random_texture_index( rng ) for _ in range( n ) ]
+
+
+_BRUSH_BANKS : dict[ BrushSet, BrushBank ] = {}
+_BRUSH_BANKS_LOCK = threading.Lock()
+
+
+def _brush_set_to_directory_path( brush_set : BrushSet ) -> Path:
+    directory_name = {
+        BrushSet.Oil : 'oil',
+        BrushSet.Sketch : 'sketch',
+        BrushSet.Canvas : 'canvas',
+        BrushSet.Watercolor : 'watercolor'
+    }[brush_set]
+    directory_path = DEFAULT_BRUSH_DIRECTORY / directory_name
+    return directory_path
+
+
+def _get_texture_paths( brush_set : BrushSet ) -> list[ Path ]:
+    # Sorted, so that texture indices do not depend on the order in which the file system lists the files
+    directory_path = _brush_set_to_directory_path( brush_set )
+    texture_paths = []
+    for extension in TEXTURE_EXTENSIONS:
+        texture_paths.extend( directory_path.rglob( f'*{extension}' ) )
+    return sorted( texture_paths )
+
+
+def _decode_texture( texture_path : Path ) -> np.ndarray:
+    texture = cv2.imread( str( texture_path ) )
+    if texture is None:
+        raise ValueError( f'Could not read brush texture {texture_path}.' )
+    texture = cv2.cvtColor( texture, cv2.COLOR_BGR2GRAY )
+    texture.flags.writeable = False
+    return texture
+
+
+def _decode_brush_bank( brush_set : BrushSet ) -> BrushBank:
+    textures = tuple( _decode_texture( texture_path ) for texture_path in _get_texture_paths( brush_set ) )
+    return BrushBank( brush_set = brush_set, textures = textures )
+
+
+def _get_texture_index_entry( texture_path : Path ) -> dict:
+    return {
+        'path' : texture_path.relative_to( DEFAULT_BRUSH_DIRECTORY ).as_posix(),
+        'size_bytes' : texture_path.stat().st_size,
+    }
+
+
+def write_packed_brush_banks(
+        array_path : Path = PACKED_BRUSH_BANK_PATH,
+        index_path : Path = PACKED_BRUSH_BANK_INDEX_PATH,
+) -> None:
+    """
+    Decodes the textures of all brush sets, and writes them to a single flat array,
+    together with an index of where every texture starts, and which file it was decoded from.
+    """
+    chunks = []
+    index = { 'format_version' : PACKED_BRUSH_BANK_FORMAT_VERSION, 'brush_sets' : {} }
+    offset = 0
+    for brush_set in BrushSet:
+        entries = []
+        for texture_path in _get_texture_paths( brush_set ):
+            texture = _decode_texture( texture_path )
+            entry = _get_texture_index_entry( texture_path )
+            entry.update( { 'offset' : offset, 'shape' : list( texture.shape ) } )
+            entries.append( entry )
+            chunks.append( texture.ravel() )
+            offset += texture.size
+        index[ 'brush_sets' ][ brush_set.name ] = entries
+
+    packed_textures = np.concatenate( chunks ) if chunks else np.zeros( 0, dtype = np.uint8 )
+    # Written next to the final files first, so readers never see a partially written bank
+    temporary_array_path = array_path.with_name( f'.{array_path.name}.tmp' )
+    temporary_index_path = index_path.with_name( f'.{index_path.name}.tmp' )
+    with open( temporary_array_path, 'wb' ) as array_file:
+        np.save( array_file, packed_textures )
+    temporary_index_path.write_text( json.dumps( index, indent = 2 ) )
+    os.replace( temporary_array_path, array_path )
+    os.replace( temporary_index_path, index_path )
+    logger.info( f'Wrote {offset / ( 1024 * 1024 ):.2f} MiB of brush textures to {array_path}' )
+
+
+def _load_packed_brush_banks(
+        array_path : Path = PACKED_BRUSH_BANK_PATH,
+        index_path : Path = PACKED_BRUSH_BANK_INDEX_PATH,
+) -> Optional[ dict[ BrushSet, BrushBank ] ]:
+    """
+    Returns the brush banks of the packed textures,
+    or None if there are no packed textures, or if they do not match the texture files anymore.
+    """
+    if not array_path.exists() or not index_path.exists():
+        return None
+    index = json.loads( index_path.read_text() )
+    if index.get( 'format_version' ) != PACKED_BRUSH_BANK_FORMAT_VERSION:
+        logger.warning( f'Packed brush textures {array_path} have an unsupported format, decoding the textures instead.' )
+        return None
+
+    packed_textures = np.load( array_path, mmap_mode = 'r' )
+    brush_banks = {}
+    for brush_set in BrushSet:
+        entries = index[ 'brush_sets' ].get( brush_set.name, [] )
+        expected_entries = [ _get_texture_index_entry( texture_path ) for texture_path in _get_texture_paths( brush_set ) ]
+        if [ { 'path' : entry[ 'path' ], 'size_bytes' : entry[ 'size_bytes' ] } for entry in entries ] != expected_entries:
+            logger.warning( f'Packed brush textures {array_path} are out of date, decoding the textures instead.' )
+            return None
+        textures = tuple(
+            packed_textures[ entry[ 'offset' ] : entry[ 'offset' ] + int( np.prod( entry[ 'shape' ] ) ) ].reshape( entry[ 'shape' ] )
+            for entry in entries
+        )
+        brush_banks[ brush_set ] = BrushBank( brush_set = brush_set, textures = textures )
+    return brush_banks
+
+
+def preload_brush_banks() -> None:
+    """
+    Loads the banks of all brush sets, so that requests never have to wait for them.
+    Intended to be called once, when a process starts.
+    """
+    with _BRUSH_BANKS_LOCK:
+        if len( _BRUSH_BANKS ) == len( BrushSet ):
+            return
+        brush_banks = _load_packed_brush_banks()
+        if brush_banks is not None:
+            logger.info( f'Loaded packed brush textures from {PACKED_BRUSH_BANK_PATH}' )
+        else:
+            brush_banks = { brush_set : _decode_brush_bank( brush_set ) for brush_set in BrushSet }
+        for brush_set, brush_bank in brush_banks.items():
+            _BRUSH_BANKS.setdefault( brush_set, brush_bank )
+
+
+def get_brush_bank( brush_set : BrushSet ) -> BrushBank:
+    """
+    Returns the bank of the brush set, which is only loaded the first time it is needed, unless it was preloaded.
+    """
+    with _BRUSH_BANKS_LOCK:
+        brush_bank = _BRUSH_BANKS.get( brush_set )
+        if brush_bank is None:
+            brush_bank = _decode_brush_bank( brush_set )
+            _BRUSH_BANKS[ brush_set ] = brush_bank
+        return brush_bank
+
+
+if __name__ == '__main__':
+    logging.basicConfig( level = logging.INFO )
+    write_packed_brush_banks()
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import logging
+import threading
+from typing import Callable, Hashable
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class BrushStampCache:
+    """
+    A bounded LRU cache of pre-rendered brush stamps.
+    Rendering a stamp means resizing and rotating the original brush texture,
+    which is much more expensive than compositing the stamp onto the canvas.
+    Most strokes share only a few sizes, so most stamps can be reused.
+    If multiple threads miss the same stamp at the same time, only one of them renders it,
+    the others wait for the result.
+    """
+
+    def __init__( self, max_size_bytes : int ) :
+        self.max_size_bytes = max_size_bytes
+        self._stamps : OrderedDict[ Hashable, np.ndarray ] = OrderedDict()
+        self._pending_renders : dict[ Hashable, threading.Event ] = {}
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+
+    def get( self, key : Hashable, render : Callable[ [], np.ndarray ] ) -> np.ndarray:
+        while True:
+            with self._lock:
+                stamp = self._stamps.get( key )
+                if stamp is not None:
+                    self._stamps.move_to_end( key )
+                    self.n_hits += 1
+                    return stamp
+                pending_render = self._pending_renders.get( key )
+                if pending_render is None:
+                    self.n_misses += 1
+                    pending_render = threading.Event()
+                    self._pending_renders[ key ] = pending_render
+                    break
+            # Another thread is rendering this stamp already, the stamp is usually cached once it is done
+            pending_render.wait()
+
+        try:
+            stamp = render()
+            stamp.setflags( write = False )
+
+            with self._lock:
+                if key not in self._stamps:
+                    self._stamps[ key ] = stamp
+                    self._size_bytes += stamp.nbytes
+                while self._size_bytes > self.max_size_bytes and len( self._stamps ) > 1:
+                    _, evicted_stamp = self._stamps.popitem( last = False )
+                    self._size_bytes -= evicted_stamp.nbytes
+        finally:
+            with self._lock:
+                del self._pending_renders[ key ]
+            pending_render.set()
+        return stamp
+
+
+    def clear( self ) -> None:
+        with self._lock:
+            self._stamps.clear()
+            self._size_bytes = 0
+            self.n_hits = 0
+            self.n_misses = 0
+
+
+    def log_stats( self ) -> None:
+        n_lookups = self.n_hits + self.n_misses
+        hit_rate = self.n_hits / n_lookups if n_lookups > 0 else 0
+        size_mib = self._size_bytes / ( 1024 * 1024 )
+        logger.info(
+            f'Brush stamp cache: {self.n_hits}/{n_lookups} hits ({hit_rate:.1%}), '
+            f'{len( self._stamps )} stamps, {size_mib:.1f} MiB.'
+        )
@@ -0,0 +1,210 @@
+from collections import deque
+from dataclasses import dataclass
+import math
+import threading
+import time
+from typing import Optional
+
+
+# The time that is reserved to finish a painting after the evolution: the 4K redraw and the encoding of the results.
+# It grows with the number of strokes, which all have to be redrawn, see finch.bench for the measured durations.
+# These are measured on a single core, and corrected by the durations of the paintings that finished in the process.
+FINISH_SECONDS_BASE : float = 5.0
+FINISH_SECONDS_PER_STROKE : float = 0.001
+# How quickly the correction follows the measured durations, between 0 (never) and 1 (only the last painting)
+FINISH_SECONDS_CORRECTION_RATE : float = 0.5
+# The correction is never below this, so that a single fast painting does not leave too little time for the next one
+MIN_FINISH_SECONDS_CORRECTION : float = 0.5
+
+# Adaptive patience stops once this many rejections in a row would be unlikely at the recent acceptance rate,
+# so the patience is longer when improvements get rare, instead of giving up after a fixed number of generations.
+ADAPTIVE_PATIENCE_FALSE_STOP_PROBABILITY : float = 0.01
+# The acceptance rate is a moving average over roughly this many generations
+ACCEPTANCE_RATE_WINDOW : int = 200
+# Relative to the patience of the tunables
+MIN_PATIENCE_FACTOR : float = 0.5
+MAX_PATIENCE_FACTOR : float = 4.0
+
+# The improvement per second is measured over this window
+IMPROVEMENT_WINDOW_SECONDS : float = 2.0
+
+
+@dataclass( frozen = True )
+class RunBudget:
+    """
+    Limits of a single painting, on top of the patience and termination score of the tunables.
+    The deadline is the wall clock time of the whole painting, in seconds,
+    including the 4K redraw and the encoding of the results, for which time is reserved.
+    The minimum improvement is in rounded scores per second, see finch.evolution.get_rounded_score.
+    """
+    deadline_seconds : Optional[ float ] = None
+    max_generations : Optional[ int ] = None
+    max_strokes : Optional[ int ] = None
+    min_improvement_per_second : Optional[ float ] = None
+    adaptive_patience : bool = False
+
+    @property
+    def is_deterministic( self ) -> bool:
+        # Limits on time depend on the speed of the machine, so their results cannot be reused
+        return self.deadline_seconds is None and self.min_improvement_per_second is None
+
+
+class FinishTimeEstimator:
+    """
+    Predicts how long it takes to finish a painting with a number of strokes,
+    corrected by the ratio of measured and predicted durations of the paintings that finished before.
+    Shared by all paintings of the process.
+    """
+
+    def __init__( self ) :
+        self._correction = 1.0
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def get_uncorrected_seconds( n_strokes : int, base_seconds : float, seconds_per_stroke : float ) -> float:
+        return base_seconds + seconds_per_stroke * n_strokes
+
+
+    def get_seconds(
+            self,
+            n_strokes : int,
+            base_seconds : float = FINISH_SECONDS_BASE,
+            seconds_per_stroke : float = FINISH_SECONDS_PER_STROKE,
+    ) -> float:
+        return self._correction * self.get_uncorrected_seconds( n_strokes, base_seconds, seconds_per_stroke )
+
+
+    def record( self, n_strokes : int, finish_seconds : float ) -> None:
+        ratio = finish_seconds / self.get_uncorrected_seconds( n_strokes, FINISH_SECONDS_BASE, FINISH_SECONDS_PER_STROKE )
+        with self._lock:
+            self._correction += ( ratio - self._correction ) * FINISH_SECONDS_CORRECTION_RATE
+            self._correction = max( self._correction, MIN_FINISH_SECONDS_CORRECTION )
+
+
+FINISH_TIME_ESTIMATOR = FinishTimeEstimator()
+
+
+class ConvergenceController:
+    """
+    Decides when the evolution of a painting stops, based on its budget.
+    A single controller is shared by all evolutions of a painting, such as the levels of a pyramid,
+    so the limits apply to the painting as a whole.
+    The deadline is kept as a wall clock time, so it can be handed to other processes.
+    Controllers of parts of a painting, such as tiles, only reserve time for the strokes of their own part,
+    weighted by the number of parts that are painted alongside it.
+    """
+
+    def __init__(
+            self,
+            budget : RunBudget,
+            deadline_time : Optional[ float ] = None,
+            finish_seconds_base : float = FINISH_SECONDS_BASE,
+            finish_seconds_per_stroke : float = FINISH_SECONDS_PER_STROKE,
+    ) :
+        self.budget = budget
+        self.finish_seconds_base = finish_seconds_base
+        self.finish_seconds_per_stroke = finish_seconds_per_stroke
+        self.start_time = time.time()
+        if deadline_time is None and budget.deadline_seconds is not None:
+            deadline_time = self.start_time + budget.deadline_seconds
+        self.deadline_time = deadline_time
+        self.n_generations = 0
+        self.n_strokes = 0
+        self._acceptance_rate : Optional[ float ] = None
+        self._score_samples : deque[ tuple[ float, int ] ] = deque()
+
+
+    def get_finish_seconds( self ) -> float:
+        return FINISH_TIME_ESTIMATOR.get_seconds( self.n_strokes, self.finish_seconds_base, self.finish_seconds_per_stroke )
+
+
+    def get_evolution_deadline_time( self ) -> Optional[ float ]:
+        """
+        Returns the wall clock time at which the evolution has to stop, to finish the painting before the deadline.
+        """
+        if self.deadline_time is None:
+            return None
+        return self.deadline_time - self.get_finish_seconds()
+
+
+    def get_state( self ) -> dict:
+        """
+        Returns the counters that carry over when a painting is resumed, see finch.checkpoint.
+        The deadline and the improvement per second are measured again by the resumed painting.
+        """
+        return {
+            'n_generations' : self.n_generations,
+            'n_strokes' : self.n_strokes,
+            'acceptance_rate' : self._acceptance_rate,
+        }
+
+
+    def restore_state( self, state : dict ) -> None:
+        self.n_generations = state[ 'n_generations' ]
+        self.n_strokes = state[ 'n_strokes' ]
+        self._acceptance_rate = state[ 'acceptance_rate' ]
+
+
+    def add_strokes( self, n_strokes : int ) -> None:
+        # For strokes that were accepted elsewhere, such as in the processes of tiles
+        self.n_strokes += n_strokes
+
+
+    def update( self, n_accepted_strokes : int, rounded_score : int ) -> None:
+        self.n_generations += 1
+        self.n_strokes += n_accepted_strokes
+        acceptance = 1.0 if n_accepted_strokes > 0 else 0.0
+        if self._acceptance_rate is None:
+            self._acceptance_rate = acceptance
+        else:
+            self._acceptance_rate += ( acceptance - self._acceptance_rate ) / ACCEPTANCE_RATE_WINDOW
+
+        if self.budget.min_improvement_per_second is not None:
+            now = time.time()
+            self._score_samples.append( ( now, rounded_score ) )
+            # Keep a single sample older than the window, to measure over the whole window
+            while len( self._score_samples ) > 1 and now - self._score_samples[ 1 ][ 0 ] >= IMPROVEMENT_WINDOW_SECONDS:
+                self._score_samples.popleft()
+
+
+    def get_patience( self, n_iterations_patience : int ) -> int:
+        """
+        Returns the patience for the recent acceptance rate, bounded relative to the given patience.
+        Until the acceptance rate is known well enough, the given patience is used.
+        """
+        if not self.budget.adaptive_patience or self.n_generations < ACCEPTANCE_RATE_WINDOW:
+            return n_iterations_patience
+        min_patience = max( 1, int( n_iterations_patience * MIN_PATIENCE_FACTOR ) )
+        max_patience = int( n_iterations_patience * MAX_PATIENCE_FACTOR )
+        acceptance_rate = min( max( self._acceptance_rate, 1e-6 ), 1 - 1e-6 )
+        patience = math.ceil( math.log( ADAPTIVE_PATIENCE_FALSE_STOP_PROBABILITY ) / math.log( 1 - acceptance_rate ) )
+        return min( max( patience, min_patience ), max_patience )
+
+
+    def get_improvement_per_second( self ) -> Optional[ float ]:
+        if len( self._score_samples ) < 2:
+            return None
+        ( start_time, start_score ), ( end_time, end_score ) = self._score_samples[ 0 ], self._score_samples[ -1 ]
+        if end_time - start_time < IMPROVEMENT_WINDOW_SECONDS:
+            return None
+        return ( start_score - end_score ) / ( end_time - start_time )
+
+
+    def get_stop_reason( self ) -> Optional[ str ]:
+        """
+        Returns why the evolution has to stop, or None if it can go on.
+        """
+        budget = self.budget
+        if budget.max_generations is not None and self.n_generations >= budget.max_generations:
+            return f'Reached the maximum of {budget.max_generations} generations.'
+        if budget.max_strokes is not None and self.n_strokes >= budget.max_strokes:
+            return f'Reached the maximum of {budget.max_strokes} strokes.'
+        evolution_deadline_time = self.get_evolution_deadline_time()
+        if evolution_deadline_time is not None and time.time() >= evolution_deadline_time:
+            return f'Reached the deadline, {self.get_finish_seconds():.1f} seconds are left to finish the painting.'
+        if budget.min_improvement_per_second is not None:
+            improvement_per_second = self.get_improvement_per_second()
+            if improvement_per_second is not None and improvement_per_second < budget.min_improvement_per_second:
+                return f'Improvement of {improvement_per_second:.1f} per second dropped below {budget.min_improvement_per_second}.'
+        return None
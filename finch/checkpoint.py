@@ -0,0 +1,277 @@
+import logging
+
+from dataclasses import asdict, dataclass
+import hashlib
+import json
+import os
+from pathlib import Path
+import tempfile
+import time
+from typing import Optional
+
+import numpy as np
+
+from finch.brush import draw_brush_on_image
+from finch.context import EngineContext
+from finch.primitive_types import Image
+from finch.specimen import Specimen
+from finch.stroke_log import StrokeLog
+
+
+# Checkpoints are written at most this often while painting, and once more when the evolution ends
+CHECKPOINT_INTERVAL_SECONDS : float = 10.0
+
+CHECKPOINT_MAGIC = b'FCKP'
+CHECKPOINT_FORMAT_VERSION = 1
+# The header is followed by the metadata as JSON, the states of both random number generators as raw words,
+# and the brushes as a serialized stroke log, see StrokeLog.to_bytes
+CHECKPOINT_HEADER_DTYPE = np.dtype( [ ( 'magic', 'S4' ), ( 'version', '<u4' ), ( 'metadata_size', '<u8' ) ] )
+RNG_STATE_DTYPE = np.dtype( '<u4' )
+# The Mersenne Twister state of random, including its position, and the key of numpy, without its position
+N_RNG_STATE_WORDS = 625
+N_NP_RNG_STATE_WORDS = 624
+
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointError( Exception ):
+    pass
+
+
+@dataclass
+class EvolutionState:
+    """
+    The state of the loop of an evolution, apart from the specimen and the random number generators.
+    Together with those, it is enough to continue the evolution as if it was never interrupted.
+    """
+    last_written_score : int
+    generation_index : int = 0
+    n_iterations_with_same_score : int = 0
+
+
+def get_image_digest( image : Image ) -> str:
+    image = np.ascontiguousarray( image )
+    hasher = hashlib.sha256()
+    hasher.update( repr( ( image.shape, image.dtype.str ) ).encode() )
+    hasher.update( memoryview( image ).cast( 'B' ) )
+    return hasher.hexdigest()
+
+
+@dataclass
+class Checkpoint:
+    """
+    Everything needed to resume a painting: its brushes, the state of its evolution and of its random number generators,
+    and the counters of its controller, if it has a budget.
+    The canvas is not stored, it is rebuilt by replaying the brushes, see replay.
+    A converged checkpoint holds a finished painting, which can be redrawn without evolving it again.
+    """
+    brush_set_name : str
+    image_shape : tuple[ int, int ]
+    # Resuming with another target image or other tunables would not continue the same painting
+    target_image_digest : str
+    tunables : dict
+    seed : int
+    state : EvolutionState
+    rounded_score : int
+    is_converged : bool
+    rng_state : tuple
+    np_rng_state : tuple
+    controller_state : Optional[ dict ]
+    brushes : StrokeLog
+
+
+    @classmethod
+    def capture(
+            cls,
+            specimen : Specimen,
+            target_image_digest : str,
+            state : EvolutionState,
+            rounded_score : int,
+            context : EngineContext,
+            is_converged : bool = False,
+    ) -> "Checkpoint":
+        return cls(
+            brush_set_name = context.brush_bank.brush_set.name,
+            image_shape = specimen.cached_image.shape[:2],
+            target_image_digest = target_image_digest,
+            tunables = asdict( context.tunables ),
+            seed = context.seed,
+            state = EvolutionState( **asdict( state ) ),
+            rounded_score = rounded_score,
+            is_converged = is_converged,
+            rng_state = context.rng.getstate(),
+            np_rng_state = context.np_rng.get_state(),
+            controller_state = context.controller.get_state() if context.controller is not None else None,
+            brushes = specimen.brushes.copy(),
+        )
+
+
+    def validate( self, target_image : Image, context : EngineContext ) -> None:
+        """
+        Raises a CheckpointError if the checkpoint belongs to another painting than the one of the target image and context.
+        """
+        if self.brush_set_name != context.brush_bank.brush_set.name:
+            raise CheckpointError( f'Checkpoint uses brush set {self.brush_set_name}, not {context.brush_bank.brush_set.name}.' )
+        if self.target_image_digest != get_image_digest( target_image ):
+            raise CheckpointError( 'Checkpoint belongs to another target image.' )
+        if self.tunables != asdict( context.tunables ) or self.seed != context.seed:
+            raise CheckpointError( 'Checkpoint was painted with other tunables.' )
+
+
+    def restore( self, context : EngineContext ) -> None:
+        """
+        Restores the random number generators of the context, and the counters of its controller.
+        """
+        context.rng.setstate( self.rng_state )
+        context.np_rng.set_state( self.np_rng_state )
+        if context.controller is not None and self.controller_state is not None:
+            context.controller.restore_state( self.controller_state )
+
+
+    def replay( self, specimen : Specimen ) -> None:
+        """
+        Draws the brushes on the canvas of the specimen, in order, and adds them to its brushes.
+        Rejected brushes were rolled back exactly, so this rebuilds the canvas the checkpoint was taken from.
+        """
+        for brush in self.brushes:
+            draw_brush_on_image( brush = brush, image = specimen.cached_image, brush_bank = specimen.brush_bank )
+        specimen.brushes.extend( self.brushes )
+
+
+    def to_bytes( self ) -> bytes:
+        rng_version, rng_words, rng_gauss_next = self.rng_state
+        np_rng_algorithm, np_rng_key, np_rng_position, np_rng_has_gauss, np_rng_cached_gaussian = self.np_rng_state
+        metadata = {
+            'brush_set_name' : self.brush_set_name,
+            'image_shape' : list( self.image_shape ),
+            'target_image_digest' : self.target_image_digest,
+            'tunables' : self.tunables,
+            'seed' : self.seed,
+            'state' : asdict( self.state ),
+            'rounded_score' : self.rounded_score,
+            'is_converged' : self.is_converged,
+            'rng' : { 'version' : rng_version, 'gauss_next' : rng_gauss_next },
+            'np_rng' : {
+                'algorithm' : np_rng_algorithm,
+                'position' : int( np_rng_position ),
+                'has_gauss' : int( np_rng_has_gauss ),
+                'cached_gaussian' : float( np_rng_cached_gaussian ),
+            },
+            'controller_state' : self.controller_state,
+        }
+        metadata_bytes = json.dumps( metadata ).encode()
+        header = np.array( [ ( CHECKPOINT_MAGIC, CHECKPOINT_FORMAT_VERSION, len( metadata_bytes ) ) ], dtype = CHECKPOINT_HEADER_DTYPE )
+        return b''.join( [
+            header.tobytes(),
+            metadata_bytes,
+            np.asarray( rng_words, dtype = RNG_STATE_DTYPE ).tobytes(),
+            np.asarray( np_rng_key, dtype = RNG_STATE_DTYPE ).tobytes(),
+            self.brushes.to_bytes(),
+        ] )
+
+
+    @classmethod
+    def from_bytes( cls, data : bytes ) -> "Checkpoint":
+        if len( data ) < CHECKPOINT_HEADER_DTYPE.itemsize:
+            raise CheckpointError( 'Data is too short for a checkpoint.' )
+        header = np.frombuffer( data, dtype = CHECKPOINT_HEADER_DTYPE, count = 1 )[ 0 ]
+        if header[ 'magic' ] != CHECKPOINT_MAGIC:
+            raise CheckpointError( 'Data is not a checkpoint.' )
+        if header[ 'version' ] != CHECKPOINT_FORMAT_VERSION:
+            raise CheckpointError( f'Unsupported checkpoint format version {header[ "version" ]}.' )
+
+        try:
+            offset = CHECKPOINT_HEADER_DTYPE.itemsize
+            metadata_size = int( header[ 'metadata_size' ] )
+            metadata = json.loads( data[ offset : offset + metadata_size ] )
+            offset += metadata_size
+            rng_words = np.frombuffer( data, dtype = RNG_STATE_DTYPE, count = N_RNG_STATE_WORDS, offset = offset )
+            offset += rng_words.nbytes
+            np_rng_key = np.frombuffer( data, dtype = RNG_STATE_DTYPE, count = N_NP_RNG_STATE_WORDS, offset = offset )
+            offset += np_rng_key.nbytes
+            brushes = StrokeLog.from_bytes( data[ offset: ] )
+            rng = metadata[ 'rng' ]
+            np_rng = metadata[ 'np_rng' ]
+            return cls(
+                brush_set_name = metadata[ 'brush_set_name' ],
+                image_shape = tuple( metadata[ 'image_shape' ] ),
+                target_image_digest = metadata[ 'target_image_digest' ],
+                tunables = metadata[ 'tunables' ],
+                seed = metadata[ 'seed' ],
+                state = EvolutionState( **metadata[ 'state' ] ),
+                rounded_score = metadata[ 'rounded_score' ],
+                is_converged = metadata[ 'is_converged' ],
+                rng_state = ( rng[ 'version' ], tuple( rng_words.tolist() ), rng[ 'gauss_next' ] ),
+                np_rng_state = (
+                    np_rng[ 'algorithm' ],
+                    np_rng_key.astype( np.uint32 ),
+                    np_rng[ 'position' ],
+                    np_rng[ 'has_gauss' ],
+                    np_rng[ 'cached_gaussian' ],
+                ),
+                controller_state = metadata[ 'controller_state' ],
+                brushes = brushes,
+            )
+        # Missing or mistyped metadata is as corrupt as a truncated checkpoint
+        except ( ValueError, KeyError, TypeError ) as error:
+            raise CheckpointError( f'Checkpoint is corrupt: {error!r}' ) from error
+
+
+def write_checkpoint( checkpoint : Checkpoint, path : Path ) -> None:
+    """
+    Writes the checkpoint next to the path first, and then renames it,
+    so that an interrupted write never leaves a partial checkpoint behind.
+    """
+    path = Path( path )
+    # Unique across threads and processes, so concurrent writers of the same path never share a temporary file
+    file_descriptor, temporary_path = tempfile.mkstemp( prefix = f'.{path.name}.', suffix = '.tmp', dir = path.parent )
+    try:
+        with os.fdopen( file_descriptor, 'wb' ) as file:
+            file.write( checkpoint.to_bytes() )
+        os.replace( temporary_path, path )
+    except BaseException:
+        Path( temporary_path ).unlink( missing_ok = True )
+        raise
+
+
+def read_checkpoint( path : Path ) -> Checkpoint:
+    return Checkpoint.from_bytes( Path( path ).read_bytes() )
+
+
+class Checkpointer:
+    """
+    Writes checkpoints of a painting to a single path, at most once per interval,
+    always at the end of a generation, so that a resumed painting continues exactly where the checkpoint was taken.
+    """
+
+    def __init__( self, path : Path, target_image : Image, interval_seconds : float = CHECKPOINT_INTERVAL_SECONDS ) :
+        self.path = Path( path )
+        self.interval_seconds = interval_seconds
+        self._target_image_digest = get_image_digest( target_image )
+        self._last_write_time = time.perf_counter()
+
+
+    def write(
+            self,
+            specimen : Specimen,
+            state : EvolutionState,
+            rounded_score : int,
+            context : EngineContext,
+            is_converged : bool = False,
+    ) -> None:
+        checkpoint = Checkpoint.capture( specimen, self._target_image_digest, state, rounded_score, context, is_converged )
+        write_checkpoint( checkpoint, self.path )
+        self._last_write_time = time.perf_counter()
+        logger.info( f'Wrote checkpoint of {len( checkpoint.brushes )} brushes at generation {state.generation_index} to {self.path}' )
+
+
+    def write_if_due(
+            self,
+            specimen : Specimen,
+            state : EvolutionState,
+            rounded_score : int,
+            context : EngineContext,
+    ) -> None:
+        if time.perf_counter() - self._last_write_time >= self.interval_seconds:
+            self.write( specimen, state, rounded_score, context )
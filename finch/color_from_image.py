@@ -1,3 +1,5 @@
+import numpy as np
+
 from finch.primitive_types import Color, Image, Point
 
 
@@ -5,3 +7,9 @@ def get_color_from_image( image : Image, position : Point ) -> Color:
     color_raw = image[ position.y, position.x ]
     color = ( int(color_raw[0]), int(color_raw[1]), int(color_raw[2]) )
     return color
+
+
+def get_colors_from_image( image : Image, xs : np.ndarray, ys : np.ndarray ) -> list[ Color ]:
+    colors_raw = image[ ys, xs ]
+    colors = [ tuple( color_raw ) for color_raw in colors_raw.tolist() ]
+    return colors
@@ -0,0 +1,93 @@
+from dataclasses import dataclass, field
+from enum import Enum, auto
+import random
+from typing import Optional
+
+import numpy as np
+
+from finch.brush_bank import BrushBank, BrushSet, get_brush_bank
+from finch.budget import ConvergenceController, RunBudget
+
+
+FIXED_RANDOM_SEED = 1337
+
+
+class Config(Enum):
+    DEBUG = auto()
+    PROD = auto()
+
+
+@dataclass( frozen = True )
+class RunSettings:
+    """
+    What a painting produces, apart from the 4K result.
+    """
+    write_output : bool = False
+    write_strokes : bool = False
+    make_gif : bool = False
+    log_scores : bool = True
+    use_result_cache : bool = False
+
+    @classmethod
+    def from_config( cls, config : Config ) -> "RunSettings":
+        if config == Config.DEBUG:
+            # Cached results would skip writing the intermediate results
+            return cls( write_output = True, write_strokes = False, make_gif = True, log_scores = True, use_result_cache = False )
+        return cls( write_output = False, write_strokes = False, make_gif = True, log_scores = False, use_result_cache = True )
+
+
+@dataclass( frozen = True )
+class EvolutionTunables:
+    n_iterations_patience : int = 100
+    # Evaluating multiple candidate brushes per generation amortizes the Python overhead per brush.
+    # With a single candidate, the population size is effectively 2, see the README.
+    n_candidates_per_generation : int = 1
+    # If disabled, only the best candidate of a generation is accepted,
+    # otherwise all improving candidates are accepted, as long as they do not overlap.
+    accept_all_non_overlapping_candidates : bool = False
+    # In rounded scores, see finch.evolution.get_rounded_score
+    score_interval : int = 500
+    termination_score : int = 3500
+    # Brushes on the strongest edge of the image are made smaller by this fraction, see finch.brush.get_brush_size_for_detail.
+    # Disabled by default, so that all brushes of a generation have the size given by the fitness.
+    edge_size_reduction : float = 0.0
+    # Stores the gradient angles as float16 and its magnitudes as uint8, see finch.image_gradient.ImageGradient
+    compact_gradient : bool = False
+
+
+@dataclass( eq = False )
+class EngineContext:
+    """
+    Everything a single painting uses, apart from its images:
+    the settings, the brush bank, the random number generators and the tunables of the evolution.
+    Nothing in it is shared with other paintings, apart from the read only brush bank,
+    so a single process can paint many images concurrently, each with its own context.
+    The random number generators are seeded with the seed of the context, which makes paintings reproducible.
+    If the painting has a budget, its controller is shared by all copies of the context, see finch.budget.
+    """
+    brush_bank : BrushBank
+    settings : RunSettings = field( default_factory = RunSettings )
+    tunables : EvolutionTunables = field( default_factory = EvolutionTunables )
+    seed : int = FIXED_RANDOM_SEED
+    controller : Optional[ ConvergenceController ] = None
+    # Used for the brush textures
+    rng : random.Random = field( init = False, repr = False )
+    # Used for the brush positions
+    np_rng : np.random.RandomState = field( init = False, repr = False )
+
+    def __post_init__( self ) -> None:
+        # The same generators as the global ones of random and numpy, so seeded results stay the same
+        self.rng = random.Random( self.seed )
+        self.np_rng = np.random.RandomState( self.seed )
+
+    @classmethod
+    def create(
+            cls,
+            brush_set : BrushSet,
+            settings : RunSettings = RunSettings(),
+            tunables : EvolutionTunables = EvolutionTunables(),
+            seed : int = FIXED_RANDOM_SEED,
+            budget : Optional[ RunBudget ] = None,
+    ) -> "EngineContext":
+        controller = ConvergenceController( budget ) if budget is not None else None
+        return cls( brush_bank = get_brush_bank( brush_set ), settings = settings, tunables = tunables, seed = seed, controller = controller )
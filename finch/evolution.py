@@ -0,0 +1,320 @@
+import logging
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterator, Optional
+
+from finch.brush import Brush, get_brush_size_for_detail, get_brush_size_for_fitness
+from finch.checkpoint import Checkpointer, EvolutionState
+from finch.color_from_image import get_color_from_image, get_colors_from_image
+from finch.context import EngineContext
+from finch.fitness import FitnessUpdate, IncrementalFitness
+from finch.image_gradient import ImageGradient
+from finch.instrumentation import count, timer
+from finch.primitive_types import Image, FitnessScore, Point
+from finch.sample_weighted_position_from_image import WeightedPositionSampler
+from finch.specimen import Mutation, Specimen
+
+
+DECIMALS = 3
+SCORE_MULTIPLIER = 10 ** DECIMALS
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class EvolutionProgress:
+    generation_index : int
+    rounded_score : int
+    report_string : str
+    # The last progress of an evolution is always reported, even if it did not meet the score interval
+    is_final : bool
+
+
+def mutate_specimen_inplace(
+        specimen : Specimen,
+        fitness : FitnessScore,
+        target_image : Image,
+        target_gradient : ImageGradient,
+        position_sampler : WeightedPositionSampler,
+        context : EngineContext,
+        brush_size_image_shape : Optional[ tuple[ int, int ] ] = None,
+) -> Mutation:
+    position = position_sampler.sample()
+    color = get_color_from_image( image = target_image, position = position )
+    texture_index = context.brush_bank.random_texture_index( context.rng )
+    angle = target_gradient.get_direction( position )
+    if brush_size_image_shape is None:
+        brush_size_image_shape = target_image.shape[:2]
+    brush_size = get_brush_size_for_fitness(
+        fitness = fitness,
+        image_height = brush_size_image_shape[0],
+        image_width = brush_size_image_shape[1]
+    )
+    edge_size_reduction = context.tunables.edge_size_reduction
+    if edge_size_reduction > 0:
+        brush_size = get_brush_size_for_detail( brush_size, target_gradient.get_magnitude( position ), edge_size_reduction )
+    new_brush = Brush(
+        color = color,
+        position = position,
+        texture_index = texture_index,
+        angle = angle,
+        size = brush_size,
+    )
+    mutation = specimen.draw_brush( new_brush )
+    return mutation
+
+
+def propose_brushes(
+        n_brushes : int,
+        fitness : FitnessScore,
+        target_image : Image,
+        target_gradient : ImageGradient,
+        position_sampler : WeightedPositionSampler,
+        context : EngineContext,
+        brush_size_image_shape : Optional[ tuple[ int, int ] ] = None,
+) -> list[ Brush ]:
+    xs, ys = position_sampler.sample_many( n_brushes )
+    colors = get_colors_from_image( image = target_image, xs = xs, ys = ys )
+    texture_indices = context.brush_bank.random_texture_indices( context.rng, n_brushes )
+    angles = target_gradient.get_directions( xs, ys )
+    if brush_size_image_shape is None:
+        brush_size_image_shape = target_image.shape[:2]
+    brush_size = get_brush_size_for_fitness(
+        fitness = fitness,
+        image_height = brush_size_image_shape[0],
+        image_width = brush_size_image_shape[1]
+    )
+    edge_size_reduction = context.tunables.edge_size_reduction
+    if edge_size_reduction > 0:
+        magnitudes = target_gradient.get_magnitudes( xs, ys )
+        brush_sizes = [ get_brush_size_for_detail( brush_size, magnitude, edge_size_reduction ) for magnitude in magnitudes.tolist() ]
+    else:
+        brush_sizes = [ brush_size ] * n_brushes
+    brushes = [
+        Brush(
+            color = color,
+            position = Point( x, y ),
+            texture_index = texture_index,
+            angle = angle,
+            size = size,
+        )
+        for x, y, color, texture_index, angle, size
+        in zip( xs.tolist(), ys.tolist(), colors, texture_indices, angles.tolist(), brush_sizes )
+    ]
+    return brushes
+
+
+def get_rounded_score( fitness : FitnessScore ) -> int:
+    return round( fitness * 100 * SCORE_MULTIPLIER )
+
+
+def _select_candidates(
+        candidates : list[ tuple[ Brush, FitnessUpdate ] ],
+        rounded_score : int,
+        accept_all_non_overlapping_candidates : bool,
+) -> list[ tuple[ Brush, FitnessUpdate ] ]:
+    # Every fitness update was evaluated against the current specimen,
+    # so candidates can be compared by how much they change the difference with the target
+    improving_candidates = [
+        ( brush, update ) for brush, update in candidates
+        if get_rounded_score( update.fitness ) < rounded_score
+    ]
+    improving_candidates.sort( key = lambda candidate: candidate[ 1 ].diff_sum_delta )
+    if not accept_all_non_overlapping_candidates:
+        return improving_candidates[ :1 ]
+
+    selected_candidates = []
+    for brush, update in improving_candidates:
+        if not any( update.roi.intersects( selected_update.roi ) for _, selected_update in selected_candidates ):
+            selected_candidates.append( ( brush, update ) )
+    return selected_candidates
+
+
+def evolve_specimen_with_candidates_inplace(
+        specimen : Specimen,
+        incremental_fitness : IncrementalFitness,
+        rounded_score : int,
+        target_image : Image,
+        target_gradient : ImageGradient,
+        position_sampler : WeightedPositionSampler,
+        context : EngineContext,
+        brush_size_image_shape : Optional[ tuple[ int, int ] ] = None,
+) -> int:
+    """
+    Proposes a batch of brushes, scores each of them against the current specimen,
+    and draws the selected ones. Returns the number of accepted brushes.
+    Brushes are sized for an image of the given shape, or for the target image if none is given.
+    """
+    with timer( 'mutate' ):
+        brushes = propose_brushes(
+            n_brushes = context.tunables.n_candidates_per_generation,
+            fitness = incremental_fitness.fitness,
+            target_image = target_image,
+            target_gradient = target_gradient,
+            position_sampler = position_sampler,
+            context = context,
+            brush_size_image_shape = brush_size_image_shape,
+        )
+    candidates = []
+    for brush in brushes:
+        mutation = specimen.draw_brush( brush )
+        with timer( 'fitness' ):
+            fitness_update = incremental_fitness.evaluate_roi( specimen.cached_image, mutation.roi )
+        candidates.append( ( brush, fitness_update ) )
+        specimen.rollback( mutation )
+
+    selected_candidates = _select_candidates(
+        candidates, rounded_score, context.tunables.accept_all_non_overlapping_candidates
+    )
+    for brush, fitness_update in selected_candidates:
+        specimen.accept( specimen.draw_brush( brush ) )
+        incremental_fitness.apply( fitness_update )
+        position_sampler.update_roi( fitness_update.roi )
+    count( 'accepted_strokes', len( selected_candidates ) )
+    count( 'rejected_strokes', len( candidates ) - len( selected_candidates ) )
+    return len( selected_candidates )
+
+
+def evolve_specimen_inplace(
+        specimen : Specimen,
+        target_image : Image,
+        target_gradient : ImageGradient,
+        context : EngineContext,
+        sampling_mask : Optional[ Image ] = None,
+        n_iterations_patience : Optional[ int ] = None,
+        termination_score : Optional[ int ] = None,
+        state : Optional[ EvolutionState ] = None,
+        checkpointer : Optional[ Checkpointer ] = None,
+        brush_size_image_shape : Optional[ tuple[ int, int ] ] = None,
+) -> Iterator[ EvolutionProgress ]:
+    """
+    Runs the visual genetic algorithm on the specimen, until it runs out of patience,
+    reaches the termination score, or the controller of the context stops it.
+    Progress is yielded whenever the score improved by at least SCORE_INTERVAL since the last report,
+    and once more when the evolution ends.
+    New brushes are only placed where the sampling mask is nonzero, if one is given.
+    Brushes are sized for an image of the given shape, like the full painting when the target is a tile of it,
+    or for the target image if none is given.
+    The tunables of the context are used, unless the patience or termination score are given.
+    The state of the loop is kept in the given state, if any, so that a resumed evolution can continue from it,
+    and a checkpoint is written at the end of a generation whenever the checkpointer is due, see finch.checkpoint.
+    """
+    tunables = context.tunables
+    if n_iterations_patience is None:
+        n_iterations_patience = tunables.n_iterations_patience
+    if termination_score is None:
+        termination_score = tunables.termination_score
+
+    if state is None:
+        state = EvolutionState( last_written_score = 100 * SCORE_MULTIPLIER )
+    last_update_time = datetime.now()
+
+    # Only the ROI of each new brush is re-evaluated, instead of the full image
+    incremental_fitness = IncrementalFitness( specimen_image = specimen.cached_image, target_image = target_image )
+    fitness = incremental_fitness.fitness
+    # New brushes are most likely placed where the difference with the target is largest
+    position_sampler = WeightedPositionSampler(
+        weight_image = incremental_fitness.diff_image,
+        mask = sampling_mask,
+        rng = context.np_rng,
+    )
+    rounded_score = get_rounded_score( fitness )
+    controller = context.controller
+
+    while True:
+        state.generation_index += 1
+
+        if tunables.n_candidates_per_generation > 1:
+            n_accepted_brushes = evolve_specimen_with_candidates_inplace(
+                specimen = specimen,
+                incremental_fitness = incremental_fitness,
+                rounded_score = rounded_score,
+                target_image = target_image,
+                target_gradient = target_gradient,
+                position_sampler = position_sampler,
+                context = context,
+                brush_size_image_shape = brush_size_image_shape,
+            )
+            if n_accepted_brushes == 0:
+                state.n_iterations_with_same_score += 1
+            else:
+                state.n_iterations_with_same_score = 0
+                fitness = incremental_fitness.fitness
+                rounded_score = get_rounded_score( fitness )
+        else:
+            # Mutate the specimen in place,
+            # the mutation remembers what it overwrote so that it can be rolled back
+            with timer( 'mutate' ):
+                mutation = mutate_specimen_inplace(
+                    specimen = specimen,
+                    fitness = fitness,
+                    target_image = target_image,
+                    target_gradient = target_gradient,
+                    position_sampler = position_sampler,
+                    context = context,
+                    brush_size_image_shape = brush_size_image_shape,
+                )
+            with timer( 'fitness' ):
+                fitness_update = incremental_fitness.evaluate_roi( specimen.cached_image, mutation.roi )
+            new_fitness = fitness_update.fitness
+            new_rounded_score = get_rounded_score( new_fitness )
+
+            # Only keep the new version if it is an improvement
+            if new_rounded_score >= rounded_score:
+                n_accepted_brushes = 0
+                state.n_iterations_with_same_score += 1
+                specimen.rollback( mutation )
+                count( 'rejected_strokes' )
+            else:
+                n_accepted_brushes = 1
+                state.n_iterations_with_same_score = 0
+                fitness = new_fitness
+                rounded_score = new_rounded_score
+                specimen.accept( mutation )
+                incremental_fitness.apply( fitness_update )
+                position_sampler.update_roi( mutation.roi )
+                count( 'accepted_strokes' )
+
+        current_update_time = datetime.now()
+        # timedelta.microseconds is only the sub-second part, so convert the whole duration
+        update_time_ms = ( current_update_time - last_update_time ).total_seconds() * 1000
+        last_update_time = current_update_time
+
+        report_string = f'gen_{state.generation_index:06d}__dt_{update_time_ms:.3f}_ms__score_{rounded_score}'
+
+        if context.settings.log_scores:
+            logger.info( report_string )
+
+        # We only report progress if it shows enough improvement compared to the last reported one
+        if state.last_written_score - rounded_score >= tunables.score_interval :
+            state.last_written_score = rounded_score
+            yield EvolutionProgress( state.generation_index, rounded_score, report_string, is_final = False )
+
+        stop_reason = None
+        if controller is not None:
+            controller.update( n_accepted_brushes, rounded_score )
+            stop_reason = controller.get_stop_reason()
+            generation_patience = controller.get_patience( n_iterations_patience )
+        else:
+            generation_patience = n_iterations_patience
+
+        # If ran out of patience, report the final result, and stop
+        ran_out_of_patience = state.n_iterations_with_same_score >= generation_patience
+        reached_termination_score = rounded_score <= termination_score
+        if ( ran_out_of_patience or reached_termination_score or stop_reason is not None ):
+            if ran_out_of_patience:
+                logger.info( 'Ran out of patience.' )
+            elif reached_termination_score:
+                logger.info( 'Reached termination score.' )
+            else:
+                logger.info( stop_reason )
+            count( 'generations', state.generation_index )
+            yield EvolutionProgress( state.generation_index, rounded_score, report_string, is_final = True )
+            return
+
+        if checkpointer is not None:
+            with timer( 'checkpoint' ):
+                checkpointer.write_if_due( specimen, state, rounded_score, context )
+
@@ -1,103 +1,159 @@
-import io
 import logging
+from typing import Optional
 
 import cv2
-import imageio
+import numpy as np
+from PIL import GifImagePlugin, Image as PilImage
 
 from finch.memory_size import get_size_mib
 from finch.primitive_types import Image
 
 
+FPS = 5
+FRAME_DURATION_MS = 1000 // FPS
+FINAL_FRAME_HOLD_SECONDS = 3
+N_FRAMES_TARGET = 50
+
+# The last palette entry is reserved to mark pixels that did not change since the previous frame
+N_PALETTE_COLORS = 256
+TRANSPARENT_INDEX = N_PALETTE_COLORS - 1
+BLANK_COLOR = ( 255, 255, 255 )
+
+# Do not dispose frames, so that every frame only has to contain what changed since the previous one
+DISPOSAL_DO_NOT_DISPOSE = 1
+
+
 logger = logging.getLogger(__name__)
 
 
-def make_gif(result_frames : list[Image]) -> bytes:
-    logger.info( f'Creating GIF.' )
-
-    FPS = 5
-    FINAL_FRAME_REPEAT_SECONDS = 3
-    FINAL_FRAME_REPEAT_FRAMES = FPS * FINAL_FRAME_REPEAT_SECONDS
-
-    n_frames_original = len(result_frames)
-    n_frames_target = 50
-    needs_skips = n_frames_original > n_frames_target
-
-    logger.info( f'Got {n_frames_original} input frames.' )
-    logger.info( f'Target is {n_frames_target} output frames.' )
-
-    if needs_skips:
-        n_frames_to_delete = n_frames_original - n_frames_target
-        # add 1 because we do not want to delete the last frame
-        frame_interval_to_delete = n_frames_original // n_frames_to_delete
-        logger.info( f'Skipping every {frame_interval_to_delete} frames from the back.' )
-    else:
-        logger.info( f'No skips needed!' )
-
-    n_frames_result = 0
-    gif_buffer = io.BytesIO()
-    with imageio.get_writer( gif_buffer, format = '.gif', mode = 'I', loop=0, fps = FPS ) as writer :
-        for i, image in enumerate( result_frames ):
-            # We skip certain frames to limit the number of output frames
-            # We count the distance from the end of the list,
-            # So that we don't remove frames too close to the end of the list
-            if needs_skips:
-                if i > 0 and ( n_frames_original - i ) % frame_interval_to_delete == 0:
-                    logger.info(f'- Skipping frame {i}.')
-                    continue
-            n_frames_result += 1
-            image_rgb = cv2.cvtColor( image, cv2.COLOR_BGR2RGB )
-            writer.append_data( image_rgb )
-        for i in range( FINAL_FRAME_REPEAT_FRAMES ):
-            writer.append_data( image_rgb )
-
-    logger.info(f'Result has {n_frames_result} + {FINAL_FRAME_REPEAT_FRAMES} frames.')
-
-    original_gif = gif_buffer.getvalue()
-    original_size_mib = get_size_mib(original_gif)
-    logger.info(f'GIF is {original_size_mib} MiB.')
-
-    # optimized_gif = gifsicle_optimize_in_memory(original_gif)
-    # size_bytes_optimized = get_size_mib(optimized_gif)
-    #
-    # logger.info(f'Optimizing the GIF brought it from {original_size_mib} MiB to {size_bytes_optimized} MiB')
-
-    return original_gif
-
-
-# ================================================================
-# We are currently not using gifsicle,
-# because we cannot easily install it inside a GCF
-#
-# def gifsicle_optimize_in_memory(
-#         gif_data: bytes,
-#         colors: int = 256,
-#         options: list[str] | None = None
-# ) -> bytes:
-#     if options is None:
-#         options = []
-#
-#     if "--optimize" not in options:
-#         options.append("--optimize")
-#
-#     TESTING_ON_WINDOWS = False
-#     if TESTING_ON_WINDOWS:
-#         exe = "C:/Users/Berry/Downloads/gifsicle-1.95-win64/gifsicle"
-#     else:
-#         exe = "gifsicle"
-#
-#     command = [ exe, *options, "--colors", str( colors ) ]
-#     try:
-#         proc = subprocess.Popen(
-#             command,
-#             stdin=subprocess.PIPE,
-#             stdout=subprocess.PIPE,
-#             stderr=subprocess.PIPE
-#         )
-#         result_gif_data, stderr_data = proc.communicate(input=gif_data)
-#         if stderr_data:
-#             raise Exception(stderr_data.decode())
-#
-#     except FileNotFoundError:
-#         raise FileNotFoundError("The gifsicle library was not found on your system.")
-#
-#     return result_gif_data
\ No newline at end of file
+def _make_palette_image( image : Image ) -> PilImage.Image:
+    """
+    Returns a paletted image, with a palette for all frames of the GIF.
+    The painting converges to the target image, so the colors of the target are a good fit for all frames.
+    The color of the blank canvas is always included.
+    """
+    image_rgb = cv2.cvtColor( image, cv2.COLOR_BGR2RGB )
+    n_image_colors = TRANSPARENT_INDEX - 1
+    quantized_image = PilImage.fromarray( image_rgb ).quantize(
+        colors = n_image_colors,
+        method = PilImage.Quantize.MEDIANCUT,
+        dither = PilImage.Dither.NONE,
+    )
+    image_palette = quantized_image.getpalette()[ :n_image_colors * 3 ]
+    image_palette += [ 0 ] * ( n_image_colors * 3 - len( image_palette ) )
+    # The transparent index gets a copy of the blank color, see _quantize
+    palette = image_palette + list( BLANK_COLOR ) + list( BLANK_COLOR )
+
+    palette_image = PilImage.new( 'P', ( 1, 1 ) )
+    palette_image.putpalette( palette )
+    return palette_image
+
+
+class StreamingGifWriter:
+    """
+    Encodes frames into a GIF while they are produced, instead of collecting all frames first.
+    All frames share a single global palette, based on the target image.
+    Every frame only contains the bounding box of the pixels that changed since the previous frame,
+    and unchanged pixels within that box are transparent, which keeps the GIF small.
+    Frames are decimated on the fly, based on their score:
+    a frame is only kept once the score improved enough since the last kept frame,
+    so that at most n_frames_target frames are kept between the first and the last score.
+    """
+
+    def __init__(
+            self,
+            palette_image : Image,
+            first_score : int,
+            last_score : int,
+            n_frames_target : int = N_FRAMES_TARGET,
+    ) :
+        self._palette_image = _make_palette_image( palette_image )
+        self._score_step = max( 1.0, ( first_score - last_score ) / max( 1, n_frames_target - 1 ) )
+        self._next_score : Optional[ float ] = None
+        self._chunks : list[ bytes ] = []
+        self._previous_indices : Optional[ np.ndarray ] = None
+        # The last frame is only written once the next one arrives, so that its duration can still be extended
+        self._pending_frame : Optional[ tuple[ PilImage.Image, tuple[ int, int ], dict ] ] = None
+        self.n_frames = 0
+        self.n_skipped_frames = 0
+
+
+    def add_frame( self, image : Image, score : int ) -> None:
+        if self._next_score is not None and score > self._next_score:
+            self.n_skipped_frames += 1
+            return
+        self._next_score = score - self._score_step
+        self._add_frame( image )
+
+
+    def finish( self, image : Image ) -> bytes:
+        """
+        Adds the final frame, which is always kept, and shown for longer than the other frames.
+        """
+        self._add_frame( image )
+        _, _, params = self._pending_frame
+        params[ 'duration' ] += FINAL_FRAME_HOLD_SECONDS * 1000
+        self._write_pending_frame()
+        self._chunks.append( b';' )
+
+        gif = b''.join( self._chunks )
+        logger.info( f'GIF has {self.n_frames} frames, {self.n_skipped_frames} frames were skipped.' )
+        logger.info( f'GIF is {get_size_mib( gif )} MiB.' )
+        return gif
+
+
+    def _quantize( self, image : Image ) -> PilImage.Image:
+        image_rgb = cv2.cvtColor( image, cv2.COLOR_BGR2RGB )
+        quantized_image = PilImage.fromarray( image_rgb ).quantize(
+            palette = self._palette_image,
+            dither = PilImage.Dither.NONE,
+        )
+        return quantized_image
+
+
+    def _add_frame( self, image : Image ) -> None:
+        quantized_image = self._quantize( image )
+        indices = np.asarray( quantized_image ).copy()
+        # The transparent index has the same color as the one before it, so this does not change the frame
+        indices[ indices == TRANSPARENT_INDEX ] = TRANSPARENT_INDEX - 1
+
+        if self._previous_indices is None:
+            header, _ = GifImagePlugin.getheader( quantized_image, info = { 'loop' : 0 } )
+            self._chunks.extend( header )
+            frame = PilImage.fromarray( indices, mode = 'P' )
+            offset = ( 0, 0 )
+            params = { 'duration' : FRAME_DURATION_MS, 'disposal' : DISPOSAL_DO_NOT_DISPOSE }
+        else:
+            changed = indices != self._previous_indices
+            changed_rows = np.flatnonzero( np.any( changed, axis = 1 ) )
+            if len( changed_rows ) == 0:
+                # Nothing changed, so simply show the previous frame for longer
+                _, _, params = self._pending_frame
+                params[ 'duration' ] += FRAME_DURATION_MS
+                return
+            changed_columns = np.flatnonzero( np.any( changed, axis = 0 ) )
+            y_min, y_max = int( changed_rows[ 0 ] ), int( changed_rows[ -1 ] ) + 1
+            x_min, x_max = int( changed_columns[ 0 ] ), int( changed_columns[ -1 ] ) + 1
+
+            frame_indices = indices[ y_min:y_max, x_min:x_max ].copy()
+            frame_indices[ ~changed[ y_min:y_max, x_min:x_max ] ] = TRANSPARENT_INDEX
+            frame = PilImage.fromarray( frame_indices, mode = 'P' )
+            offset = ( x_min, y_min )
+            params = {
+                'duration' : FRAME_DURATION_MS,
+                'disposal' : DISPOSAL_DO_NOT_DISPOSE,
+                'transparency' : TRANSPARENT_INDEX,
+            }
+
+        self._write_pending_frame()
+        self._pending_frame = ( frame, offset, params )
+        self._previous_indices = indices
+
+
+    def _write_pending_frame( self ) -> None:
+        if self._pending_frame is None:
+            return
+        frame, offset, params = self._pending_frame
+        self._chunks.extend( GifImagePlugin.getdata( frame, offset = offset, **params ) )
+        self._pending_frame = None
+        self.n_frames += 1
@@ -1,37 +1,178 @@
+from collections import OrderedDict
+import hashlib
+import threading
+from typing import Optional
+
 import cv2
-import math
+import numpy as np
+
+from finch.primitive_types import Image, Point, Roi
+
+
+# Gradients are cached by the contents of their image,
+# so repeated requests for the same image, and the levels of repeated pyramids, do not recompute them
+IMAGE_GRADIENT_CACHE_MAX_SIZE_BYTES : int = 64 * 1024 * 1024
+
+# In compact mode, angles are stored with a precision of at least 0.25 degrees,
+# which is finer than the angle quantization of the brush stamps, and magnitudes with 256 levels
+COMPACT_ANGLE_DTYPE = np.float16
+COMPACT_MAGNITUDE_DTYPE = np.uint8
+COMPACT_MAGNITUDE_SCALE = 255
+
+
+def _get_derivatives( image : Image, blur_kernel_size : Optional[ int ], blur_magnitude : float ) -> tuple[ np.ndarray, np.ndarray ]:
+    if blur_kernel_size is None :
+        blur_kernel_size = int( min( image.shape[ :2 ] ) / 50 )
+    if blur_kernel_size % 2 == 0 :
+        blur_kernel_size += 1
+
+    gray = cv2.cvtColor( image, cv2.COLOR_BGR2GRAY )
+
+    dx = cv2.Scharr( gray, cv2.CV_32F, 1, 0 )
+    dy = cv2.Scharr( gray, cv2.CV_32F, 0, 1 )
 
-from finch.primitive_types import Image, Point
+    blur_kernel_size_2d = (blur_kernel_size, blur_kernel_size)
+    dx = cv2.GaussianBlur( dx, blur_kernel_size_2d, blur_magnitude )
+    dy = cv2.GaussianBlur( dy, blur_kernel_size_2d, blur_magnitude )
+    return dx, dy
 
 
 class ImageGradient:
+    """
+    The direction and strength of the edges of an image, precomputed for every pixel.
+    Angles are the direction of the gradient in degrees.
+    Magnitudes are normalized to [0, 1], relative to the strongest gradient of the image.
+    In compact mode, angles are stored as float16 and magnitudes as uint8, which saves memory for large images.
+    Lookups return angles in degrees and normalized magnitudes, whatever the storage.
+    """
 
-    def __init__( self, image : Image, blur_kernel_size = None, blur_magnitude = 0 ) :
+    def __init__( self, image : Image, blur_kernel_size = None, blur_magnitude = 0, compact : bool = False ) :
+        dx, dy = _get_derivatives( image, blur_kernel_size, blur_magnitude )
+        angles = np.degrees( np.arctan2( dy, dx ) )
+        magnitudes = cv2.magnitude( dx, dy )
+        max_magnitude = float( magnitudes.max() ) if magnitudes.size > 0 else 0.0
+        if max_magnitude > 0:
+            magnitudes /= max_magnitude
 
-        if blur_kernel_size is None :
-            blur_kernel_size = int( min( image.shape[ :2 ] ) / 50 )
-        if blur_kernel_size % 2 == 0 :
-            blur_kernel_size += 1
+        if compact:
+            angles = angles.astype( COMPACT_ANGLE_DTYPE )
+            magnitudes = np.round( magnitudes * COMPACT_MAGNITUDE_SCALE ).astype( COMPACT_MAGNITUDE_DTYPE )
+        self._angles = angles
+        self._magnitudes = magnitudes
 
-        gray = cv2.cvtColor( image, cv2.COLOR_BGR2GRAY )
 
-        dx = cv2.Scharr( gray, cv2.CV_32F, 1, 0 )
-        dy = cv2.Scharr( gray, cv2.CV_32F, 0, 1 )
+    @classmethod
+    def from_fields( cls, angles : np.ndarray, magnitudes : np.ndarray ) -> "ImageGradient":
+        """
+        Wraps fields that were computed before, for example in another process.
+        """
+        gradient = cls.__new__( cls )
+        gradient._angles = angles
+        gradient._magnitudes = magnitudes
+        return gradient
 
-        blur_kernel_size_2d = (blur_kernel_size, blur_kernel_size)
-        self._dx = cv2.GaussianBlur( dx, blur_kernel_size_2d, blur_magnitude )
-        self._dy = cv2.GaussianBlur( dy, blur_kernel_size_2d, blur_magnitude )
+
+    @property
+    def fields( self ) -> tuple[ np.ndarray, np.ndarray ]:
+        return self._angles, self._magnitudes
+
+
+    @property
+    def nbytes( self ) -> int:
+        return self._angles.nbytes + self._magnitudes.nbytes
+
+
+    def crop( self, roi : Roi ) -> "ImageGradient":
+        roi_slices = roi.slices()
+        return ImageGradient.from_fields( self._angles[ roi_slices ], self._magnitudes[ roi_slices ] )
+
+
+    def _normalize_magnitudes( self, magnitudes : np.ndarray ) -> np.ndarray:
+        if self._magnitudes.dtype == COMPACT_MAGNITUDE_DTYPE:
+            return magnitudes / COMPACT_MAGNITUDE_SCALE
+        return magnitudes
 
 
     def get_direction( self, position : Point ) -> float:
-        dy = self._dy[position.y,position.x]
-        dx = self._dx[position.y,position.x]
-        direction = math.degrees( math.atan2( dy, dx ) )
-        return direction
+        return float( self._angles[ position.y, position.x ] )
+
+
+    def get_directions( self, xs : np.ndarray, ys : np.ndarray ) -> np.ndarray:
+        return self._angles[ ys, xs ].astype( np.float64 )
 
 
     def get_magnitude( self, position : Point ) -> float:
-        dy = self._dy[position.y,position.x]
-        dx = self._dx[position.y,position.x]
-        magnitude = math.hypot( dy, dx )
-        return magnitude
+        return float( self._normalize_magnitudes( self._magnitudes[ position.y, position.x ] ) )
+
+
+    def get_magnitudes( self, xs : np.ndarray, ys : np.ndarray ) -> np.ndarray:
+        return self._normalize_magnitudes( self._magnitudes[ ys, xs ].astype( np.float64 ) )
+
+
+class ImageGradientCache:
+    """
+    A bounded LRU cache of gradients, keyed by a hash of the contents of their image.
+    Cached fields are read only, so a gradient can be shared by concurrent paintings.
+    """
+
+    def __init__( self, max_size_bytes : int ) :
+        self.max_size_bytes = max_size_bytes
+        self._gradients : OrderedDict[ str, ImageGradient ] = OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+
+    @staticmethod
+    def get_key( image : Image, compact : bool ) -> str:
+        image = np.ascontiguousarray( image )
+        hasher = hashlib.sha256()
+        hasher.update( repr( ( image.shape, image.dtype.str, compact ) ).encode() )
+        hasher.update( memoryview( image ).cast( 'B' ) )
+        return hasher.hexdigest()
+
+
+    def get( self, image : Image, compact : bool = False ) -> ImageGradient:
+        key = self.get_key( image, compact )
+        with self._lock:
+            gradient = self._gradients.get( key )
+            if gradient is not None:
+                self._gradients.move_to_end( key )
+                self.n_hits += 1
+                return gradient
+            self.n_misses += 1
+
+        # Computed outside of the lock, a concurrent miss for the same image simply computes it twice
+        gradient = ImageGradient( image = image, compact = compact )
+        for field in gradient.fields:
+            field.setflags( write = False )
+        if gradient.nbytes > self.max_size_bytes:
+            return gradient
+
+        with self._lock:
+            if key not in self._gradients:
+                self._gradients[ key ] = gradient
+                self._size_bytes += gradient.nbytes
+            while self._size_bytes > self.max_size_bytes:
+                _, evicted_gradient = self._gradients.popitem( last = False )
+                self._size_bytes -= evicted_gradient.nbytes
+        return gradient
+
+
+    def clear( self ) -> None:
+        with self._lock:
+            self._gradients.clear()
+            self._size_bytes = 0
+            self.n_hits = 0
+            self.n_misses = 0
+
+
+IMAGE_GRADIENT_CACHE = ImageGradientCache( max_size_bytes = IMAGE_GRADIENT_CACHE_MAX_SIZE_BYTES )
+
+
+def get_image_gradient( image : Image, compact : bool = False ) -> ImageGradient:
+    """
+    Returns the gradient of the image, from the cache if the same image was seen before.
+    """
+    return IMAGE_GRADIENT_CACHE.get( image, compact = compact )
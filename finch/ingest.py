@@ -0,0 +1,129 @@
+import logging
+
+import io
+from typing import BinaryIO, Optional
+
+import cv2
+import numpy as np
+from PIL import Image as PILImage, UnidentifiedImageError
+
+from finch.instrumentation import count, timer
+from finch.primitive_types import Image
+from finch.scale import MAX_IMAGE_DIMENSION, normalize_image_size
+
+
+# Uploads are read in chunks, and rejected as soon as they exceed the limit, instead of after reading all of them
+MAX_UPLOAD_SIZE_BYTES : int = 32 * 1024 * 1024
+UPLOAD_CHUNK_SIZE_BYTES : int = 1024 * 1024
+# Checked against the dimensions in the header, before anything is decoded
+MAX_IMAGE_PIXELS : int = 100 * 1000 * 1000
+# The dimensions are read from this prefix of the upload, which also covers large EXIF segments of JPEGs
+HEADER_SIZE_BYTES : int = 512 * 1024
+
+# Reducing while decoding is only native for JPEGs, which decode at a fraction of the resolution directly.
+# Other formats are decoded completely, and reduced afterwards.
+REDUCED_DECODE_FLAGS : dict[ int, int ] = {
+    8 : cv2.IMREAD_REDUCED_COLOR_8,
+    4 : cv2.IMREAD_REDUCED_COLOR_4,
+    2 : cv2.IMREAD_REDUCED_COLOR_2,
+}
+
+
+logger = logging.getLogger(__name__)
+
+
+class UploadTooLargeError( Exception ):
+    pass
+
+
+class ImageTooLargeError( Exception ):
+    pass
+
+
+class ImageDecodeError( Exception ):
+    pass
+
+
+def read_upload( stream : BinaryIO, max_size_bytes : int = MAX_UPLOAD_SIZE_BYTES ) -> np.ndarray:
+    """
+    Reads the upload into a single buffer, chunk by chunk, and raises an UploadTooLargeError as soon as it exceeds the limit.
+    The buffer is returned as an array without copying it.
+    """
+    buffer = bytearray()
+    while True:
+        chunk = stream.read( UPLOAD_CHUNK_SIZE_BYTES )
+        if not chunk:
+            break
+        if len( buffer ) + len( chunk ) > max_size_bytes:
+            raise UploadTooLargeError( f'Upload is larger than {max_size_bytes} bytes.' )
+        buffer += chunk
+    count( 'upload_bytes', len( buffer ) )
+    return np.frombuffer( buffer, np.uint8 )
+
+
+def get_image_dimensions( data : np.ndarray ) -> Optional[ tuple[ int, int ] ]:
+    """
+    Returns the ( width, height ) in the header of the encoded image, without decoding it,
+    or None if the header is not recognized.
+    Raises an ImageTooLargeError if Pillow refuses to open it as a decompression bomb,
+    which is only the case for images with far more than MAX_IMAGE_PIXELS.
+    """
+    try:
+        with PILImage.open( io.BytesIO( data[ :HEADER_SIZE_BYTES ].tobytes() ) ) as header_image:
+            return header_image.size
+    except PILImage.DecompressionBombError as error:
+        raise ImageTooLargeError( str( error ) ) from error
+    except ( UnidentifiedImageError, OSError, SyntaxError ):
+        return None
+
+
+def get_reduction_factor( width : int, height : int, max_dimension : int = MAX_IMAGE_DIMENSION ) -> int:
+    # The largest factor that still decodes at least at the normalized size, so the exact resize only ever shrinks.
+    # The larger of both dimensions does not depend on the EXIF orientation, which is applied while decoding.
+    largest_dimension = max( width, height )
+    for factor in REDUCED_DECODE_FLAGS:
+        if largest_dimension // factor >= max_dimension:
+            return factor
+    return 1
+
+
+def decode_upload(
+        data : np.ndarray,
+        max_image_pixels : int = MAX_IMAGE_PIXELS,
+        max_dimension : int = MAX_IMAGE_DIMENSION,
+) -> Image:
+    """
+    Decodes the encoded image at the normalized size.
+    Large images are decoded at a reduced resolution, based on the dimensions in their header,
+    so that the full resolution image never has to be in memory.
+    Raises an ImageTooLargeError before decoding if the image has too many pixels,
+    and an ImageDecodeError if it cannot be decoded.
+    """
+    dimensions = get_image_dimensions( data )
+    reduction_factor = 1
+    if dimensions is not None:
+        width, height = dimensions
+        if width * height > max_image_pixels:
+            raise ImageTooLargeError( f'Image of ({width}*{height}) has more than {max_image_pixels} pixels.' )
+        reduction_factor = get_reduction_factor( width, height, max_dimension )
+        logger.info( f'Decoding image of ({width}*{height}) at 1/{reduction_factor} of its resolution.' )
+
+    decode_flags = REDUCED_DECODE_FLAGS.get( reduction_factor, cv2.IMREAD_COLOR )
+    with timer( 'decode_image' ):
+        image = cv2.imdecode( data, decode_flags )
+    if image is None:
+        raise ImageDecodeError( 'Could not decode image.' )
+    # Without a recognized header, the pixels can only be checked once the image is decoded
+    if dimensions is None and image.shape[ 0 ] * image.shape[ 1 ] > max_image_pixels:
+        raise ImageTooLargeError( f'Image of ({image.shape[ 1 ]}*{image.shape[ 0 ]}) has more than {max_image_pixels} pixels.' )
+    count( 'decoded_image_bytes', image.nbytes )
+
+    return normalize_image_size( image, max_dimension )
+
+
+def ingest_upload( stream : BinaryIO, max_size_bytes : int = MAX_UPLOAD_SIZE_BYTES ) -> Image:
+    """
+    Reads and decodes an uploaded image, while keeping at most the encoded upload and a reduced decoded image in memory.
+    """
+    data = read_upload( stream, max_size_bytes )
+    return decode_upload( data )
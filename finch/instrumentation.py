@@ -0,0 +1,186 @@
+import logging
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import cProfile
+import json
+from pathlib import Path
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Iterator, Optional
+
+
+# If disabled, timers and counters do nothing, apart from looking up that there is nothing to record
+ENABLE_INSTRUMENTATION : bool = True
+# The fraction of instrumented requests that is also profiled with cProfile
+PROFILE_SAMPLE_RATE : float = 0.0
+# Profiles can be inspected with: python -m pstats <path>
+PROFILE_OUTPUT_DIRECTORY_PATH : Path = Path( tempfile.gettempdir() ) / 'finch_profiles'
+
+
+logger = logging.getLogger(__name__)
+
+# Separate from the global random state, which is seeded to make paintings reproducible
+_PROFILE_RANDOM = random.Random()
+
+
+class Instrumentation:
+    """
+    Collects the total duration and number of calls of named timers, and named counters.
+    Work that happens in other threads or processes is only recorded as a whole, by whoever waits for it.
+    """
+
+    def __init__( self ) :
+        self.timers : dict[ str, list ] = {}
+        self.counters : dict[ str, int | float ] = {}
+
+
+    def add_time( self, name : str, duration_s : float ) -> None:
+        timer = self.timers.get( name )
+        if timer is None:
+            self.timers[ name ] = [ duration_s, 1 ]
+        else:
+            timer[ 0 ] += duration_s
+            timer[ 1 ] += 1
+
+
+    def add_count( self, name : str, n : int = 1 ) -> None:
+        self.counters[ name ] = self.counters.get( name, 0 ) + n
+
+
+    def set_count( self, name : str, n : int | float ) -> None:
+        self.counters[ name ] = n
+
+
+    def get_fields( self ) -> dict[ str, float | int ]:
+        """
+        Returns a flat dictionary, to be used as the fields of a structured log entry.
+        """
+        fields = {}
+        for name, ( duration_s, n_calls ) in self.timers.items():
+            fields[ f'{name}_ms' ] = round( duration_s * 1000, 3 )
+            fields[ f'{name}_calls' ] = n_calls
+        fields.update( self.counters )
+        return fields
+
+
+    def get_server_timing( self ) -> str:
+        # See https://www.w3.org/TR/server-timing/
+        return ', '.join(
+            f'{name};dur={duration_s * 1000:.1f}'
+            for name, ( duration_s, _ ) in self.timers.items()
+        )
+
+
+class _Timer:
+
+    def __init__( self, instrumentation : Instrumentation, name : str ) :
+        self._instrumentation = instrumentation
+        self._name = name
+        self._start_time = 0.0
+
+
+    def __enter__( self ) -> "_Timer":
+        self._start_time = time.perf_counter()
+        return self
+
+
+    def __exit__( self, *exception_info ) -> None:
+        self._instrumentation.add_time( self._name, time.perf_counter() - self._start_time )
+
+
+class _NullTimer:
+
+    def __enter__( self ) -> "_NullTimer":
+        return self
+
+
+    def __exit__( self, *exception_info ) -> None:
+        pass
+
+
+def get_peak_rss_mib() -> float:
+    # The peak of the whole process so far, in KiB on Linux, but in bytes on macOS
+    peak_rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss /= 1024
+    return round( peak_rss / 1024, 1 )
+
+
+_NULL_TIMER = _NullTimer()
+_CURRENT_INSTRUMENTATION : ContextVar[ Optional[ Instrumentation ] ] = ContextVar( 'finch_instrumentation', default = None )
+
+
+def get_instrumentation() -> Optional[ Instrumentation ]:
+    return _CURRENT_INSTRUMENTATION.get()
+
+
+def timer( name : str ) -> _Timer | _NullTimer:
+    """
+    Returns a context manager that adds the time spent within it to the named timer of the current instrumentation.
+    """
+    instrumentation = _CURRENT_INSTRUMENTATION.get()
+    if instrumentation is None:
+        return _NULL_TIMER
+    return _Timer( instrumentation, name )
+
+
+def count( name : str, n : int = 1 ) -> None:
+    instrumentation = _CURRENT_INSTRUMENTATION.get()
+    if instrumentation is not None:
+        instrumentation.add_count( name, n )
+
+
+def set_count( name : str, n : int ) -> None:
+    instrumentation = _CURRENT_INSTRUMENTATION.get()
+    if instrumentation is not None:
+        instrumentation.set_count( name, n )
+
+
+def _write_profile( profile : cProfile.Profile, request_name : str ) -> None:
+    PROFILE_OUTPUT_DIRECTORY_PATH.mkdir( parents = True, exist_ok = True )
+    profile_path = PROFILE_OUTPUT_DIRECTORY_PATH / f'{request_name}_{time.strftime( "%Y%m%d_%H%M%S" )}_{id( profile ):x}.prof'
+    profile.dump_stats( profile_path )
+    logger.info( f'Wrote profile to {profile_path}' )
+
+
+@contextmanager
+def instrument( request_name : str ) -> Iterator[ Optional[ Instrumentation ] ]:
+    """
+    Records the timers and counters of everything that runs within it, in the same thread,
+    and logs them as structured fields at the end.
+    The peak memory of the process is recorded as well, together with how much the request raised it.
+    Concurrent requests share the process, so the increase is attributed to whichever request reached the new peak.
+    A sample of the instrumented requests is also profiled with cProfile.
+    Yields None if instrumentation is disabled.
+    """
+    if not ENABLE_INSTRUMENTATION:
+        yield None
+        return
+
+    instrumentation = Instrumentation()
+    previous_instrumentation = _CURRENT_INSTRUMENTATION.get()
+    _CURRENT_INSTRUMENTATION.set( instrumentation )
+    profile = None
+    if PROFILE_SAMPLE_RATE > 0 and _PROFILE_RANDOM.random() < PROFILE_SAMPLE_RATE:
+        profile = cProfile.Profile()
+        profile.enable()
+    start_peak_rss_mib = get_peak_rss_mib()
+    start_time = time.perf_counter()
+    try:
+        yield instrumentation
+    finally:
+        instrumentation.add_time( 'total', time.perf_counter() - start_time )
+        peak_rss_mib = get_peak_rss_mib()
+        instrumentation.set_count( 'peak_rss_mib', peak_rss_mib )
+        instrumentation.set_count( 'peak_rss_increase_mib', round( peak_rss_mib - start_peak_rss_mib, 1 ) )
+        if profile is not None:
+            profile.disable()
+            _write_profile( profile, request_name )
+        _CURRENT_INSTRUMENTATION.set( previous_instrumentation )
+        fields = instrumentation.get_fields()
+        # Cloud Logging picks up the json_fields, other handlers only show the message
+        logger.info( f'Instrumentation of {request_name}: {json.dumps( fields )}', extra = { 'json_fields' : fields } )
@@ -0,0 +1,324 @@
+import logging
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from enum import Enum, auto
+import multiprocessing
+import os
+import threading
+import time
+from typing import Optional, Protocol
+import uuid
+
+from finch.budget import RunBudget
+from finch.context import Config, RunSettings
+from finch.instrumentation import instrument
+from finch.output import OutputOptions
+from finch.primitive_types import Image
+from finch.run import FinchFrame, FinchResult, run_finch_streaming
+
+
+N_JOB_WORKERS : int = os.cpu_count() or 1
+# Jobs that are queued or running, new jobs are refused once this is reached
+MAX_ACTIVE_JOBS : int = 4 * N_JOB_WORKERS
+# Finished jobs, including their results, are forgotten after this time
+JOB_RESULT_TTL_SECONDS : float = 15 * 60
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobStatus( Enum ):
+    QUEUED = auto()
+    RUNNING = auto()
+    SUCCEEDED = auto()
+    FAILED = auto()
+    CANCELLED = auto()
+
+
+FINISHED_JOB_STATUSES = { JobStatus.SUCCEEDED, JobStatus.FAILED, JobStatus.CANCELLED }
+
+
+class JobCancelledError( Exception ):
+    pass
+
+
+class JobQueueFullError( Exception ):
+    pass
+
+
+class JobSchedulerUnavailableError( Exception ):
+    pass
+
+
+@dataclass
+class Job:
+    job_id : str
+    status : JobStatus
+    created_time : float
+    finished_time : Optional[ float ] = None
+    generation_index : int = 0
+    rounded_score : Optional[ int ] = None
+    result : Optional[ FinchResult ] = None
+    error : Optional[ str ] = None
+    future : Optional[ Future ] = field( default = None, repr = False )
+
+    @property
+    def is_finished( self ) -> bool:
+        return self.status in FINISHED_JOB_STATUSES
+
+
+class JobStore( Protocol ):
+
+    def add( self, job : Job ) -> None:
+        ...
+
+    def get( self, job_id : str ) -> Optional[ Job ]:
+        ...
+
+    def remove( self, job_id : str ) -> None:
+        ...
+
+    def list( self ) -> list[ Job ]:
+        ...
+
+
+class InMemoryJobStore:
+    """
+    Keeps jobs in the memory of the current process, so it does not need any external services.
+    Jobs are only visible to requests that are handled by the same process.
+    """
+
+    def __init__( self ) :
+        self._jobs : dict[ str, Job ] = {}
+        self._lock = threading.Lock()
+
+
+    def add( self, job : Job ) -> None:
+        with self._lock:
+            self._jobs[ job.job_id ] = job
+
+
+    def get( self, job_id : str ) -> Optional[ Job ]:
+        with self._lock:
+            return self._jobs.get( job_id )
+
+
+    def remove( self, job_id : str ) -> None:
+        with self._lock:
+            self._jobs.pop( job_id, None )
+
+
+    def list( self ) -> list[ Job ]:
+        with self._lock:
+            return list( self._jobs.values() )
+
+
+def _run_job(
+        job_id : str,
+        image : Image,
+        brush_set_name : str,
+        tiled : bool,
+        pyramid : bool,
+        settings : RunSettings,
+        output_options : OutputOptions,
+        budget : Optional[ RunBudget ],
+        progress : dict,
+        cancel_requests : dict,
+) -> FinchResult:
+    """
+    Runs in a worker process.
+    Progress is reported through a shared dictionary,
+    and the job stops at the next progress report after it is cancelled.
+    """
+    progress[ job_id ] = ( 0, None )
+    try:
+        with instrument( f'job_{job_id}' ):
+            for item in run_finch_streaming(
+                image = image,
+                brush_set_name = brush_set_name,
+                tiled = tiled,
+                pyramid = pyramid,
+                settings = settings,
+                output_options = output_options,
+                budget = budget,
+            ):
+                if job_id in cancel_requests:
+                    raise JobCancelledError( job_id )
+                if isinstance( item, FinchFrame ):
+                    progress[ job_id ] = ( item.generation_index, item.rounded_score )
+                else:
+                    return item
+    except JobCancelledError:
+        raise
+    except Exception:
+        logger.exception( f'Job {job_id} failed.' )
+        raise
+    raise ValueError( f'Job {job_id} did not produce a result.' )
+
+
+class JobScheduler:
+    """
+    Runs paintings in a bounded pool of worker processes, so that requests can return immediately.
+    Jobs are refused once too many of them are queued or running.
+    Queued jobs can be cancelled right away, running jobs stop at their next progress report.
+    Finished jobs expire after a while, to bound the memory that is used for results.
+    """
+
+    def __init__(
+            self,
+            config : Config,
+            store : Optional[ JobStore ] = None,
+            n_workers : int = N_JOB_WORKERS,
+            max_active_jobs : int = MAX_ACTIVE_JOBS,
+            result_ttl_seconds : float = JOB_RESULT_TTL_SECONDS,
+    ) :
+        self.config = config
+        self.settings = RunSettings.from_config( config )
+        self.store = store if store is not None else InMemoryJobStore()
+        self.n_workers = n_workers
+        self.max_active_jobs = max_active_jobs
+        self.result_ttl_seconds = result_ttl_seconds
+        self._lock = threading.Lock()
+        self._executor : Optional[ ProcessPoolExecutor ] = None
+        self._manager = None
+        self._progress : Optional[ dict ] = None
+        self._cancel_requests : Optional[ dict ] = None
+
+
+    def _start( self ) -> None:
+        # The pool and the manager that shares progress are only started once they are needed
+        if self._executor is not None:
+            return
+        self._manager = multiprocessing.Manager()
+        self._progress = self._manager.dict()
+        self._cancel_requests = self._manager.dict()
+        self._executor = ProcessPoolExecutor( max_workers = self.n_workers )
+
+
+    def _stop( self ) -> None:
+        self._executor.shutdown( wait = False, cancel_futures = True )
+        self._manager.shutdown()
+        self._executor = None
+        self._manager = None
+
+
+    def _submit_to_executor( self, *args ) -> Future:
+        """
+        Submits to the pool, and restarts it once if it is broken, for example after a worker was killed.
+        The futures of a broken pool fail, so their jobs finish as failed.
+        """
+        self._start()
+        try:
+            return self._executor.submit( _run_job, *args, self._progress, self._cancel_requests )
+        except BrokenProcessPool:
+            logger.warning( 'The pool of job workers is broken, restarting it.' )
+            self._stop()
+        self._start()
+        try:
+            return self._executor.submit( _run_job, *args, self._progress, self._cancel_requests )
+        except BrokenProcessPool as error:
+            raise JobSchedulerUnavailableError( 'The pool of job workers could not be restarted.' ) from error
+
+
+    def _count_active_jobs( self ) -> int:
+        return sum( 1 for job in self.store.list() if not job.is_finished )
+
+
+    def expire_jobs( self ) -> None:
+        now = time.time()
+        for job in self.store.list():
+            if job.is_finished and now - job.finished_time > self.result_ttl_seconds:
+                logger.info( f'Job {job.job_id} expired.' )
+                self.store.remove( job.job_id )
+
+
+    def submit(
+            self,
+            image : Image,
+            brush_set_name : str,
+            tiled : bool = False,
+            pyramid : bool = False,
+            output_options : OutputOptions = OutputOptions(),
+            budget : Optional[ RunBudget ] = None,
+    ) -> Job:
+        self.expire_jobs()
+        with self._lock:
+            if self._count_active_jobs() >= self.max_active_jobs:
+                raise JobQueueFullError( f'There are already {self.max_active_jobs} active jobs.' )
+            job = Job( job_id = uuid.uuid4().hex, status = JobStatus.QUEUED, created_time = time.time() )
+            job.future = self._submit_to_executor(
+                job.job_id,
+                image,
+                brush_set_name,
+                tiled,
+                pyramid,
+                self.settings,
+                output_options,
+                budget,
+            )
+            # Only jobs that were submitted are stored, so a failed submission never counts as an active job
+            self.store.add( job )
+        job.future.add_done_callback( lambda future: self._finish_job( job, future ) )
+        logger.info( f'Submitted job {job.job_id}.' )
+        return job
+
+
+    def _finish_job( self, job : Job, future : Future ) -> None:
+        if future.cancelled():
+            job.status = JobStatus.CANCELLED
+        elif isinstance( future.exception(), JobCancelledError ):
+            job.status = JobStatus.CANCELLED
+        elif future.exception() is not None:
+            job.status = JobStatus.FAILED
+            job.error = 'Process on server failed. (The Developer is notified)'
+        else:
+            job.status = JobStatus.SUCCEEDED
+            job.result = future.result()
+        job.finished_time = time.time()
+        # The future keeps a reference to the result, which is already stored in the job
+        job.future = None
+        self._update_progress( job )
+        self._progress.pop( job.job_id, None )
+        self._cancel_requests.pop( job.job_id, None )
+        logger.info( f'Job {job.job_id} finished with status {job.status.name}.' )
+
+
+    def _update_progress( self, job : Job ) -> None:
+        progress = self._progress.get( job.job_id )
+        if progress is None:
+            return
+        if job.status == JobStatus.QUEUED:
+            job.status = JobStatus.RUNNING
+        job.generation_index, job.rounded_score = progress
+
+
+    def get( self, job_id : str ) -> Optional[ Job ]:
+        self.expire_jobs()
+        job = self.store.get( job_id )
+        if job is not None and not job.is_finished:
+            self._update_progress( job )
+        return job
+
+
+    def cancel( self, job_id : str ) -> Optional[ Job ]:
+        job = self.get( job_id )
+        if job is None or job.is_finished:
+            return job
+        future = job.future
+        if future is not None and future.cancel():
+            logger.info( f'Cancelled queued job {job_id}.' )
+        else:
+            self._cancel_requests[ job_id ] = True
+            logger.info( f'Requested cancellation of running job {job_id}.' )
+        return job
+
+
+    def shutdown( self ) -> None:
+        if self._executor is None:
+            return
+        self._executor.shutdown( wait = True, cancel_futures = True )
+        self._manager.shutdown()
+        self._executor = None
+        self._manager = None
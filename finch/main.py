@@ -2,7 +2,28 @@ import logging
 
 import cv2
 
-from finch.run import set_global_config, Config, DEFAULT_INPUT_IMAGE_PATH, run_finch
+from finch.context import Config
+from finch.run import (
+    DEFAULT_INPUT_IMAGE_PATH,
+    FinchFrame,
+    FinchResult,
+    RunBudget,
+    RunSettings,
+    run_finch,
+    run_finch_streaming,
+)
+
+
+# The API of the engine that the app uses, see main.py in the root of the repository
+__all__ = [
+    'Config',
+    'FinchFrame',
+    'FinchResult',
+    'RunBudget',
+    'RunSettings',
+    'run_finch',
+    'run_finch_streaming',
+]
 
 
 logger = logging.getLogger(__name__)
@@ -11,9 +32,8 @@ logger = logging.getLogger(__name__)
 if __name__ == '__main__':
     logging.basicConfig( level = logging.DEBUG )
     logging.getLogger( 'PIL.Image' ).setLevel( logging.WARNING )
-    set_global_config( Config.DEBUG )
     path = str( DEFAULT_INPUT_IMAGE_PATH / 'new/10.jpg' )
     image = cv2.imread( path )
     assert image is not None
     brush_set_name = 'Canvas'
-    run_finch( image = image, brush_set_name = brush_set_name )
+    run_finch( image = image, brush_set_name = brush_set_name, settings = RunSettings.from_config( Config.DEBUG ) )
@@ -0,0 +1,205 @@
+import logging
+
+from dataclasses import dataclass, field
+import math
+
+import cv2
+import numpy as np
+
+from finch.brush import BrushBank, get_brush_roi, get_brush_stamp_key, get_brush_stamp_subsection
+from finch.composite import MAX_ALPHA
+from finch.primitive_types import Roi
+from finch.stroke_log import StrokeLog
+
+
+# Pixels are not drawn where the later brushes let through at most this fraction of what is below them.
+# Every brush lets through 1 - alpha / MAX_ALPHA, and stacked brushes multiply,
+# so the error per pixel and channel is at most MAX_ALPHA times this fraction, plus 1 for rounding.
+# The bundled textures hardly reach full alpha, so a pixel is only covered by a stack of brushes.
+# With a fraction of 0 only fully opaque pixels cover what is below them.
+OCCLUSION_MAX_TRANSMITTANCE : float = 1 / MAX_ALPHA
+
+# The redraw uses resampled versions of the brushes,
+# so coverage is computed with this margin to stay on the safe side.
+OCCLUSION_MARGIN_PIXELS : int = 1
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class OcclusionCullingResult:
+    # The brushes that are at least partially visible, in their original order
+    brushes : StrokeLog
+    # For every kept brush, the part of the canvas where it is visible, in the coordinates of the painting.
+    # These include the margin, so they can extend a little beyond the brush itself.
+    visible_rois : list[ Roi ] = field( default_factory = list )
+    n_culled_brushes : int = 0
+    n_shrunk_brushes : int = 0
+    # The number of pixels of the painting that do not have to be drawn anymore
+    n_saved_pixels : int = 0
+
+
+def _get_unrotated_alpha_bounds( texture : np.ndarray, size : int ) -> tuple[ np.ndarray, np.ndarray ]:
+    """
+    Returns the lowest and the highest alpha that a stamp of the texture can have within each of its pixels,
+    once it is rendered at a larger size, like in the 4K redraw, see finch.brush._render_brush_stamp.
+    Resizing and rotating interpolate between neighbouring pixels of the texture,
+    so the bounds are taken over all pixels of the texture that a pixel of the stamp covers, and their neighbours.
+    """
+    kernel_size = 2 * math.ceil( max( texture.shape ) / size ) + 3
+    kernel = np.ones( ( kernel_size, kernel_size ), dtype = np.uint8 )
+    bounds = []
+    for morphology in [ cv2.erode, cv2.dilate ]:
+        # Pixels outside of the texture are transparent
+        bound = morphology( texture, kernel, borderType = cv2.BORDER_CONSTANT, borderValue = 0 )
+        bounds.append( cv2.resize( bound, ( size, size ), interpolation = cv2.INTER_NEAREST ) )
+    return bounds[ 0 ], bounds[ 1 ]
+
+
+def _rotate_alpha_bound( bound : np.ndarray, angle : float ) -> np.ndarray:
+    """
+    Rotates a bound like the stamp is rotated.
+    This moves the bound by less than a pixel, which the margin covers.
+    """
+    size = bound.shape[ 0 ]
+    transformation_matrix = cv2.getRotationMatrix2D( ( size / 2, size / 2 ), angle, 1 )
+    return cv2.warpAffine( bound, transformation_matrix, ( size, size ), flags = cv2.INTER_NEAREST )
+
+
+def _get_margin_kernel() -> np.ndarray:
+    kernel_size = 2 * OCCLUSION_MARGIN_PIXELS + 1
+    return np.ones( ( kernel_size, kernel_size ), dtype = np.uint8 )
+
+
+def _get_footprint( max_alpha : np.ndarray, roi : Roi, expanded_roi : Roi ) -> np.ndarray:
+    """
+    Returns the pixels within the expanded roi that the brush can draw on, grown by the margin.
+    The alpha is the highest alpha of the brush within the roi, see _render_alpha_bounds.
+    """
+    footprint = np.zeros( ( expanded_roi.y_max - expanded_roi.y_min, expanded_roi.x_max - expanded_roi.x_min ), dtype = np.uint8 )
+    footprint[
+        roi.y_min - expanded_roi.y_min : roi.y_max - expanded_roi.y_min,
+        roi.x_min - expanded_roi.x_min : roi.x_max - expanded_roi.x_min,
+    ] = max_alpha > 0
+    if OCCLUSION_MARGIN_PIXELS > 0:
+        footprint = cv2.dilate( footprint, _get_margin_kernel() )
+    return footprint.astype( bool )
+
+
+def _get_transmittance( min_alpha : np.ndarray ) -> np.ndarray:
+    """
+    Returns the highest fraction of what is below that the brush can let through,
+    using the lowest alpha of the brush within the margin of every pixel, see _render_alpha_bounds.
+    """
+    if OCCLUSION_MARGIN_PIXELS > 0:
+        # Pixels outside of the stamp let everything through, so the border should lower the alpha too
+        min_alpha = cv2.erode( min_alpha, _get_margin_kernel(), borderType = cv2.BORDER_CONSTANT, borderValue = 0 )
+    return 1 - min_alpha.astype( np.float32 ) / MAX_ALPHA
+
+
+def _expand_roi( roi : Roi, margin : int, image_height : int, image_width : int ) -> Roi:
+    return Roi(
+        y_min = max( roi.y_min - margin, 0 ),
+        y_max = min( roi.y_max + margin, image_height ),
+        x_min = max( roi.x_min - margin, 0 ),
+        x_max = min( roi.x_max + margin, image_width ),
+    )
+
+
+def _get_area( roi : Roi ) -> int:
+    return ( roi.y_max - roi.y_min ) * ( roi.x_max - roi.x_min )
+
+
+def cull_occluded_brushes(
+        brushes : StrokeLog,
+        image_height : int,
+        image_width : int,
+        brush_bank : BrushBank,
+) -> OcclusionCullingResult:
+    """
+    Finds the brushes that are completely painted over by later brushes, so they do not have to be redrawn.
+    Brushes are visited from the last to the first, while keeping track of how much of what is below
+    the later brushes still shows through every pixel, see OCCLUSION_MAX_TRANSMITTANCE.
+    Brushes that are only partially painted over are shrunk to the bounding box of their visible pixels.
+    Coverage is computed at the resolution of the painting,
+    which is much cheaper than at the resolution of the redraw.
+    """
+    transmittance = np.ones( ( image_height, image_width ), dtype = np.float32 )
+    # Brushes often share their stamps, and the stamps of the painting are small, so they are kept for the whole painting
+    stamp_alpha_bounds = {}
+    # Rotating is cheap, finding the bounds is not, so they are shared by all angles
+    unrotated_stamp_alpha_bounds = {}
+    kept_indices = []
+    visible_rois = []
+    n_culled_brushes = 0
+    n_shrunk_brushes = 0
+    n_saved_pixels = 0
+
+    all_brushes = list( brushes )
+    for brush_index in range( len( all_brushes ) - 1, -1, -1 ):
+        brush = all_brushes[ brush_index ]
+        roi = get_brush_roi( brush, image_height, image_width )
+        if roi.is_empty():
+            n_culled_brushes += 1
+            continue
+
+        # Look at a slightly larger region, so that the resampled brush is always drawn where it is visible
+        expanded_roi = _expand_roi( roi, OCCLUSION_MARGIN_PIXELS, image_height, image_width )
+        stamp_key = get_brush_stamp_key( brush, brush_bank )
+        alpha_bounds = stamp_alpha_bounds.get( stamp_key )
+        if alpha_bounds is None:
+            _, texture_index, size, angle = stamp_key
+            unrotated_alpha_bounds = unrotated_stamp_alpha_bounds.get( ( texture_index, size ) )
+            if unrotated_alpha_bounds is None:
+                unrotated_alpha_bounds = _get_unrotated_alpha_bounds( brush_bank.textures[ texture_index ], size )
+                unrotated_stamp_alpha_bounds[ ( texture_index, size ) ] = unrotated_alpha_bounds
+            alpha_bounds = tuple( _rotate_alpha_bound( bound, angle ) for bound in unrotated_alpha_bounds )
+            stamp_alpha_bounds[ stamp_key ] = alpha_bounds
+        min_alpha, max_alpha = ( get_brush_stamp_subsection( bound, brush, roi ) for bound in alpha_bounds )
+        # Only the pixels that the brush draws on matter, not the transparent corners of its stamp
+        visible = _get_footprint( max_alpha, roi, expanded_roi ) & ( transmittance[ expanded_roi.slices() ] > OCCLUSION_MAX_TRANSMITTANCE )
+        visible_rows = np.flatnonzero( np.any( visible, axis = 1 ) )
+        if len( visible_rows ) == 0:
+            n_culled_brushes += 1
+            n_saved_pixels += _get_area( roi )
+            continue
+        visible_columns = np.flatnonzero( np.any( visible, axis = 0 ) )
+        visible_roi = Roi(
+            y_min = expanded_roi.y_min + int( visible_rows[ 0 ] ),
+            y_max = expanded_roi.y_min + int( visible_rows[ -1 ] ) + 1,
+            x_min = expanded_roi.x_min + int( visible_columns[ 0 ] ),
+            x_max = expanded_roi.x_min + int( visible_columns[ -1 ] ) + 1,
+        )
+        if visible_roi != expanded_roi:
+            n_shrunk_brushes += 1
+            n_saved_pixels += max( 0, _get_area( roi ) - _get_area( visible_roi ) )
+
+        kept_indices.append( brush_index )
+        visible_rois.append( visible_roi )
+        transmittance[ roi.slices() ] *= _get_transmittance( min_alpha )
+
+    kept_indices.reverse()
+    visible_rois.reverse()
+    kept_brushes = StrokeLog.from_brushes( [ all_brushes[ brush_index ] for brush_index in kept_indices ] )
+    return OcclusionCullingResult(
+        brushes = kept_brushes,
+        visible_rois = visible_rois,
+        n_culled_brushes = n_culled_brushes,
+        n_shrunk_brushes = n_shrunk_brushes,
+        n_saved_pixels = n_saved_pixels,
+    )
+
+
+def scale_roi( roi : Roi, scale : float ) -> Roi:
+    """
+    Scales the roi, rounding outwards so that the result covers at least the scaled region.
+    The redraw truncates the scaled positions and sizes of the brushes, which moves them by up to a pixel,
+    so the result is grown by another pixel, see finch.redraw._scale_brushes.
+    """
+    return Roi(
+        y_min = math.floor( roi.y_min * scale ) - 1,
+        y_max = math.ceil( roi.y_max * scale ) + 1,
+        x_min = math.floor( roi.x_min * scale ) - 1,
+        x_max = math.ceil( roi.x_max * scale ) + 1,
+    )
@@ -0,0 +1,275 @@
+import logging
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextvars
+from dataclasses import dataclass
+from enum import Enum
+import io
+from typing import Optional
+
+import cv2
+import numpy as np
+from PIL import Image as PilImage, ImageSequence
+
+from finch.gif import FRAME_DURATION_MS, StreamingGifWriter
+from finch.instrumentation import timer
+from finch.memory_size import size_bytes_to_mib
+from finch.primitive_types import Image
+
+
+# The 4K image and the animation are encoded at the same time.
+# The encoders of OpenCV and Pillow release the GIL, so threads are enough.
+N_OUTPUT_WORKERS : int = 2
+
+# Quality steps are tried in order, until the outputs fit in the size budget.
+# For PNG these are compression levels, where None is the default level of OpenCV, which favors speed.
+PNG_COMPRESSION_LEVEL_STEPS : list[ Optional[ int ] ] = [ None, 9 ]
+JPEG_QUALITY_STEPS : list[ int ] = [ 95, 85, 75, 60 ]
+WEBP_QUALITY_STEPS : list[ int ] = [ 90, 80, 70, 55 ]
+# Once the lowest quality is reached, the 4K image is scaled down
+IMAGE_SCALE_STEPS : list[ float ] = [ 1.0, 0.75, 0.5 ]
+# Animated WebPs are transcoded from the GIF, which is encoded while painting
+ANIMATION_WEBP_QUALITY_STEPS : list[ int ] = [ 80, 60, 40 ]
+# Between 0 (fast) and 6 (small)
+WEBP_METHOD : int = 4
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageFormat( Enum ):
+    PNG = 'png'
+    JPEG = 'jpeg'
+    WEBP = 'webp'
+
+    @property
+    def content_type( self ) -> str:
+        return f'image/{self.value}'
+
+    @property
+    def extension( self ) -> str:
+        return f'.{self.value}'
+
+
+class AnimationFormat( Enum ):
+    GIF = 'gif'
+    WEBP = 'webp'
+
+    @property
+    def content_type( self ) -> str:
+        return f'image/{self.value}'
+
+    @property
+    def extension( self ) -> str:
+        return f'.{self.value}'
+
+
+class OutputTooLargeError( Exception ):
+    pass
+
+
+@dataclass( frozen = True )
+class OutputOptions:
+    """
+    How the results of a painting are encoded.
+    The quality is the starting quality for JPEG and WebP images and animations, between 1 and 100,
+    and the compression level the starting level for PNG images, between 0 and 9.
+    If there is a size budget, the quality is stepped down until the outputs fit,
+    and the animation is left out if even the lowest quality 4K image does not leave room for it.
+    """
+    image_format : ImageFormat = ImageFormat.PNG
+    quality : Optional[ int ] = None
+    compression_level : Optional[ int ] = None
+    animation_format : AnimationFormat = AnimationFormat.GIF
+    max_size_bytes : Optional[ int ] = None
+
+
+@dataclass
+class EncodedOutputs:
+    image_4k : bytes
+    animation : Optional[ bytes ]
+
+
+def _get_image_quality_steps( options : OutputOptions ) -> list[ Optional[ int ] ]:
+    if options.image_format == ImageFormat.PNG:
+        if options.compression_level is None:
+            return PNG_COMPRESSION_LEVEL_STEPS
+        return [ options.compression_level ] + [ level for level in PNG_COMPRESSION_LEVEL_STEPS if level is not None and level > options.compression_level ]
+    quality_steps = JPEG_QUALITY_STEPS if options.image_format == ImageFormat.JPEG else WEBP_QUALITY_STEPS
+    if options.quality is None:
+        return quality_steps
+    return [ options.quality ] + [ quality for quality in quality_steps if quality < options.quality ]
+
+
+def _get_animation_quality_steps( options : OutputOptions ) -> list[ Optional[ int ] ]:
+    # GIFs use the palette of the target image, there is nothing to step down
+    if options.animation_format == AnimationFormat.GIF:
+        return [ None ]
+    if options.quality is None:
+        return ANIMATION_WEBP_QUALITY_STEPS
+    return [ options.quality ] + [ quality for quality in ANIMATION_WEBP_QUALITY_STEPS if quality < options.quality ]
+
+
+def _get_image_encode_params( image_format : ImageFormat, quality : Optional[ int ] ) -> list[ int ]:
+    if quality is None:
+        return []
+    quality_flag = {
+        ImageFormat.PNG : cv2.IMWRITE_PNG_COMPRESSION,
+        ImageFormat.JPEG : cv2.IMWRITE_JPEG_QUALITY,
+        ImageFormat.WEBP : cv2.IMWRITE_WEBP_QUALITY,
+    }[ image_format ]
+    return [ quality_flag, quality ]
+
+
+def encode_image( image : Image, image_format : ImageFormat, quality : Optional[ int ] = None, scale : float = 1.0 ) -> bytes:
+    if scale != 1.0:
+        image = cv2.resize( image, None, fx = scale, fy = scale, interpolation = cv2.INTER_AREA )
+    success, image_encoded = cv2.imencode( image_format.extension, image, _get_image_encode_params( image_format, quality ) )
+    if not success:
+        raise ValueError( f'Failed to encode the 4K result as {image_format.name}.' )
+    return image_encoded.tobytes()
+
+
+def _transcode_to_webp( animation : bytes, quality : int ) -> bytes:
+    # Pillow reads animated WebPs like GIFs, so cached WebPs can be transcoded to a lower quality as well
+    with PilImage.open( io.BytesIO( animation ) ) as animation_image:
+        durations = [ frame.info.get( 'duration', FRAME_DURATION_MS ) for frame in ImageSequence.Iterator( animation_image ) ]
+        animation_image.seek( 0 )
+        buffer = io.BytesIO()
+        animation_image.save(
+            buffer,
+            format = 'WEBP',
+            save_all = True,
+            duration = durations,
+            loop = 0,
+            quality = quality,
+            method = WEBP_METHOD,
+        )
+    return buffer.getvalue()
+
+
+def encode_animation( gif : bytes, animation_format : AnimationFormat, quality : Optional[ int ] ) -> bytes:
+    if animation_format == AnimationFormat.GIF:
+        return gif
+    return _transcode_to_webp( gif, quality )
+
+
+def _finish_animation( gif_writer : StreamingGifWriter, final_image : Image, options : OutputOptions ) -> tuple[ bytes, bytes ]:
+    with timer( 'animation_encode' ):
+        gif = gif_writer.finish( final_image )
+        animation = encode_animation( gif, options.animation_format, _get_animation_quality_steps( options )[ 0 ] )
+    return gif, animation
+
+
+def submit_animation(
+        executor : ThreadPoolExecutor,
+        gif_writer : StreamingGifWriter,
+        final_image : Image,
+        options : OutputOptions,
+) -> Future:
+    """
+    Finishes the GIF and encodes the animation in the background, for example while the 4K image is painted.
+    The future returns both the GIF and the encoded animation.
+    """
+    # Runs in the context of the caller, so the timers end up in its instrumentation
+    return executor.submit( contextvars.copy_context().run, _finish_animation, gif_writer, final_image, options )
+
+
+def _encode_image_timed( image : Image, image_format : ImageFormat, quality : Optional[ int ], scale : float ) -> bytes:
+    with timer( 'image_encode' ):
+        return encode_image( image, image_format, quality, scale )
+
+
+def encode_outputs(
+        executor : ThreadPoolExecutor,
+        image_4k : Image,
+        animation_future : Optional[ Future ],
+        options : OutputOptions,
+) -> EncodedOutputs:
+    """
+    Encodes the 4K image, while the animation is encoded in the background, and fits both in the size budget,
+    see fit_outputs.
+    """
+    image_future = executor.submit(
+        contextvars.copy_context().run, _encode_image_timed, image_4k, options.image_format, *_get_image_steps( options )[ 0 ]
+    )
+    gif, animation = animation_future.result() if animation_future is not None else ( None, None )
+    return fit_outputs( image_4k, gif, EncodedOutputs( image_4k = image_future.result(), animation = animation ), options )
+
+
+def fit_encoded_outputs( outputs : EncodedOutputs, options : OutputOptions ) -> EncodedOutputs:
+    """
+    Fits outputs that were encoded at the starting quality, but without a size budget, such as cached ones,
+    in the size budget of the options.
+    Lower qualities are encoded from the decoded outputs, so they only match freshly fitted outputs for PNG images and GIFs.
+    """
+    if not _exceeds_size_budget( outputs, options ):
+        return outputs
+    image_4k = cv2.imdecode( np.frombuffer( outputs.image_4k, dtype = np.uint8 ), cv2.IMREAD_COLOR )
+    if image_4k is None:
+        raise ValueError( f'Failed to decode the 4K result as {options.image_format.name}.' )
+    return fit_outputs( image_4k, outputs.animation, outputs, options )
+
+
+def _exceeds_size_budget( outputs : EncodedOutputs, options : OutputOptions ) -> bool:
+    animation_size_bytes = len( outputs.animation ) if outputs.animation is not None else 0
+    return options.max_size_bytes is not None and len( outputs.image_4k ) + animation_size_bytes > options.max_size_bytes
+
+
+def _get_image_steps( options : OutputOptions ) -> list[ tuple[ Optional[ int ], float ] ]:
+    image_quality_steps = _get_image_quality_steps( options )
+    image_steps = [ ( quality, 1.0 ) for quality in image_quality_steps ]
+    image_steps += [ ( image_quality_steps[ -1 ], scale ) for scale in IMAGE_SCALE_STEPS[ 1: ] ]
+    return image_steps
+
+
+def fit_outputs(
+        image_4k : Image,
+        gif : Optional[ bytes ],
+        outputs : EncodedOutputs,
+        options : OutputOptions,
+) -> EncodedOutputs:
+    """
+    Fits outputs that were encoded at the starting quality in the size budget,
+    encoding lower qualities from the 4K image and the GIF.
+    First the animation quality is stepped down, then the image quality, and then the image scale.
+    If the image does not leave room for the animation at any step, the animation is left out.
+    Raises an OutputTooLargeError if the image on its own does not fit at the lowest quality and scale.
+    """
+    image_steps = _get_image_steps( options )
+    image, animation = outputs.image_4k, outputs.animation
+    max_size_bytes = options.max_size_bytes
+
+    def animation_size_bytes() -> int:
+        return len( animation ) if animation is not None else 0
+
+    if max_size_bytes is None or len( image ) + animation_size_bytes() <= max_size_bytes:
+        return EncodedOutputs( image_4k = image, animation = animation )
+    logger.info(
+        f'Outputs are {size_bytes_to_mib( len( image ) + animation_size_bytes() ):.2f} MiB, '
+        f'the budget is {size_bytes_to_mib( max_size_bytes ):.2f} MiB, stepping down the quality.'
+    )
+
+    for animation_quality in _get_animation_quality_steps( options )[ 1: ]:
+        if animation is None or len( image ) + animation_size_bytes() <= max_size_bytes:
+            break
+        with timer( 'animation_encode' ):
+            animation = encode_animation( gif, options.animation_format, animation_quality )
+        logger.info( f'Animation is {size_bytes_to_mib( animation_size_bytes() ):.2f} MiB at quality {animation_quality}.' )
+
+    for image_quality, image_scale in image_steps[ 1: ]:
+        if len( image ) + animation_size_bytes() <= max_size_bytes:
+            break
+        # Once the image on its own fits, the animation is left out instead of scaling down the image
+        if animation is not None and image_scale != 1.0 and len( image ) <= max_size_bytes:
+            break
+        image = _encode_image_timed( image_4k, options.image_format, image_quality, image_scale )
+        logger.info( f'4K image is {size_bytes_to_mib( len( image ) ):.2f} MiB at quality {image_quality} and scale {image_scale}.' )
+
+    if len( image ) + animation_size_bytes() > max_size_bytes:
+        if animation is not None:
+            logger.info( 'Leaving out the animation, it does not fit in the size budget.' )
+            animation = None
+        if len( image ) > max_size_bytes:
+            raise OutputTooLargeError( f'4K image is {size_bytes_to_mib( len( image ) ):.2f} MiB at the lowest quality.' )
+    return EncodedOutputs( image_4k = image, animation = animation )
@@ -14,5 +14,33 @@ class Point :
         return Point( self.x, self.y )
 
 
+@dataclass
+class Roi :
+    y_min: int
+    y_max: int
+    x_min: int
+    x_max: int
+
+    def is_empty( self ) -> bool:
+        return self.y_min >= self.y_max or self.x_min >= self.x_max
+
+    def intersects( self, other : "Roi" ) -> bool:
+        return (
+            self.y_min < other.y_max and other.y_min < self.y_max and
+            self.x_min < other.x_max and other.x_min < self.x_max
+        )
+
+    def intersection( self, other : "Roi" ) -> "Roi":
+        return Roi(
+            y_min = max( self.y_min, other.y_min ),
+            y_max = min( self.y_max, other.y_max ),
+            x_min = max( self.x_min, other.x_min ),
+            x_max = min( self.x_max, other.x_max ),
+        )
+
+    def slices( self ) -> tuple[ slice, slice ]:
+        return slice( self.y_min, self.y_max ), slice( self.x_min, self.x_max )
+
+
 FitnessScore = float
 Image = np.ndarray
@@ -0,0 +1,126 @@
+import logging
+
+from dataclasses import dataclass, replace
+from typing import Iterator, Optional
+
+import cv2
+import numpy as np
+
+from finch.brush import draw_brush_on_image
+from finch.context import EngineContext
+from finch.evolution import EvolutionProgress, evolve_specimen_inplace
+from finch.image_gradient import ImageGradient, get_image_gradient
+from finch.primitive_types import Image
+from finch.specimen import Specimen
+
+
+@dataclass
+class PyramidLevel:
+    # The resolution of the level, relative to the target image
+    scale : float
+    # If not given, the tunables of the context are used
+    n_iterations_patience : Optional[ int ] = None
+    termination_score : Optional[ int ] = None
+
+
+# Large early brushes are placed at low resolutions, where evaluating them is cheap.
+# Coarse levels stop once brushes become too small to be represented at their resolution.
+PYRAMID_LEVELS : list[ PyramidLevel ] = [
+    PyramidLevel( scale = 0.25, n_iterations_patience = 50, termination_score = 10000 ),
+    PyramidLevel( scale = 0.5, n_iterations_patience = 75, termination_score = 6000 ),
+    PyramidLevel( scale = 1.0 ),
+]
+# Levels at which the image would be smaller than this are skipped
+PYRAMID_MIN_LEVEL_SIZE : int = 64
+
+
+logger = logging.getLogger(__name__)
+
+
+def _get_level_shape( image : Image, scale : float ) -> tuple[ int, int ]:
+    height, width = image.shape[:2]
+    return max( 1, round( height * scale ) ), max( 1, round( width * scale ) )
+
+
+def _get_levels( target_image : Image ) -> list[ PyramidLevel ]:
+    levels = [
+        level for level in PYRAMID_LEVELS
+        if level.scale >= 1.0 or min( _get_level_shape( target_image, level.scale ) ) >= PYRAMID_MIN_LEVEL_SIZE
+    ]
+    if not levels or levels[ -1 ].scale != 1.0:
+        levels.append( PyramidLevel( scale = 1.0 ) )
+    return levels
+
+
+def _carry_specimen_up( specimen : Specimen, level_specimen : Specimen, scale : float ) -> None:
+    """
+    Replaces the specimen with the brushes of a lower resolution specimen, scaled up and redrawn.
+    Like finch.redraw, detail that was lost at the lower resolution is added by the brushes at this level.
+    """
+    specimen.brushes = level_specimen.brushes.scaled( scale )
+    specimen.cached_image.fill( 255 )
+    for brush in specimen.brushes:
+        draw_brush_on_image( brush, specimen.cached_image, specimen.brush_bank )
+
+
+def evolve_specimen_pyramid_inplace(
+        specimen : Specimen,
+        target_image : Image,
+        target_gradient : ImageGradient,
+        context : EngineContext,
+) -> Iterator[ EvolutionProgress ]:
+    """
+    Runs the visual genetic algorithm from coarse to fine resolutions.
+    Every level starts from the brushes of the previous level, scaled up,
+    and has its own patience and termination score.
+    While painting at a lower resolution, the specimen shows an upscaled version of that level,
+    so progress can be reported at the full resolution.
+    Only the last progress of the last level is final.
+    """
+    levels = _get_levels( target_image )
+    image_height, image_width = target_image.shape[:2]
+    level_specimen = specimen
+    previous_scale = None
+
+    for level_index, level in enumerate( levels ):
+        is_last_level = level_index == len( levels ) - 1
+        logger.info( f'Painting at {level.scale:.2f} of the full resolution.' )
+
+        if is_last_level:
+            level_target_image = target_image
+            level_target_gradient = target_gradient
+            next_level_specimen = specimen
+        else:
+            level_height, level_width = _get_level_shape( target_image, level.scale )
+            level_target_image = cv2.resize( target_image, ( level_width, level_height ), interpolation = cv2.INTER_AREA )
+            level_target_gradient = get_image_gradient( level_target_image, compact = context.tunables.compact_gradient )
+            next_level_specimen = Specimen(
+                cached_image = np.full_like( level_target_image, 255 ),
+                brush_bank = specimen.brush_bank,
+            )
+
+        if previous_scale is not None:
+            _carry_specimen_up( next_level_specimen, level_specimen, level.scale / previous_scale )
+        level_specimen = next_level_specimen
+        previous_scale = level.scale
+
+        for progress in evolve_specimen_inplace(
+            specimen = level_specimen,
+            target_image = level_target_image,
+            target_gradient = level_target_gradient,
+            context = context,
+            n_iterations_patience = level.n_iterations_patience,
+            termination_score = level.termination_score,
+        ):
+            if not is_last_level:
+                # Lower resolutions are shown upscaled, so that every reported image has the same size
+                specimen.cached_image[ ... ] = cv2.resize(
+                    level_specimen.cached_image,
+                    ( image_width, image_height ),
+                    interpolation = cv2.INTER_LINEAR
+                )
+            yield replace(
+                progress,
+                report_string = f'level_{level_index}__{progress.report_string}',
+                is_final = progress.is_final and is_last_level,
+            )
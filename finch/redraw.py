@@ -1,34 +1,49 @@
 import logging
+
+from concurrent.futures import ThreadPoolExecutor
 import math
+import os
+from typing import Iterator, Optional
 
 import numpy as np
 
-from finch.primitive_types import Image, Point
-from finch.brush import Brush, get_global_brush_textures, draw_brush_on_image
+from finch.primitive_types import Image, Point, Roi
+from finch.brush import (
+    Brush,
+    BrushBank,
+    draw_brush_on_image,
+    get_brush_roi,
+    get_brush_stamp,
+    get_brush_stamp_key,
+    get_brush_stamp_nbytes,
+)
+from finch.occlusion import cull_occluded_brushes, scale_roi
 from finch.scale import get_scale_for_4k_from_image
 from finch.specimen import Specimen
+from finch.stroke_log import StrokeLog
 
 
-logger = logging.getLogger(__name__)
+# The tiles of the high resolution canvas are painted in parallel.
+# Resizing, rotating and compositing are done by OpenCV and NumPy, which release the GIL,
+# so threads can share the canvas and the brush stamp cache, without copying them to other processes.
+N_REDRAW_WORKERS : int = os.cpu_count() or 1
+REDRAW_TILE_SIZE : int = 512
+# The stamps of the brushes of a batch are kept in memory until every tile drew them, see _redraw_painting
+REDRAW_MAX_PINNED_STAMP_BYTES : int = 128 * 1024 * 1024
+# Skips brushes, or parts of brushes, that are painted over by later brushes, see finch.occlusion.
+# Off by default: the bundled textures are grainy, so even dozens of stacked brushes let some of what is below through,
+# and paintings hardly have any brush that is covered completely. Culling does not make the redraw faster for them.
+ENABLE_OCCLUSION_CULLING : bool = False
 
 
-def _redraw_painting(
-        brushes : list[Brush],
-        scale: float,
-        result_image: np.ndarray,
-) -> Image:
+logger = logging.getLogger(__name__)
 
-    """
-    Redraws a painting by using scaled versions of the original brushes.
-    As long as the brush texture is available at larger resolutions,
-    this allows you to make higher resolution versions of your images.
-    Even if some of the brushes are drawn at scales larger than the original texture resolution,
-    the image detail improve drastically as the larger brushes are painted over with smaller images.
-    """
 
+def _scale_brushes( brushes : StrokeLog, scale : float ) -> list[ Brush ]:
     def int_scale(v):
         return int( v * scale )
 
+    scaled_brushes = []
     for brush in brushes:
         # note that brush width and height are expected to be equal
         brush.size = int_scale(brush.size)
@@ -37,8 +52,156 @@ def _redraw_painting(
             int_scale(brush.position.x),
             int_scale(brush.position.y),
         )
+        scaled_brushes.append( brush )
+    return scaled_brushes
+
+
+def _redraw_painting_serial(
+        brushes : StrokeLog,
+        scale: float,
+        result_image: np.ndarray,
+        brush_bank : BrushBank,
+) -> Image:
+    # The original serial redraw, kept as a reference for comparison and benchmarking
+    for brush in _scale_brushes( brushes, scale ):
+        draw_brush_on_image( brush, result_image, brush_bank )
+    return result_image
+
+
+def _get_brush_rois(
+        brushes : list[ Brush ],
+        clip_rois : Optional[ list[ Roi ] ],
+        image_height : int,
+        image_width : int,
+) -> list[ Optional[ Roi ] ]:
+    """
+    Returns the part of the canvas that each brush should be drawn on, or None if it is not drawn at all.
+    """
+    brush_rois = []
+    for brush_index, brush in enumerate( brushes ):
+        roi = get_brush_roi( brush, image_height, image_width )
+        if clip_rois is not None:
+            roi = roi.intersection( clip_rois[ brush_index ] )
+        brush_rois.append( None if roi.is_empty() else roi )
+    return brush_rois
+
+
+def _batch_brushes_by_stamp_size(
+        brushes : list[ Brush ],
+        brush_rois : list[ Optional[ Roi ] ],
+        brush_bank : BrushBank,
+) -> Iterator[ list[ int ] ]:
+    """
+    Yields the indices of the drawn brushes in consecutive batches,
+    whose distinct stamps take at most REDRAW_MAX_PINNED_STAMP_BYTES together.
+    A stamp that is larger on its own gets a batch of its own.
+    """
+    batch = []
+    batch_stamp_keys = set()
+    batch_nbytes = 0
+    for brush_index, ( brush, roi ) in enumerate( zip( brushes, brush_rois ) ):
+        if roi is None:
+            continue
+        stamp_key = get_brush_stamp_key( brush, brush_bank )
+        stamp_nbytes = 0 if stamp_key in batch_stamp_keys else get_brush_stamp_nbytes( brush )
+        if batch and batch_nbytes + stamp_nbytes > REDRAW_MAX_PINNED_STAMP_BYTES:
+            yield batch
+            batch = []
+            batch_stamp_keys = set()
+            batch_nbytes = 0
+            stamp_nbytes = get_brush_stamp_nbytes( brush )
+        batch.append( brush_index )
+        batch_stamp_keys.add( stamp_key )
+        batch_nbytes += stamp_nbytes
+    if batch:
+        yield batch
+
+
+def _bin_brushes_per_tile(
+        brush_indices : list[ int ],
+        brush_rois : list[ Optional[ Roi ] ],
+) -> dict[ tuple[ int, int ], list[ int ] ]:
+    """
+    Returns the indices of the brushes that touch each tile, in their original order.
+    Tiles are identified by their row and column index.
+    """
+    tile_brushes = {}
+    for brush_index in brush_indices:
+        roi = brush_rois[ brush_index ]
+        for row_index in range( roi.y_min // REDRAW_TILE_SIZE, ( roi.y_max - 1 ) // REDRAW_TILE_SIZE + 1 ):
+            for column_index in range( roi.x_min // REDRAW_TILE_SIZE, ( roi.x_max - 1 ) // REDRAW_TILE_SIZE + 1 ):
+                tile_brushes.setdefault( ( row_index, column_index ), [] ).append( brush_index )
+    return tile_brushes
+
+
+def _get_tile_roi( row_index : int, column_index : int, image_height : int, image_width : int ) -> Roi:
+    return Roi(
+        y_min = row_index * REDRAW_TILE_SIZE,
+        y_max = min( ( row_index + 1 ) * REDRAW_TILE_SIZE, image_height ),
+        x_min = column_index * REDRAW_TILE_SIZE,
+        x_max = min( ( column_index + 1 ) * REDRAW_TILE_SIZE, image_width ),
+    )
+
+
+def _redraw_painting(
+        brushes : StrokeLog,
+        scale: float,
+        result_image: np.ndarray,
+        brush_bank : BrushBank,
+        n_workers : int = N_REDRAW_WORKERS,
+        clip_rois : Optional[ list[ Roi ] ] = None,
+) -> Image:
+
+    """
+    Redraws a painting by using scaled versions of the original brushes.
+    As long as the brush texture is available at larger resolutions,
+    this allows you to make higher resolution versions of your images.
+    Even if some of the brushes are drawn at scales larger than the original texture resolution,
+    the image detail improve drastically as the larger brushes are painted over with smaller images.
 
-        draw_brush_on_image( brush, result_image )
+    With multiple workers, the canvas is split in tiles, which are painted in parallel.
+    Every tile draws the brushes that touch it in their original order, clipped to the tile,
+    so the result is identical to drawing all brushes one after another.
+    The brushes are drawn in batches, see _batch_brushes_by_stamp_size.
+    The stamps of a batch are rendered once and kept until every tile drew them,
+    otherwise the bounded brush stamp cache would evict large stamps and render them again for every tile they touch.
+    If clip ROIs are given, every brush is only drawn within its clip ROI, in the coordinates of the result.
+    """
+    image_height, image_width = result_image.shape[:2]
+    scaled_brushes = _scale_brushes( brushes, scale )
+    brush_rois = _get_brush_rois( scaled_brushes, clip_rois, image_height, image_width )
+
+    if n_workers <= 1:
+        # Tiles only pay off when they are painted in parallel
+        for brush, roi in zip( scaled_brushes, brush_rois ):
+            if roi is not None:
+                draw_brush_on_image( brush, result_image, brush_bank, clip_roi = roi )
+        return result_image
+
+    def get_stamp( brush_index : int ) -> np.ndarray:
+        return get_brush_stamp( scaled_brushes[ brush_index ], brush_bank )
+
+    with ThreadPoolExecutor( max_workers = n_workers ) as executor:
+        for batch in _batch_brushes_by_stamp_size( scaled_brushes, brush_rois, brush_bank ):
+            stamps = dict( zip( batch, executor.map( get_stamp, batch ) ) )
+            tile_brushes = _bin_brushes_per_tile( batch, brush_rois )
+
+            def redraw_tile( tile_index : tuple[ int, int ] ) -> None:
+                tile_roi = _get_tile_roi( *tile_index, image_height, image_width )
+                for brush_index in tile_brushes[ tile_index ]:
+                    draw_brush_on_image(
+                        scaled_brushes[ brush_index ],
+                        result_image,
+                        brush_bank,
+                        clip_roi = brush_rois[ brush_index ].intersection( tile_roi ),
+                        stamp = stamps[ brush_index ],
+                    )
+
+            # Start with the tiles with the most brushes, so that no single long tile is left at the end
+            tile_indices = sorted( tile_brushes, key = lambda tile_index: len( tile_brushes[ tile_index ] ), reverse = True )
+            # Consume the results, so that exceptions in the workers are raised here
+            for _ in executor.map( redraw_tile, tile_indices ):
+                pass
 
     # As long as oversized brushes disappear in the background when they are painted over with smaller brushes,
     # having oversized brushes is not a problem.
@@ -46,9 +209,7 @@ def _redraw_painting(
     return result_image
 
 
-def redraw_painting_at_4k(
-        specimen : Specimen,
-):
+def _get_blank_4k_image( specimen : Specimen ) -> tuple[ Image, float ]:
     scale = get_scale_for_4k_from_image( specimen.cached_image )
 
     result_image_shape = (
@@ -58,11 +219,33 @@ def redraw_painting_at_4k(
     )
     result_image = np.zeros( result_image_shape, dtype = np.uint8 )
     result_image.fill(255)
+    return result_image, scale
+
+
+def redraw_painting_at_4k(
+        specimen : Specimen,
+):
+    result_image, scale = _get_blank_4k_image( specimen )
+
+    brushes = specimen.brushes
+    clip_rois = None
+    if ENABLE_OCCLUSION_CULLING:
+        image_height, image_width = specimen.cached_image.shape[:2]
+        culling_result = cull_occluded_brushes( brushes, image_height, image_width, specimen.brush_bank )
+        logger.info(
+            f'Culled {culling_result.n_culled_brushes}/{len( brushes )} brushes, '
+            f'shrunk {culling_result.n_shrunk_brushes} brushes, '
+            f'saved approximately {int( culling_result.n_saved_pixels * scale * scale )} pixels at 4K.'
+        )
+        brushes = culling_result.brushes
+        clip_rois = [ scale_roi( roi, scale ) for roi in culling_result.visible_rois ]
 
     result = _redraw_painting(
-        specimen.brushes,
+        brushes,
         scale,
-        result_image
+        result_image,
+        specimen.brush_bank,
+        clip_rois = clip_rois,
     )
 
     return result
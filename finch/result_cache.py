@@ -0,0 +1,178 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import logging
+from pathlib import Path
+import tempfile
+import threading
+from typing import Optional, Protocol
+
+import numpy as np
+
+from finch.stroke_log import StrokeLog
+
+
+logger = logging.getLogger(__name__)
+
+
+# Increase this whenever the painting algorithm changes in a way that is not captured by its parameters,
+# so that results of older versions are not returned anymore.
+RESULT_CACHE_VERSION = 8
+
+
+@dataclass
+class CachedResult:
+    # Encoded as given by the output options, which are part of the key, apart from the size budget,
+    # which is applied to the cached result, see finch.run.run_finch_streaming
+    image_4k : bytes
+    animation : Optional[ bytes ]
+    brushes : StrokeLog
+
+    @property
+    def size_bytes( self ) -> int:
+        animation_size_bytes = len( self.animation ) if self.animation is not None else 0
+        return len( self.image_4k ) + animation_size_bytes + self.brushes.nbytes
+
+
+def get_result_cache_key( image : np.ndarray, brush_set_name : str, parameters : dict ) -> str:
+    """
+    Returns a key that identifies a painting, based on a hash of the image and everything that affects the result.
+    The painting is deterministic, so equal keys mean equal results.
+    """
+    image = np.ascontiguousarray( image )
+    hasher = hashlib.sha256()
+    hasher.update( repr( ( RESULT_CACHE_VERSION, image.shape, image.dtype.str, brush_set_name ) ).encode() )
+    hasher.update( repr( sorted( parameters.items() ) ).encode() )
+    hasher.update( memoryview( image ).cast( 'B' ) )
+    return hasher.hexdigest()
+
+
+class ResultCacheBackend( Protocol ):
+
+    def get( self, key : str ) -> Optional[ CachedResult ]:
+        ...
+
+    def put( self, key : str, result : CachedResult ) -> None:
+        ...
+
+
+class InMemoryResultCacheBackend:
+    """
+    A bounded LRU cache of results, kept in the memory of the current process.
+    """
+
+    def __init__( self, max_size_bytes : int ) :
+        self.max_size_bytes = max_size_bytes
+        self._results : OrderedDict[ str, CachedResult ] = OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+
+
+    def get( self, key : str ) -> Optional[ CachedResult ]:
+        with self._lock:
+            result = self._results.get( key )
+            if result is not None:
+                self._results.move_to_end( key )
+            return result
+
+
+    def put( self, key : str, result : CachedResult ) -> None:
+        if result.size_bytes > self.max_size_bytes:
+            return
+        with self._lock:
+            if key in self._results:
+                return
+            self._results[ key ] = result
+            self._size_bytes += result.size_bytes
+            while self._size_bytes > self.max_size_bytes:
+                _, evicted_result = self._results.popitem( last = False )
+                self._size_bytes -= evicted_result.size_bytes
+
+
+class DirectoryResultCacheBackend:
+    """
+    Stores every result in its own subdirectory, named after its key,
+    so that results survive restarts and can be shared between processes.
+    Results are written to a temporary directory first, and then renamed,
+    so that readers never see a partially written result.
+    """
+
+    IMAGE_4K_FILE_NAME = 'result_4k'
+    ANIMATION_FILE_NAME = 'result_animation'
+    BRUSHES_FILE_NAME = 'brushes.strokes'
+
+    def __init__( self, directory_path : Path ) :
+        self.directory_path = Path( directory_path )
+        self.directory_path.mkdir( parents = True, exist_ok = True )
+
+
+    def get( self, key : str ) -> Optional[ CachedResult ]:
+        result_directory_path = self.directory_path / key
+        if not result_directory_path.is_dir():
+            return None
+        try:
+            image_4k = ( result_directory_path / self.IMAGE_4K_FILE_NAME ).read_bytes()
+            animation_path = result_directory_path / self.ANIMATION_FILE_NAME
+            animation = animation_path.read_bytes() if animation_path.is_file() else None
+            brushes = StrokeLog.from_bytes( ( result_directory_path / self.BRUSHES_FILE_NAME ).read_bytes() )
+        except Exception:
+            logger.exception( f'Could not read cached result {key}.' )
+            return None
+        return CachedResult( image_4k = image_4k, animation = animation, brushes = brushes )
+
+
+    def put( self, key : str, result : CachedResult ) -> None:
+        result_directory_path = self.directory_path / key
+        if result_directory_path.is_dir():
+            return
+        # Unique across threads and processes, so concurrent writers of the same key never share a directory
+        temporary_directory_path = Path( tempfile.mkdtemp( prefix = f'.{key}.', suffix = '.tmp', dir = self.directory_path ) )
+        ( temporary_directory_path / self.IMAGE_4K_FILE_NAME ).write_bytes( result.image_4k )
+        if result.animation is not None:
+            ( temporary_directory_path / self.ANIMATION_FILE_NAME ).write_bytes( result.animation )
+        ( temporary_directory_path / self.BRUSHES_FILE_NAME ).write_bytes( result.brushes.to_bytes() )
+        try:
+            temporary_directory_path.rename( result_directory_path )
+        except OSError:
+            # Another process stored the same result first
+            for path in temporary_directory_path.iterdir():
+                path.unlink()
+            temporary_directory_path.rmdir()
+
+
+class ResultCache:
+    """
+    Caches finished paintings in front of the painting algorithm,
+    so that repeated requests for the same image and settings do not repeat the evolution.
+    Keeps track of hits and misses, regardless of the backend.
+    """
+
+    def __init__( self, backend : ResultCacheBackend ) :
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+
+    def get( self, key : str ) -> Optional[ CachedResult ]:
+        result = self.backend.get( key )
+        with self._lock:
+            if result is None:
+                self.n_misses += 1
+            else:
+                self.n_hits += 1
+        return result
+
+
+    def put( self, key : str, result : CachedResult ) -> None:
+        try:
+            self.backend.put( key, result )
+        except Exception:
+            # Failing to cache a result should never fail the request
+            logger.exception( f'Could not store result {key} in the cache.' )
+
+
+    def log_stats( self ) -> None:
+        n_lookups = self.n_hits + self.n_misses
+        hit_rate = self.n_hits / n_lookups if n_lookups > 0 else 0
+        logger.info( f'Result cache: {self.n_hits}/{n_lookups} hits ({hit_rate:.1%}).' )
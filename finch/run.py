@@ -1,44 +1,40 @@
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, replace
 from datetime import datetime
-from enum import Enum, auto
-import math
 from pathlib import Path
-import pickle
+import time
+from typing import Iterator, Optional
 
-import random
 import cv2
 import numpy as np
 
-from finch.absolute_difference_image import get_absolute_difference_image
+from finch import brush, occlusion, pyramid as pyramid_engine, redraw, tiled as tiled_engine
 from finch.brush import (
-    Brush,
     BrushSet,
-    preload_brush_textures_for_brush_set,
-    random_brush_texture_index,
-    draw_brush_on_image,
-    get_brush_size_for_fitness,
+    BRUSH_STAMP_CACHE,
     str_to_brush_set
 )
-from finch.color_from_image import get_color_from_image
-from finch.fitness import get_fitness
-from finch.gif import make_gif
-from finch.image_gradient import ImageGradient
-from finch.primitive_types import Image, FitnessScore
-from finch.sample_weighted_position_from_image import sample_weighted_position_from_image
+from finch.budget import FINISH_TIME_ESTIMATOR, RunBudget
+from finch.checkpoint import Checkpoint, CheckpointError, Checkpointer, EvolutionState, read_checkpoint
+from finch.context import FIXED_RANDOM_SEED, EngineContext, EvolutionTunables, RunSettings
+from finch.evolution import SCORE_MULTIPLIER, evolve_specimen_inplace, get_rounded_score
+from finch.fitness import IncrementalFitness
+from finch.gif import StreamingGifWriter
+from finch.image_gradient import get_image_gradient
+from finch.instrumentation import set_count, timer
+from finch.output import N_OUTPUT_WORKERS, EncodedOutputs, OutputOptions, encode_outputs, fit_encoded_outputs, submit_animation
+from finch.primitive_types import Image
+from finch.pyramid import evolve_specimen_pyramid_inplace
 from finch.redraw import redraw_painting_at_4k
+from finch.result_cache import CachedResult, InMemoryResultCacheBackend, ResultCache, get_result_cache_key
 from finch.scale import normalize_image_size
+from finch.tiled import N_TILE_WORKERS, evolve_specimen_tiled_inplace
 from finch.specimen import Specimen
+from finch.stroke_log import StrokeLog
 
 
-FIXED_RANDOM_SEED = 1337
-DECIMALS = 3
-SCORE_MULTIPLIER = 10 ** DECIMALS
-
-N_ITERATIONS_PATIENCE : int = 100
-SCORE_INTERVAL: int = 0.5 * SCORE_MULTIPLIER
-TERMINATION_SCORE: int = 3500
-
 ROOT_DIR                        = Path( __file__ ).parent.parent
 DEFAULT_OUTPUT_DIRECTORY_PATH   = ROOT_DIR / '_results'
 DEFAULT_INPUT_IMAGE_PATH        = ROOT_DIR / '_input_images'
@@ -47,32 +43,34 @@ DEFAULT_INPUT_IMAGE_PATH        = ROOT_DIR / '_input_images'
 logger = logging.getLogger(__name__)
 
 
-WRITE_OUTPUT = False
-WRITE_PICKLE = False
-MAKE_GIF = False
-LOG_SCORES = True
+# Finished paintings are cached in memory by default,
+# use a DirectoryResultCacheBackend to keep them on disk instead.
+RESULT_CACHE_MAX_SIZE_BYTES : int = 256 * 1024 * 1024
+RESULT_CACHE = ResultCache( InMemoryResultCacheBackend( max_size_bytes = RESULT_CACHE_MAX_SIZE_BYTES ) )
 
 
-class Config(Enum):
-    DEBUG = auto()
-    PROD = auto()
+@dataclass
+class FinchFrame:
+    """
+    An intermediate result, yielded whenever the score improved by at least the score interval.
+    """
+    report_string : str
+    generation_index : int
+    rounded_score : int
+    image : Image
 
 
-def set_global_config( config : Config ) -> None:
-    global WRITE_OUTPUT
-    global WRITE_PICKLE
-    global MAKE_GIF
-    global LOG_SCORES
-    if config == Config.DEBUG:
-        WRITE_OUTPUT = True
-        WRITE_PICKLE = False
-        MAKE_GIF = True
-        LOG_SCORES = True
-    else:
-        WRITE_OUTPUT = False
-        WRITE_PICKLE = False
-        MAKE_GIF = True
-        LOG_SCORES = False
+@dataclass
+class FinchResult:
+    """
+    The final result, yielded once after the evolution converged, or when it was found in the result cache.
+    """
+    image_4k : bytes
+    # Left out if it was disabled, or if it did not fit in the size budget of the output options
+    animation : Optional[ bytes ]
+    brushes : StrokeLog
+    output_options : OutputOptions = OutputOptions()
+    from_cache : bool = False
 
 
 def get_blank_image_like( example_image ) -> Image:
@@ -81,172 +79,335 @@ def get_blank_image_like( example_image ) -> Image:
     return blank_image
 
 
-def get_initial_specimen( target_image : Image ) -> Specimen:
+def get_initial_specimen( target_image : Image, context : EngineContext ) -> Specimen:
     blank_image = get_blank_image_like( target_image )
-    specimen = Specimen(cached_image = blank_image )
+    specimen = Specimen(cached_image = blank_image, brush_bank = context.brush_bank )
     return specimen
 
 
-def mutate_specimen_inplace(
-        specimen : Specimen,
-        fitness : FitnessScore,
-        target_image : Image,
-        target_gradient : ImageGradient,
-        diff_image : Image
-) -> None:
-    position = sample_weighted_position_from_image( diff_image = diff_image )
-    color = get_color_from_image( image = target_image, position = position )
-    texture_index = random_brush_texture_index()
-    angle = math.degrees( target_gradient.get_direction( position ) )
-    brush_size = get_brush_size_for_fitness(
-        fitness = fitness,
-        image_height = target_image.shape[0],
-        image_width = target_image.shape[1]
-    )
-    new_brush = Brush(
-        color = color,
-        position = position,
-        texture_index = texture_index,
-        angle = angle,
-        size = brush_size,
-    )
-    draw_brush_on_image( brush = new_brush, image = specimen.cached_image )
-    specimen.brushes.append( new_brush )
-
-
-def write_results(report_string : str, image : Image, specimen : Specimen) -> None:
-    if not WRITE_OUTPUT:
+def write_results(report_string : str, image : Image, specimen : Specimen, settings : RunSettings) -> None:
+    if not settings.write_output:
         return
     cv2.imwrite( f'{DEFAULT_OUTPUT_DIRECTORY_PATH}/{report_string}.png', image )
-    # store pickled specimen if desired
-    if WRITE_PICKLE:
-        pickle_file_path = f'{DEFAULT_OUTPUT_DIRECTORY_PATH}/{report_string}.pickle'
-        with open( pickle_file_path, 'wb' ) as pickle_file :
-            pickle.dump( specimen.__dict__, pickle_file )
+    # store the brushes of the specimen if desired, they can be read with StrokeLog.from_bytes
+    if settings.write_strokes:
+        strokes_file_path = f'{DEFAULT_OUTPUT_DIRECTORY_PATH}/{report_string}.strokes'
+        with open( strokes_file_path, 'wb' ) as strokes_file :
+            strokes_file.write( specimen.brushes.to_bytes() )
+
+
+def _read_checkpoint_to_resume(
+        checkpoint_path : Path,
+        target_image : Image,
+        context : EngineContext,
+        is_tiled_or_pyramid : bool,
+) -> Optional[ Checkpoint ]:
+    if not Path( checkpoint_path ).is_file():
+        return None
+    checkpoint = read_checkpoint( checkpoint_path )
+    checkpoint.validate( target_image, context )
+    if is_tiled_or_pyramid and not checkpoint.is_converged:
+        raise CheckpointError( 'Only paintings without tiles or a pyramid can be resumed before they converged.' )
+    return checkpoint
 
 
 def run_finch_generator(
     target_image    : Image,
     brush_set       : BrushSet,
-) -> Image | tuple[Image, bytes]:
-    preload_brush_textures_for_brush_set( brush_set = brush_set )
-    target_gradient = ImageGradient( image = target_image )
-
-    last_rounded_score = 100 * SCORE_MULTIPLIER
-    last_written_score = last_rounded_score
-    n_iterations_with_same_score = 0
-    last_update_time = datetime.now()
+    tiled           : bool = False,
+    n_tile_workers  : Optional[int] = None,
+    pyramid         : bool = False,
+    settings        : RunSettings = RunSettings(),
+    tunables        : EvolutionTunables = EvolutionTunables(),
+    output_options  : OutputOptions = OutputOptions(),
+    budget          : Optional[ RunBudget ] = None,
+    checkpoint_path : Optional[ Path ] = None,
+) -> Iterator[ FinchFrame | FinchResult ]:
+    """
+    Yields a FinchFrame for every reported progress of the evolution,
+    so that callers can show intermediate results while the painting converges.
+    The last item is always a FinchResult, containing the 4K version and, if enabled, the animation,
+    encoded as given by the output options.
+    Tiled painting takes precedence over pyramid painting, they cannot be combined.
+    All state of the painting is kept in its own context, so paintings can run concurrently in threads.
+    If a budget is given, the evolution also stops when it runs out of budget, see finch.budget.
+    If a checkpoint path is given, checkpoints are written to it while painting, and once more when the evolution ends.
+    If it already holds a checkpoint, the painting resumes from it, and continues as if it was never interrupted,
+    or is only redrawn if the checkpoint had converged, see finch.checkpoint.
+    Only paintings without tiles or a pyramid are checkpointed while painting.
+    """
+    # use a seed to make things reproducible
+    context = EngineContext.create(
+        brush_set = brush_set,
+        settings = settings,
+        tunables = tunables,
+        seed = FIXED_RANDOM_SEED,
+        budget = budget,
+    )
+    target_gradient = get_image_gradient( target_image, compact = tunables.compact_gradient )
 
     logger.info('Running visual genetic algorithm')
     start_time = datetime.now()
 
-    # use a seed to make things reproducible
-    random.seed( FIXED_RANDOM_SEED )
-    np.random.seed( FIXED_RANDOM_SEED )
-
-    generation_index = 0
-
-    specimen = get_initial_specimen( target_image = target_image )
-    diff_image = get_absolute_difference_image( specimen_image = specimen.cached_image, target_image = target_image )
-    fitness = get_fitness( specimen = specimen, target_image = target_image )
-    rounded_score = 9999999
-
-    result_frames = []
-    if MAKE_GIF:
-        result_frames.append( specimen.cached_image.copy() )
-
-    while True:
-        generation_index += 1
+    specimen = get_initial_specimen( target_image = target_image, context = context )
+
+    checkpointer = None
+    checkpoint = None
+    if checkpoint_path is not None:
+        checkpointer = Checkpointer( checkpoint_path, target_image )
+        checkpoint = _read_checkpoint_to_resume( checkpoint_path, target_image, context, tiled or pyramid )
+    if checkpoint is not None:
+        checkpoint.restore( context )
+        checkpoint.replay( specimen )
+        state = checkpoint.state
+        logger.info( f'Resuming from {len( checkpoint.brushes )} brushes at generation {state.generation_index}.' )
+    else:
+        state = EvolutionState( last_written_score = 100 * SCORE_MULTIPLIER )
+
+    # The GIF is encoded while painting, so frames do not have to be kept until the end
+    gif_writer = None
+    if settings.make_gif:
+        initial_rounded_score = get_rounded_score( IncrementalFitness( specimen.cached_image, target_image ).fitness )
+        gif_writer = StreamingGifWriter(
+            palette_image = target_image,
+            first_score = initial_rounded_score,
+            last_score = tunables.termination_score,
+        )
+        gif_writer.add_frame( specimen.cached_image, initial_rounded_score )
 
-        # Mutate a copy of the specimen
-        new_specimen = specimen.copy()
-        mutate_specimen_inplace(
-            specimen = new_specimen,
-            fitness = fitness,
+    if checkpoint is not None and checkpoint.is_converged:
+        evolution_generator = iter( [] )
+    elif tiled:
+        evolution_generator = evolve_specimen_tiled_inplace(
+            specimen = specimen,
+            target_image = target_image,
+            target_gradient = target_gradient,
+            context = context,
+            n_workers = n_tile_workers or N_TILE_WORKERS,
+        )
+    elif pyramid:
+        evolution_generator = evolve_specimen_pyramid_inplace(
+            specimen = specimen,
+            target_image = target_image,
+            target_gradient = target_gradient,
+            context = context,
+        )
+    else:
+        evolution_generator = evolve_specimen_inplace(
+            specimen = specimen,
             target_image = target_image,
             target_gradient = target_gradient,
-            diff_image = diff_image
+            context = context,
+            state = state,
+            checkpointer = checkpointer,
+        )
+
+    for progress in evolution_generator:
+        write_results( progress.report_string, specimen.cached_image, specimen, settings )
+        # The specimen keeps changing while the caller handles the frame, so hand out a copy
+        frame_image = specimen.cached_image.copy()
+        if gif_writer is not None and not progress.is_final:
+            with timer( 'gif' ):
+                gif_writer.add_frame( frame_image, progress.rounded_score )
+        yield FinchFrame(
+            report_string = progress.report_string,
+            generation_index = progress.generation_index,
+            rounded_score = progress.rounded_score,
+            image = frame_image,
         )
-        new_fitness = get_fitness( specimen = new_specimen, target_image = target_image )
-        new_rounded_score = round( new_fitness * 100 * SCORE_MULTIPLIER )
-
-        # Only keep the new version if it is an improvement
-        if new_rounded_score >= rounded_score:
-            n_iterations_with_same_score += 1
-        else:
-            n_iterations_with_same_score = 0
-            fitness = new_fitness
-            rounded_score = new_rounded_score
-            specimen = new_specimen
-            diff_image = get_absolute_difference_image( specimen.cached_image, target_image )
-
-        current_update_time = datetime.now()
-        update_time_microseconds = ( current_update_time - last_update_time ).microseconds
-        last_update_time = current_update_time
-
-        report_string = f'gen_{generation_index:06d}__dt_{update_time_microseconds}_ms__score_{rounded_score}'
-
-        if LOG_SCORES:
-            logger.info( report_string )
-
-        # We only write images if they show enough improvement compared to the last written one
-        if last_written_score - rounded_score >= SCORE_INTERVAL :
-            write_results( report_string, specimen.cached_image, specimen )
-            last_written_score = rounded_score
-            if MAKE_GIF:
-                result_frames.append( specimen.cached_image.copy() )
-
-        # If ran out of patience, write the final result, and break
-        ran_out_of_patience = n_iterations_with_same_score == N_ITERATIONS_PATIENCE
-        reached_termination_score = rounded_score <= TERMINATION_SCORE
-        if ( ran_out_of_patience or reached_termination_score ):
-            write_results( report_string, specimen.cached_image, specimen)
-            if ran_out_of_patience:
-                logger.info( 'Ran out of patience.' )
-            else:
-                logger.info( 'Reached termination score.' )
-            break
-
-    # make sure to include the last frame in the GIF,
-    # even though it did not meet the score_interval
-    if MAKE_GIF :
-        result_frames.append( specimen.cached_image.copy() )
 
     end_time = datetime.now()
     convergence_time = end_time - start_time
     logger.info( f'Converged in {convergence_time.seconds} seconds.' )
 
-    logger.info( 'Creating 4K version' )
-    result_4k = redraw_painting_at_4k( specimen = specimen )
-
-    if WRITE_OUTPUT:
-        output_path_4k = f'{DEFAULT_OUTPUT_DIRECTORY_PATH}/___final_result_4k.png'
-        cv2.imwrite( output_path_4k, result_4k )
+    set_count( 'final_strokes', len( specimen.brushes ) )
+
+    if checkpointer is not None:
+        rounded_score = get_rounded_score( IncrementalFitness( specimen.cached_image, target_image ).fitness )
+        checkpointer.write( specimen, state, rounded_score, context, is_converged = True )
+
+    with ThreadPoolExecutor( max_workers = N_OUTPUT_WORKERS ) as executor:
+        # The animation is encoded while the 4K version is painted,
+        # make sure to include the last frame in the GIF, even though it did not meet the score_interval
+        animation_future = None
+        if gif_writer is not None:
+            animation_future = submit_animation( executor, gif_writer, specimen.cached_image, output_options )
+
+        logger.info( 'Creating 4K version' )
+        finish_start_time = time.perf_counter()
+        with timer( 'redraw_4k' ):
+            result_4k = redraw_painting_at_4k( specimen = specimen )
+        BRUSH_STAMP_CACHE.log_stats()
+
+        outputs = encode_outputs( executor, result_4k, animation_future, output_options )
+    # Budgets of later paintings reserve time to finish, based on how long this took
+    FINISH_TIME_ESTIMATOR.record( len( specimen.brushes ), time.perf_counter() - finish_start_time )
+
+    if settings.write_output:
+        output_path_4k = f'{DEFAULT_OUTPUT_DIRECTORY_PATH}/___final_result_4k{output_options.image_format.extension}'
+        with open( output_path_4k, 'wb' ) as f :
+            f.write( outputs.image_4k )
         logger.info( f'Wrote 4k result to {output_path_4k}' )
 
-    if MAKE_GIF:
-        output_path_gif = f'{DEFAULT_OUTPUT_DIRECTORY_PATH}/___final_result_gif.gif'
-        gif_buffer = make_gif(result_frames)
-        logger.info( f'Wrote GIF result to {output_path_gif}' )
-
-        if WRITE_OUTPUT:
-            with open( output_path_gif, 'wb' ) as f :
-                f.write( gif_buffer )
+        if outputs.animation is not None:
+            output_path_animation = f'{DEFAULT_OUTPUT_DIRECTORY_PATH}/___final_result_animation{output_options.animation_format.extension}'
+            with open( output_path_animation, 'wb' ) as f :
+                f.write( outputs.animation )
+            logger.info( f'Wrote animation result to {output_path_animation}' )
+
+    logger.info( 'DONE!' )
+    yield FinchResult(
+        image_4k = outputs.image_4k,
+        animation = outputs.animation,
+        brushes = specimen.brushes,
+        output_options = output_options,
+    )
 
-        logger.info( f'DONE!' )
-        return result_4k, gif_buffer
 
-    logger.info( f'DONE!' )
-    return result_4k
+def get_algorithm_parameters(
+        tiled : bool,
+        pyramid : bool,
+        settings : RunSettings,
+        tunables : EvolutionTunables,
+        output_options : OutputOptions,
+        budget : Optional[ RunBudget ] = None,
+) -> dict:
+    """
+    Returns all settings that affect the result of a painting, apart from the image and brush set.
+    """
+    parameters = {
+        'fixed_random_seed' : FIXED_RANDOM_SEED,
+        'make_gif' : settings.make_gif,
+        **asdict( tunables ),
+        # The size budget is applied to cached results after the lookup, see run_finch_streaming
+        **{ f'output_{name}' : value for name, value in asdict( output_options ).items() if name != 'max_size_bytes' },
+        'stamp_size_quantization_step' : brush.STAMP_SIZE_QUANTIZATION_STEP,
+        'stamp_angle_quantization_step_degrees' : brush.STAMP_ANGLE_QUANTIZATION_STEP_DEGREES,
+        'enable_occlusion_culling' : redraw.ENABLE_OCCLUSION_CULLING,
+        'occlusion_max_transmittance' : occlusion.OCCLUSION_MAX_TRANSMITTANCE,
+        'occlusion_margin_pixels' : occlusion.OCCLUSION_MARGIN_PIXELS,
+        'tiled' : tiled,
+    }
+    if budget is not None:
+        parameters.update( { f'budget_{name}' : value for name, value in asdict( budget ).items() } )
+    # The tiled result does not depend on the number of workers, only on the tiles
+    if tiled:
+        parameters.update( {
+            'tile_size' : tiled_engine.TILE_SIZE,
+            'tile_overlap' : tiled_engine.TILE_OVERLAP,
+            'seam_half_width' : tiled_engine.SEAM_HALF_WIDTH,
+        } )
+    elif pyramid:
+        parameters.update( {
+            'pyramid_levels' : repr( pyramid_engine.PYRAMID_LEVELS ),
+            'pyramid_min_level_size' : pyramid_engine.PYRAMID_MIN_LEVEL_SIZE,
+        } )
+    return parameters
+
+
+def run_finch_streaming(
+        image : np.ndarray,
+        brush_set_name : str,
+        tiled : bool = False,
+        n_tile_workers : Optional[int] = None,
+        pyramid : bool = False,
+        settings : RunSettings = RunSettings(),
+        tunables : EvolutionTunables = EvolutionTunables(),
+        output_options : OutputOptions = OutputOptions(),
+        budget : Optional[ RunBudget ] = None,
+        checkpoint_path : Optional[ Path ] = None,
+) -> Iterator[ FinchFrame | FinchResult ]:
+    normalized_image = normalize_image_size( image )
 
+    brush_set = str_to_brush_set( brush_set_name )
 
+    # Results of budgets that depend on time are not reproducible, so they are neither cached nor looked up.
+    # Checkpointed paintings always run, so that their checkpoints are written.
+    use_result_cache = (
+        settings.use_result_cache
+        and ( budget is None or budget.is_deterministic )
+        and checkpoint_path is None
+    )
+    if not use_result_cache:
+        yield from run_finch_generator(
+            target_image = normalized_image,
+            brush_set = brush_set,
+            tiled = tiled,
+            n_tile_workers = n_tile_workers,
+            pyramid = pyramid,
+            settings = settings,
+            tunables = tunables,
+            output_options = output_options,
+            budget = budget,
+            checkpoint_path = checkpoint_path,
+        )
+        return
 
-def run_finch( image : np.ndarray, brush_set_name : str ) -> np.ndarray:
-    normalized_image = normalize_image_size( image )
+    # The painting is deterministic, so results for the same input can be reused.
+    # Results are cached without a size budget, so that paintings which only differ in their budgets share them.
+    cache_key = get_result_cache_key(
+        normalized_image, brush_set.name, get_algorithm_parameters( tiled, pyramid, settings, tunables, output_options, budget )
+    )
+    cached_result = RESULT_CACHE.get( cache_key )
+    RESULT_CACHE.log_stats()
+    if cached_result is not None:
+        logger.info( f'Found result {cache_key} in the cache.' )
+        yield _get_result_in_size_budget( cached_result, output_options, from_cache = True )
+        return
 
-    brush_set = str_to_brush_set( brush_set_name )
-    result = run_finch_generator(
+    for item in run_finch_generator(
         target_image = normalized_image,
-        brush_set = brush_set
+        brush_set = brush_set,
+        tiled = tiled,
+        n_tile_workers = n_tile_workers,
+        pyramid = pyramid,
+        settings = settings,
+        tunables = tunables,
+        output_options = replace( output_options, max_size_bytes = None ),
+        budget = budget,
+    ):
+        if isinstance( item, FinchResult ):
+            cached_result = CachedResult( image_4k = item.image_4k, animation = item.animation, brushes = item.brushes )
+            RESULT_CACHE.put( cache_key, cached_result )
+            item = _get_result_in_size_budget( cached_result, output_options )
+        yield item
+
+
+def _get_result_in_size_budget( cached_result : CachedResult, output_options : OutputOptions, from_cache : bool = False ) -> FinchResult:
+    outputs = fit_encoded_outputs( EncodedOutputs( image_4k = cached_result.image_4k, animation = cached_result.animation ), output_options )
+    return FinchResult(
+        image_4k = outputs.image_4k,
+        animation = outputs.animation,
+        brushes = cached_result.brushes,
+        output_options = output_options,
+        from_cache = from_cache,
     )
+
+
+def run_finch(
+        image : np.ndarray,
+        brush_set_name : str,
+        tiled : bool = False,
+        n_tile_workers : Optional[int] = None,
+        pyramid : bool = False,
+        settings : RunSettings = RunSettings(),
+        tunables : EvolutionTunables = EvolutionTunables(),
+        output_options : OutputOptions = OutputOptions(),
+        budget : Optional[ RunBudget ] = None,
+        checkpoint_path : Optional[ Path ] = None,
+) -> FinchResult:
+    for item in run_finch_streaming(
+        image = image,
+        brush_set_name = brush_set_name,
+        tiled = tiled,
+        n_tile_workers = n_tile_workers,
+        pyramid = pyramid,
+        settings = settings,
+        tunables = tunables,
+        output_options = output_options,
+        budget = budget,
+        checkpoint_path = checkpoint_path,
+    ):
+        if isinstance( item, FinchResult ):
+            result = item
     return result
@@ -1,4 +1,6 @@
-from finch.primitive_types import Point, Image
+from typing import Optional
+
+from finch.primitive_types import Point, Image, Roi
 
 import numpy as np
 
@@ -9,3 +11,76 @@ def sample_weighted_position_from_image( diff_image : Image ) -> Point:
     random_flat_index = np.random.choice(flat_weights.size, p=flat_probabilities )
     position = np.unravel_index( random_flat_index, diff_image.shape )
     return Point( int( position[1]), int(position[0]) )
+
+
+class WeightedPositionSampler:
+    """
+    Samples positions with a probability proportional to the value of a weight image,
+    without renormalizing the full image for every sample.
+    The weights are summed per row, so that a sample only needs a binary search over the rows,
+    followed by a binary search within a single row.
+    The weight image is referenced, not copied.
+    Whenever it is changed, update_roi should be called for the changed region.
+    An optional mask of zeros and ones restricts sampling to part of the image.
+    Random numbers are drawn from the given generator, or from the global one of numpy.
+    """
+
+    def __init__( self, weight_image : Image, mask : Optional[ Image ] = None, rng : Optional[ np.random.RandomState ] = None ) :
+        self._rng = rng if rng is not None else np.random
+        self._weight_image = weight_image if mask is None else weight_image * mask
+        self._source_weight_image = weight_image
+        self._mask = mask
+        self._row_sums = np.sum( self._weight_image, axis = 1, dtype = np.int64 )
+        self._cumulative_row_sums = None
+
+
+    def update_roi( self, roi : Roi ) -> None:
+        rows = slice( roi.y_min, roi.y_max )
+        if self._mask is not None:
+            roi_slices = roi.slices()
+            self._weight_image[ roi_slices ] = self._source_weight_image[ roi_slices ] * self._mask[ roi_slices ]
+        self._row_sums[ rows ] = np.sum( self._weight_image[ rows ], axis = 1, dtype = np.int64 )
+        self._cumulative_row_sums = None
+
+
+    def sample( self ) -> Point:
+        if self._cumulative_row_sums is None:
+            self._cumulative_row_sums = np.cumsum( self._row_sums )
+
+        total_weight = int( self._cumulative_row_sums[ -1 ] )
+        if total_weight == 0:
+            # Nothing left to prefer, so every position is equally likely
+            height, width = self._weight_image.shape[:2]
+            return Point( int( self._rng.randint( width ) ), int( self._rng.randint( height ) ) )
+
+        # Searching to the right makes sure that positions without weight can never be selected
+        random_weight = self._rng.randint( total_weight )
+        y = int( np.searchsorted( self._cumulative_row_sums, random_weight, side = 'right' ) )
+        if y > 0:
+            random_weight -= self._cumulative_row_sums[ y - 1 ]
+
+        cumulative_row_weights = np.cumsum( self._weight_image[ y ], dtype = np.int64 )
+        x = int( np.searchsorted( cumulative_row_weights, random_weight, side = 'right' ) )
+        return Point( x, y )
+
+
+    def sample_many( self, n : int ) -> tuple[ np.ndarray, np.ndarray ]:
+        """
+        Draws n independent samples at once, returned as arrays of x and y coordinates.
+        """
+        if self._cumulative_row_sums is None:
+            self._cumulative_row_sums = np.cumsum( self._row_sums )
+
+        total_weight = int( self._cumulative_row_sums[ -1 ] )
+        if total_weight == 0:
+            height, width = self._weight_image.shape[:2]
+            return self._rng.randint( width, size = n ), self._rng.randint( height, size = n )
+
+        random_weights = self._rng.randint( total_weight, size = n )
+        ys = np.searchsorted( self._cumulative_row_sums, random_weights, side = 'right' )
+        row_offsets = np.where( ys > 0, self._cumulative_row_sums[ ys - 1 ], 0 )
+        random_weights -= row_offsets
+
+        cumulative_row_weights = np.cumsum( self._weight_image[ ys ], axis = 1, dtype = np.int64 )
+        xs = np.sum( cumulative_row_weights <= random_weights[ :, np.newaxis ], axis = 1 )
+        return xs, ys
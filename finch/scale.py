@@ -9,9 +9,12 @@ from finch.primitive_types import Image
 logger= logging.getLogger(__name__)
 
 
-def normalize_image_size( image : Image, max_dimension = 640 ) -> Image:
+MAX_IMAGE_DIMENSION = 640
+
+
+def normalize_image_size( image : Image, max_dimension = MAX_IMAGE_DIMENSION ) -> Image:
     height, width = image.shape[:2]
-    if ( width <= 640 ) and ( height <= 640 ):
+    if ( width <= max_dimension ) and ( height <= max_dimension ):
         logger.info( f"Image is not resized. Its size is ({width}*{height})." )
         return image
     aspect_ratio = width / height
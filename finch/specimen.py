@@ -1,23 +1,54 @@
 from dataclasses import dataclass, field
 
-from finch.primitive_types import Image
-from finch.brush import Brush
+from finch.primitive_types import Image, Roi
+from finch.brush import Brush, BrushBank, draw_brush_on_image, get_brush_roi
+from finch.instrumentation import timer
+from finch.stroke_log import StrokeLog
+
+
+@dataclass
+class Mutation :
+    brush: Brush
+    roi: Roi
+    # The part of the cached image that was overwritten by the brush
+    previous_patch: Image
 
 
 @dataclass
 class Specimen :
     cached_image: Image
+    # The textures that the brushes refer to
+    brush_bank: BrushBank
 
     # The brushes are basically the genes of the specimen.
     # We do not actually use them in the algorithm,
     # because we can directly draw changes on top of the cached image
     # But storing this info allows for better inspection,
-    # and to later redraw the image with different settings, if pickled.
+    # and to later redraw the image with different settings, if serialized.
     # For that, see common.redraw.redraw_painting
-    brushes: list[ Brush ] = field( default_factory = list )
+    brushes: StrokeLog = field( default_factory = StrokeLog )
 
     def copy( self ) -> "Specimen":
         return Specimen(
             cached_image=self.cached_image.copy(),
-            brushes=[ brush.copy() for brush in self.brushes ]
+            brush_bank=self.brush_bank,
+            brushes=self.brushes.copy()
         )
+
+    def draw_brush( self, brush : Brush ) -> Mutation:
+        """
+        Draws the brush directly on the cached image.
+        Only the overwritten patch is stored, so that the mutation can be rolled back cheaply.
+        The brush is only added to the genes once the mutation is accepted.
+        """
+        roi = get_brush_roi( brush, *self.cached_image.shape[:2] )
+        previous_patch = self.cached_image[ roi.slices() ].copy()
+        with timer( 'draw' ):
+            draw_brush_on_image( brush = brush, image = self.cached_image, brush_bank = self.brush_bank )
+        return Mutation( brush = brush, roi = roi, previous_patch = previous_patch )
+
+    def accept( self, mutation : Mutation ) -> None:
+        self.brushes.append( mutation.brush )
+
+    def rollback( self, mutation : Mutation ) -> None:
+        self.cached_image[ mutation.roi.slices() ] = mutation.previous_patch
@@ -0,0 +1,246 @@
+from typing import Iterator
+
+import numpy as np
+
+from finch.brush import Brush
+from finch.primitive_types import Point
+
+
+# Every column is stored with an explicit byte order, so serialized logs can be read on any machine
+STROKE_LOG_COLUMNS : dict[ str, np.dtype ] = {
+    'xs' : np.dtype( '<i4' ),
+    'ys' : np.dtype( '<i4' ),
+    'sizes' : np.dtype( '<i4' ),
+    'angles' : np.dtype( '<f8' ),
+    'texture_indices' : np.dtype( '<u2' ),
+    'colors' : np.dtype( 'u1' ),
+}
+N_COLOR_CHANNELS = 3
+
+STROKE_LOG_MAGIC = b'FSTK'
+STROKE_LOG_FORMAT_VERSION = 1
+STROKE_LOG_HEADER_DTYPE = np.dtype( [ ( 'magic', 'S4' ), ( 'version', '<u4' ), ( 'n_strokes', '<u8' ) ] )
+
+INITIAL_CAPACITY = 1024
+
+
+class StrokeLog:
+    """
+    The brushes of a painting, stored as a struct of arrays instead of a list of Brush objects.
+    Appending grows the columns geometrically, so appends are amortized O(1),
+    and every brush only costs a few dozen bytes.
+    The log can be rolled back to an earlier length, see snapshot and rollback.
+    Iterating or indexing returns Brush objects, which are copies of the stored values.
+    """
+
+    def __init__( self, capacity : int = INITIAL_CAPACITY ) :
+        self._n_strokes = 0
+        self._columns = {
+            name : np.empty( self._get_column_shape( name, max( 1, capacity ) ), dtype = dtype )
+            for name, dtype in STROKE_LOG_COLUMNS.items()
+        }
+
+
+    @staticmethod
+    def _get_column_shape( name : str, length : int ) -> tuple[ int, ... ]:
+        if name == 'colors':
+            return ( length, N_COLOR_CHANNELS )
+        return ( length, )
+
+
+    @classmethod
+    def from_brushes( cls, brushes : list[ Brush ] ) -> "StrokeLog":
+        stroke_log = cls( capacity = len( brushes ) )
+        for brush in brushes:
+            stroke_log.append( brush )
+        return stroke_log
+
+
+    def __len__( self ) -> int:
+        return self._n_strokes
+
+
+    @property
+    def capacity( self ) -> int:
+        return len( self._columns[ 'xs' ] )
+
+
+    @property
+    def nbytes( self ) -> int:
+        return sum( column[ :self._n_strokes ].nbytes for column in self._columns.values() )
+
+
+    def _reserve( self, n_strokes : int ) -> None:
+        if n_strokes <= self.capacity:
+            return
+        new_capacity = max( n_strokes, 2 * self.capacity )
+        for name, column in self._columns.items():
+            new_column = np.empty( self._get_column_shape( name, new_capacity ), dtype = column.dtype )
+            new_column[ :self._n_strokes ] = column[ :self._n_strokes ]
+            self._columns[ name ] = new_column
+
+
+    def append( self, brush : Brush ) -> None:
+        self._reserve( self._n_strokes + 1 )
+        index = self._n_strokes
+        self._columns[ 'xs' ][ index ] = brush.position.x
+        self._columns[ 'ys' ][ index ] = brush.position.y
+        self._columns[ 'sizes' ][ index ] = brush.size
+        self._columns[ 'angles' ][ index ] = brush.angle
+        self._columns[ 'texture_indices' ][ index ] = brush.texture_index
+        self._columns[ 'colors' ][ index ] = brush.color
+        self._n_strokes += 1
+
+
+    def extend( self, other : "StrokeLog" ) -> None:
+        self._reserve( self._n_strokes + len( other ) )
+        new_n_strokes = self._n_strokes + len( other )
+        for name, column in self._columns.items():
+            column[ self._n_strokes : new_n_strokes ] = other.get_column( name )
+        self._n_strokes = new_n_strokes
+
+
+    def get_column( self, name : str ) -> np.ndarray:
+        """
+        Returns a view of the used part of a column, see STROKE_LOG_COLUMNS for the names.
+        """
+        return self._columns[ name ][ :self._n_strokes ]
+
+
+    @property
+    def xs( self ) -> np.ndarray:
+        return self.get_column( 'xs' )
+
+
+    @property
+    def ys( self ) -> np.ndarray:
+        return self.get_column( 'ys' )
+
+
+    @property
+    def sizes( self ) -> np.ndarray:
+        return self.get_column( 'sizes' )
+
+
+    @property
+    def angles( self ) -> np.ndarray:
+        return self.get_column( 'angles' )
+
+
+    @property
+    def texture_indices( self ) -> np.ndarray:
+        return self.get_column( 'texture_indices' )
+
+
+    @property
+    def colors( self ) -> np.ndarray:
+        return self.get_column( 'colors' )
+
+
+    def __getitem__( self, index : int ) -> Brush:
+        if index < 0:
+            index += self._n_strokes
+        if not 0 <= index < self._n_strokes:
+            raise IndexError( f'Stroke index {index} out of range for {self._n_strokes} strokes.' )
+        color = self._columns[ 'colors' ][ index ]
+        return Brush(
+            color = ( int( color[ 0 ] ), int( color[ 1 ] ), int( color[ 2 ] ) ),
+            texture_index = int( self._columns[ 'texture_indices' ][ index ] ),
+            position = Point( int( self._columns[ 'xs' ][ index ] ), int( self._columns[ 'ys' ][ index ] ) ),
+            angle = float( self._columns[ 'angles' ][ index ] ),
+            size = int( self._columns[ 'sizes' ][ index ] ),
+        )
+
+
+    def __iter__( self ) -> Iterator[ Brush ]:
+        # Converting whole columns at once is much faster than converting every value on its own
+        for x, y, size, angle, texture_index, color in zip(
+            self.xs.tolist(),
+            self.ys.tolist(),
+            self.sizes.tolist(),
+            self.angles.tolist(),
+            self.texture_indices.tolist(),
+            self.colors.tolist(),
+        ):
+            yield Brush(
+                color = tuple( color ),
+                texture_index = texture_index,
+                position = Point( x, y ),
+                angle = angle,
+                size = size,
+            )
+
+
+    def snapshot( self ) -> int:
+        """
+        Returns a marker that can be passed to rollback, to undo all later appends.
+        """
+        return self._n_strokes
+
+
+    def rollback( self, snapshot : int ) -> None:
+        self._n_strokes = min( snapshot, self._n_strokes )
+
+
+    def translate( self, dx : int, dy : int ) -> None:
+        self.xs[ ... ] += dx
+        self.ys[ ... ] += dy
+
+
+    def scaled( self, scale : float ) -> "StrokeLog":
+        """
+        Returns a copy with positions and sizes scaled, truncated to integers like finch.redraw does.
+        """
+        stroke_log = self.copy()
+        for name in [ 'xs', 'ys', 'sizes' ]:
+            column = stroke_log.get_column( name )
+            column[ ... ] = ( column * scale ).astype( column.dtype )
+        return stroke_log
+
+
+    def copy( self ) -> "StrokeLog":
+        stroke_log = StrokeLog( capacity = self._n_strokes )
+        stroke_log.extend( self )
+        return stroke_log
+
+
+    def to_bytes( self ) -> bytes:
+        """
+        Serializes the log as a small header, followed by the raw contents of every column.
+        """
+        header = np.array( [ ( STROKE_LOG_MAGIC, STROKE_LOG_FORMAT_VERSION, self._n_strokes ) ], dtype = STROKE_LOG_HEADER_DTYPE )
+        chunks = [ header.tobytes() ]
+        chunks.extend( self.get_column( name ).tobytes() for name in STROKE_LOG_COLUMNS )
+        return b''.join( chunks )
+
+
+    @classmethod
+    def from_bytes( cls, data : bytes ) -> "StrokeLog":
+        header = np.frombuffer( data, dtype = STROKE_LOG_HEADER_DTYPE, count = 1 )[ 0 ]
+        if header[ 'magic' ] != STROKE_LOG_MAGIC:
+            raise ValueError( 'Data is not a serialized stroke log.' )
+        if header[ 'version' ] != STROKE_LOG_FORMAT_VERSION:
+            raise ValueError( f'Unsupported stroke log format version {header[ "version" ]}.' )
+
+        n_strokes = int( header[ 'n_strokes' ] )
+        stroke_log = cls( capacity = n_strokes )
+        offset = STROKE_LOG_HEADER_DTYPE.itemsize
+        for name, dtype in STROKE_LOG_COLUMNS.items():
+            shape = cls._get_column_shape( name, n_strokes )
+            count = int( np.prod( shape ) )
+            column = np.frombuffer( data, dtype = dtype, count = count, offset = offset ).reshape( shape )
+            stroke_log._columns[ name ][ :n_strokes ] = column
+            offset += column.nbytes
+        stroke_log._n_strokes = n_strokes
+        return stroke_log
+
+
+    def __getstate__( self ) -> bytes:
+        # Used when logs are sent between processes, which avoids sending the unused capacity
+        return self.to_bytes()
+
+
+    def __setstate__( self, state : bytes ) -> None:
+        stroke_log = StrokeLog.from_bytes( state )
+        self._n_strokes = stroke_log._n_strokes
+        self._columns = stroke_log._columns
@@ -0,0 +1,286 @@
+import logging
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from multiprocessing import shared_memory
+import os
+import time
+from typing import Iterator, Optional
+
+import numpy as np
+
+from finch.brush import draw_brush_on_image
+from finch.brush_bank import BrushSet, get_brush_bank
+from finch.budget import FINISH_SECONDS_PER_STROKE, ConvergenceController, RunBudget
+from finch.context import EngineContext, EvolutionTunables, RunSettings
+from finch.evolution import EvolutionProgress, evolve_specimen_inplace, get_rounded_score
+from finch.fitness import IncrementalFitness
+from finch.image_gradient import ImageGradient
+from finch.primitive_types import Image, Roi
+from finch.specimen import Specimen
+from finch.stroke_log import StrokeLog
+
+
+N_TILE_WORKERS : int = os.cpu_count() or 1
+TILE_SIZE : int = 160
+TILE_OVERLAP : int = 16
+# After painting the tiles, the seams between them are painted over,
+# by only allowing new brushes within this distance of a tile border.
+SEAM_HALF_WIDTH : int = TILE_OVERLAP
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SharedArrayInfo:
+    name : str
+    shape : tuple[ int, ... ]
+    dtype : str
+
+
+class SharedArray:
+    """
+    A numpy array backed by shared memory,
+    so that worker processes can use it without it being pickled.
+    """
+
+    def __init__( self, array : np.ndarray ) :
+        self._shared_memory = shared_memory.SharedMemory( create = True, size = max( 1, array.nbytes ) )
+        self.array = np.ndarray( array.shape, dtype = array.dtype, buffer = self._shared_memory.buf )
+        self.array[ ... ] = array
+        self.info = SharedArrayInfo( self._shared_memory.name, array.shape, array.dtype.str )
+
+    def release( self ) -> None:
+        del self.array
+        self._shared_memory.close()
+        self._shared_memory.unlink()
+
+
+@dataclass
+class TileJob:
+    tile : Roi
+    seed : int
+    target_image : SharedArrayInfo
+    gradient_angles : SharedArrayInfo
+    gradient_magnitudes : SharedArrayInfo
+    canvas : SharedArrayInfo
+    brush_set : BrushSet
+    # Brushes are sized for the full painting, not for the tile, see finch.brush.get_brush_size_for_fitness
+    image_shape : tuple[ int, int ]
+    settings : RunSettings
+    tunables : EvolutionTunables
+    # The wall clock time at which the evolution of the tiles has to stop, apart from the time to finish their strokes,
+    # see finch.budget
+    deadline_time : Optional[ float ] = None
+    n_phase_tiles : int = 1
+
+
+def _get_tile_starts( length : int ) -> list[ int ]:
+    stride = TILE_SIZE - TILE_OVERLAP
+    starts = list( range( 0, max( 1, length - TILE_OVERLAP ), stride ) )
+    return starts
+
+
+def get_tiles( image_height : int, image_width : int ) -> list[ tuple[ int, int, Roi ] ]:
+    """
+    Splits the image in overlapping tiles, returned as ( row index, column index, tile ).
+    """
+    tiles = []
+    for row_index, y_min in enumerate( _get_tile_starts( image_height ) ):
+        for column_index, x_min in enumerate( _get_tile_starts( image_width ) ):
+            tile = Roi(
+                y_min = y_min,
+                y_max = min( y_min + TILE_SIZE, image_height ),
+                x_min = x_min,
+                x_max = min( x_min + TILE_SIZE, image_width ),
+            )
+            tiles.append( ( row_index, column_index, tile ) )
+    return tiles
+
+
+def _get_seam_mask( image_height : int, image_width : int, tiles : list[ tuple[ int, int, Roi ] ] ) -> Image:
+    seam_mask = np.zeros( ( image_height, image_width ), dtype = np.uint8 )
+    for _, _, tile in tiles:
+        if tile.y_min > 0:
+            seam_mask[ max( 0, tile.y_min - SEAM_HALF_WIDTH ) : tile.y_min + TILE_OVERLAP + SEAM_HALF_WIDTH, : ] = 1
+        if tile.x_min > 0:
+            seam_mask[ :, max( 0, tile.x_min - SEAM_HALF_WIDTH ) : tile.x_min + TILE_OVERLAP + SEAM_HALF_WIDTH ] = 1
+    return seam_mask
+
+
+def _attach_shared_array( info : SharedArrayInfo ) -> tuple[ shared_memory.SharedMemory, np.ndarray ]:
+    shared = shared_memory.SharedMemory( name = info.name )
+    array = np.ndarray( info.shape, dtype = np.dtype( info.dtype ), buffer = shared.buf )
+    return shared, array
+
+
+def _initialize_tile_worker( brush_set : BrushSet ) -> None:
+    get_brush_bank( brush_set )
+
+
+def _evolve_tile( job : TileJob ) -> StrokeLog:
+    """
+    Runs in a worker process.
+    Paints directly on the shared canvas, within the bounds of the tile,
+    and returns the accepted brushes in canvas space.
+    """
+    context = EngineContext.create(
+        brush_set = job.brush_set,
+        settings = job.settings,
+        tunables = job.tunables,
+        seed = job.seed,
+    )
+    if job.deadline_time is not None:
+        # The strokes of all tiles of the phase have to be finished, assume they have as many strokes as this one
+        context.controller = ConvergenceController(
+            RunBudget(),
+            deadline_time = job.deadline_time,
+            finish_seconds_base = 0.0,
+            finish_seconds_per_stroke = FINISH_SECONDS_PER_STROKE * job.n_phase_tiles,
+        )
+
+    attached = [
+        _attach_shared_array( info )
+        for info in [ job.target_image, job.gradient_angles, job.gradient_magnitudes, job.canvas ]
+    ]
+    try:
+        target_image, gradient_angles, gradient_magnitudes, canvas = [ array for _, array in attached ]
+        tile_slices = job.tile.slices()
+        specimen = Specimen( cached_image = canvas[ tile_slices ], brush_bank = context.brush_bank )
+        tile_gradient = ImageGradient.from_fields( gradient_angles[ tile_slices ], gradient_magnitudes[ tile_slices ] )
+        for _ in evolve_specimen_inplace(
+            specimen = specimen,
+            target_image = target_image[ tile_slices ],
+            target_gradient = tile_gradient,
+            context = context,
+            brush_size_image_shape = job.image_shape,
+        ):
+            pass
+
+        brushes = specimen.brushes
+        brushes.translate( job.tile.x_min, job.tile.y_min )
+
+        del specimen, tile_gradient, target_image, gradient_angles, gradient_magnitudes, canvas
+        return brushes
+    finally:
+        attached_shared_memory = [ shared for shared, _ in attached ]
+        del attached
+        for shared in attached_shared_memory:
+            shared.close()
+
+
+def evolve_specimen_tiled_inplace(
+        specimen : Specimen,
+        target_image : Image,
+        target_gradient : ImageGradient,
+        context : EngineContext,
+        n_workers : int,
+) -> Iterator[ EvolutionProgress ]:
+    """
+    Paints the specimen by evolving overlapping tiles in parallel worker processes.
+    The target, gradient and canvas are shared with the workers through shared memory.
+    Overlapping tiles are never painted at the same time:
+    tiles are painted in four phases, based on the parity of their row and column.
+    Each tile uses its own seed, based on the seed of the context, so the result does not depend on the number of workers.
+    Brushes are sized for the full painting, so tiles are painted with the same strokes as the painting would be.
+    Afterwards, the canvas is redrawn from the brushes, and the seams between tiles are painted over,
+    until the painting reaches the termination score of the tunables.
+    Progress is reported after every phase, and during the final pass over the seams.
+    If the painting has a budget, only its deadline applies within the tiles, and no new phases start once it stops;
+    all its limits apply to the pass over the seams.
+    """
+    image_height, image_width = target_image.shape[:2]
+    brush_set = context.brush_bank.brush_set
+    tiles = get_tiles( image_height, image_width )
+    logger.info( f'Painting {len( tiles )} tiles using {n_workers} workers.' )
+
+    controller = context.controller
+    initial_image = specimen.cached_image.copy()
+    gradient_angles, gradient_magnitudes = target_gradient.fields
+    shared_arrays = [
+        SharedArray( np.ascontiguousarray( array ) )
+        for array in [ target_image, gradient_angles, gradient_magnitudes, specimen.cached_image ]
+    ]
+    shared_target_image, shared_gradient_angles, shared_gradient_magnitudes, shared_canvas = shared_arrays
+
+    tile_brushes = StrokeLog()
+    try:
+        with ProcessPoolExecutor(
+            max_workers = n_workers,
+            initializer = _initialize_tile_worker,
+            initargs = ( brush_set, )
+        ) as executor:
+            phases = [ ( 0, 0 ), ( 0, 1 ), ( 1, 0 ), ( 1, 1 ) ]
+            for phase_index, phase in enumerate( phases ):
+                deadline_time = None
+                if controller is not None:
+                    stop_reason = controller.get_stop_reason()
+                    if stop_reason is not None:
+                        logger.info( f'Skipping the remaining phases of tiles. {stop_reason}' )
+                        break
+                    evolution_deadline_time = controller.get_evolution_deadline_time()
+                    if evolution_deadline_time is not None:
+                        # The time that is left is shared by the remaining phases and the pass over the seams
+                        n_remaining_passes = len( phases ) - phase_index + 1
+                        now = time.time()
+                        deadline_time = now + ( evolution_deadline_time - now ) / n_remaining_passes
+                phase_tiles = [
+                    ( tile_index, tile )
+                    for tile_index, ( row_index, column_index, tile ) in enumerate( tiles )
+                    if ( row_index % 2, column_index % 2 ) == phase
+                ]
+                jobs = [
+                    TileJob(
+                        tile = tile,
+                        seed = context.seed + tile_index,
+                        target_image = shared_target_image.info,
+                        gradient_angles = shared_gradient_angles.info,
+                        gradient_magnitudes = shared_gradient_magnitudes.info,
+                        canvas = shared_canvas.info,
+                        brush_set = brush_set,
+                        image_shape = ( image_height, image_width ),
+                        settings = context.settings,
+                        tunables = context.tunables,
+                        deadline_time = deadline_time,
+                        n_phase_tiles = len( phase_tiles ),
+                    )
+                    for tile_index, tile in phase_tiles
+                ]
+                # Results are returned in the order of the jobs, which keeps the brush order deterministic
+                for brushes in executor.map( _evolve_tile, jobs ):
+                    tile_brushes.extend( brushes )
+                    if controller is not None:
+                        controller.add_strokes( len( brushes ) )
+
+                specimen.cached_image[ ... ] = shared_canvas.array
+                fitness = IncrementalFitness( specimen.cached_image, target_image ).fitness
+                rounded_score = get_rounded_score( fitness )
+                yield EvolutionProgress(
+                    generation_index = 0,
+                    rounded_score = rounded_score,
+                    report_string = f'tiles_phase_{phase[ 0 ]}_{phase[ 1 ]}__score_{rounded_score}',
+                    is_final = False,
+                )
+    finally:
+        for shared_array in shared_arrays:
+            shared_array.release()
+
+    # Within each tile, brushes were clipped to the tile,
+    # so redraw them on the full canvas to make sure the canvas matches the brushes
+    specimen.cached_image[ ... ] = initial_image
+    for brush in tile_brushes:
+        draw_brush_on_image( brush = brush, image = specimen.cached_image, brush_bank = specimen.brush_bank )
+    specimen.brushes.extend( tile_brushes )
+    logger.info( f'Painted {len( tile_brushes )} brushes in tiles, now painting over the seams.' )
+
+    # The seams are painted with fresh random number generators, seeded like the context
+    seam_context = replace( context )
+    seam_mask = _get_seam_mask( image_height, image_width, tiles )
+    yield from evolve_specimen_inplace(
+        specimen = specimen,
+        target_image = target_image,
+        target_gradient = target_gradient,
+        context = seam_context,
+        sampling_mask = seam_mask,
+    )
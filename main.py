@@ -1,13 +1,25 @@
 import base64
+from dataclasses import dataclass
+import json
 import logging
+import math
+import secrets
 import sys
+from typing import Iterator, Optional
 
 import cv2
 from flask import Flask, jsonify, request as flask_request, Request, Response
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 import numpy as np
-from finch.main import run_finch, set_global_config, Config
+from finch.brush import str_to_brush_set
+from finch.brush_bank import preload_brush_banks
+from finch.ingest import ingest_upload, ImageDecodeError, ImageTooLargeError, MAX_IMAGE_PIXELS, MAX_UPLOAD_SIZE_BYTES, UploadTooLargeError
+from finch.instrumentation import instrument, timer
+from finch.jobs import Job, JobQueueFullError, JobScheduler, JobSchedulerUnavailableError, JobStatus
+from finch.main import run_finch, run_finch_streaming, Config, FinchFrame, FinchResult, RunBudget, RunSettings
 from finch.memory_size import get_size_mib
+from finch.output import AnimationFormat, ImageFormat, OutputOptions, OutputTooLargeError
 
 
 logger = logging.getLogger(__name__)
@@ -16,13 +28,45 @@ CORS(app)
 
 CORS_HEADERS = {
     'Access-Control-Allow-Origin' : '*',
-    'Access-Control-Allow-Methods' : 'POST, OPTIONS',
+    'Access-Control-Allow-Methods' : 'GET, POST, DELETE, OPTIONS',
     'Access-Control-Allow-Headers' : 'Content-Type',
-    'Access-Control-Max-Age' : '3600'
+    'Access-Control-Max-Age' : '3600',
+    'Access-Control-Expose-Headers' : 'X-Result-Cache, Server-Timing',
+    'Timing-Allow-Origin' : '*',
 }
 
 KEY_RESULT_IMAGE = 'result_image'
+# Also used for animated WebPs, the format of the results is given by the format keys
 KEY_RESULT_GIF = 'result_gif'
+KEY_RESULT_IMAGE_FORMAT = 'result_image_format'
+KEY_RESULT_ANIMATION_FORMAT = 'result_animation_format'
+KEY_FRAME_IMAGE = 'frame_image'
+KEY_SCORE = 'score'
+KEY_RESULT_CACHE = 'result_cache'
+
+RESPONSE_SIZE_LIMIT_MIB = 30
+# The image, plus some room for the other fields of the form
+MAX_REQUEST_SIZE_BYTES = MAX_UPLOAD_SIZE_BYTES + 64 * 1024
+app.config[ 'MAX_CONTENT_LENGTH' ] = MAX_REQUEST_SIZE_BYTES
+# Room for everything in a response apart from the encoded results
+RESPONSE_OVERHEAD_BYTES = 64 * 1024
+# Set this to somewhat less than the timeout of the function, so that paintings always return before it.
+# Requests can ask for shorter deadlines, but not for longer ones.
+MAX_DEADLINE_SECONDS : Optional[ float ] = None
+
+MIMETYPE_JSON = 'application/json'
+MIMETYPE_MULTIPART = 'multipart/mixed'
+
+# Every request gets its own engine context with these settings, so requests can be handled concurrently
+PROD_SETTINGS = RunSettings.from_config( Config.PROD )
+
+# Paintings submitted as jobs are painted in worker processes, see finch.jobs
+JOB_SCHEDULER = JobScheduler( config = Config.PROD )
+
+# Loaded while the instance starts, instead of during its first requests.
+# Worker processes that are forked later share the loaded textures.
+preload_brush_banks()
+
 
 def make_response( data : dict, code : int ) -> Response:
     data.update({ 'status_code' : code })
@@ -32,7 +76,7 @@ def make_response( data : dict, code : int ) -> Response:
 
     response_size_b = response.calculate_content_length()
     response_size_mib = response_size_b / ( 1024 * 1024 )
-    size_limit_mib = 30
+    size_limit_mib = RESPONSE_SIZE_LIMIT_MIB
     logging.info( f'Response size is {response_size_mib} MiB, limit is {size_limit_mib} MiB.' )
 
     if response_size_mib > size_limit_mib:
@@ -43,8 +87,7 @@ def make_response( data : dict, code : int ) -> Response:
     return response
 
 
-def make_error_response( message : str ) -> Response:
-    code = 400
+def make_error_response( message : str, code : int = 400 ) -> Response:
     logger.info( f'Made Error Response: Error: {message} - {code}.' )
     return make_response( { 'error' : message }, code )
 
@@ -59,55 +102,515 @@ def log_size(data : dict) -> None:
     logger.info(f"Combined size: {combined_size_mib}")
 
 
-def handle_request( request : Request ) -> Response:
+def encode_png_base64( image : np.ndarray ) -> str | None:
+    success, image_encoded = cv2.imencode( '.png', image )
+    if not success:
+        return None
+    return base64.b64encode( image_encoded ).decode( 'utf-8' )
+
+
+def make_event( event : str, data : dict ) -> str:
+    # See https://html.spec.whatwg.org/multipage/server-sent-events.html
+    return f'event: {event}\ndata: {json.dumps( data )}\n\n'
+
+
+def make_error_event( message : str ) -> str:
+    logger.info( f'Made Error Event: Error: {message}.' )
+    return make_event( 'error', { 'error' : message } )
+
+
+def get_result_cache_status( result : FinchResult ) -> str:
+    return 'hit' if result.from_cache else 'miss'
+
+
+def make_sized_event( event : str, data : dict ) -> str:
+    # Results are fitted to the size budget while they are encoded, so this only catches what the budget missed
+    event_string = make_event( event, data )
+    event_size_mib = get_size_mib( event_string )
+    logger.info( f'Event {event} size is {event_size_mib} MiB, limit is {RESPONSE_SIZE_LIMIT_MIB} MiB.' )
+    if event_size_mib > RESPONSE_SIZE_LIMIT_MIB:
+        return make_error_event( 'Result too big to return... Try different settings and images!' )
+    return event_string
+
+
+def generate_events(
+        image : np.ndarray,
+        brush_set : str,
+        tiled : bool,
+        pyramid : bool,
+        output_options : OutputOptions,
+        budget : Optional[ RunBudget ],
+) -> Iterator[ str ]:
+    """
+    Streams the intermediate frames of the painting as Server-Sent Events, followed by the final result.
+    The size of the result is not estimated before it is rendered. Instead, the output options carry the size budget
+    of the response, see get_output_size_budget_bytes, and the encoded image and animation are stepped down
+    until they fit it together, see finch.output.fit_outputs. Results that cannot fit end the stream with an error event.
+    Every event is still checked against the size limit on its own, as a last safeguard,
+    so an oversized result does not throw away the frames that were already sent.
+    """
+    try:
+        with instrument( 'streaming_painting' ):
+            yield from generate_painting_events( image, brush_set, tiled, pyramid, output_options, budget )
+    except OutputTooLargeError:
+        logger.exception( 'Result too big.' )
+        yield make_error_event( 'Result too big to return... Try different settings and images!' )
+    except Exception:
+        logger.exception( 'Processing - FAILED' )
+        yield make_error_event( 'Process on server failed. (The Developer is notified)' )
+
+
+def generate_painting_events(
+        image : np.ndarray,
+        brush_set : str,
+        tiled : bool,
+        pyramid : bool,
+        output_options : OutputOptions,
+        budget : Optional[ RunBudget ],
+) -> Iterator[ str ]:
+    for item in run_finch_streaming(
+        image = image,
+        brush_set_name = brush_set,
+        tiled = tiled,
+        pyramid = pyramid,
+        settings = PROD_SETTINGS,
+        output_options = output_options,
+        budget = budget,
+    ):
+        if isinstance( item, FinchFrame ):
+            with timer( 'encode_response' ):
+                frame_base64_string = encode_png_base64( item.image )
+            if frame_base64_string is None:
+                yield make_error_event( 'Failed to encode an intermediate result.' )
+                return
+            yield make_event( 'frame', { KEY_FRAME_IMAGE : frame_base64_string, KEY_SCORE : item.rounded_score } )
+            continue
+
+        with timer( 'encode_response' ):
+            result_image_event = make_sized_event( 'result_image', {
+                KEY_RESULT_IMAGE : base64.b64encode( item.image_4k ).decode( 'utf-8' ),
+                KEY_RESULT_IMAGE_FORMAT : item.output_options.image_format.value,
+            } )
+        yield result_image_event
+
+        if item.animation is not None:
+            with timer( 'encode_response' ):
+                result_gif_event = make_sized_event( 'result_gif', {
+                    KEY_RESULT_GIF : base64.b64encode( item.animation ).decode( 'utf-8' ),
+                    KEY_RESULT_ANIMATION_FORMAT : item.output_options.animation_format.value,
+                } )
+            yield result_gif_event
+        result_cache_status = get_result_cache_status( item )
+
+    yield make_event( 'done', { KEY_RESULT_CACHE : result_cache_status } )
+
+
+def make_streaming_response(
+        image : np.ndarray,
+        brush_set : str,
+        tiled : bool,
+        pyramid : bool,
+        output_options : OutputOptions,
+        budget : Optional[ RunBudget ],
+) -> Response:
+    response = Response(
+        generate_events( image, brush_set, tiled, pyramid, output_options, budget ),
+        mimetype = 'text/event-stream',
+    )
+    response.headers.update( CORS_HEADERS )
+    # Make sure proxies forward every event as soon as it is produced
+    response.headers[ 'Cache-Control' ] = 'no-cache'
+    response.headers[ 'X-Accel-Buffering' ] = 'no'
+    logger.info( 'Made Streaming Response.' )
+    return response
+
+
+def get_multipart_part_header( boundary : str, name : str, content_type : str, content_length : int ) -> bytes:
+    return (
+        f'--{boundary}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        f'Content-Disposition: attachment; name="{name}"\r\n'
+        f'Content-Length: {content_length}\r\n'
+        f'\r\n'
+    ).encode( 'ascii' )
+
+
+def make_multipart_response( parts : list[ tuple[ str, str, bytes ] ] ) -> Response:
+    """
+    Returns the ( name, content type, data ) parts as a multipart/mixed response.
+    The encoded buffers are sent as they are, instead of being base64 encoded into a JSON document.
+    The results are fitted to the size budget of the response while they are encoded, see parse_output_options,
+    so the size check here is only a last safeguard.
+    """
+    boundary = secrets.token_hex( 16 )
+    chunks = []
+    for name, content_type, data in parts:
+        chunks.append( get_multipart_part_header( boundary, name, content_type, len( data ) ) )
+        chunks.append( data )
+        chunks.append( b'\r\n' )
+    chunks.append( f'--{boundary}--\r\n'.encode( 'ascii' ) )
+
+    response_size_b = sum( len( chunk ) for chunk in chunks )
+    response_size_mib = response_size_b / ( 1024 * 1024 )
+    logging.info( f'Response size is {response_size_mib} MiB, limit is {RESPONSE_SIZE_LIMIT_MIB} MiB.' )
+    if response_size_mib > RESPONSE_SIZE_LIMIT_MIB:
+        logging.info(f'Response size too big!')
+        return make_error_response( 'Result too big to return... Try different settings and images!' )
+
+    # The chunks are passed to the server one by one, so they are never joined into a single buffer
+    response = Response( iter( chunks ), status = 200, mimetype = f'{MIMETYPE_MULTIPART}; boundary={boundary}' )
+    response.content_length = response_size_b
+    response.headers.update( CORS_HEADERS )
+    logger.info( f'Made Multipart Response with parts {[ name for name, _, _ in parts ]} - 200.' )
+    return response
+
+
+def accepts_multipart( request : Request ) -> bool:
+    # JSON stays the default, also for clients that accept anything
+    return request.accept_mimetypes.best_match( [ MIMETYPE_JSON, MIMETYPE_MULTIPART ] ) == MIMETYPE_MULTIPART
+
+
+@dataclass
+class PaintingRequest:
+    image : np.ndarray
+    brush_set : str
+    tiled : bool
+    pyramid : bool
+    stream : bool
+    output_options : OutputOptions
+    budget : Optional[ RunBudget ]
+
+
+def configure_logging() -> None:
     logging.basicConfig( level = logging.DEBUG )
     logging.getLogger( 'PIL.Image' ).setLevel( logging.WARNING )
-    set_global_config( Config.PROD )
 
+
+def get_output_size_budget_bytes( base64_encoded : bool ) -> int:
+    """
+    Returns how large the encoded image and animation can be together, so that every response and event fits the limit.
+    The budget is applied after the painting is rendered, by encoding the results at lower qualities and sizes,
+    instead of estimating their size up front.
+    """
+    size_limit_bytes = RESPONSE_SIZE_LIMIT_MIB * 1024 * 1024 - RESPONSE_OVERHEAD_BYTES
+    if base64_encoded:
+        # Base64 encodes every 3 bytes as 4 characters
+        return size_limit_bytes * 3 // 4
+    return size_limit_bytes
+
+
+def parse_output_options( request : Request, stream : bool ) -> OutputOptions | Response:
+    """
+    Returns how the results are encoded, or an error response if the requested formats are invalid.
+    The results of JSON and streaming responses are base64 encoded, which leaves less room in the size budget.
+    """
+    image_format_name = request.form.get( 'image_format', ImageFormat.PNG.value ).lower()
+    animation_format_name = request.form.get( 'animation_format', AnimationFormat.GIF.value ).lower()
+    try:
+        image_format = ImageFormat( image_format_name )
+    except ValueError:
+        return make_error_response( f'Unknown image format {image_format_name}.' )
+    try:
+        animation_format = AnimationFormat( animation_format_name )
+    except ValueError:
+        return make_error_response( f'Unknown animation format {animation_format_name}.' )
+
+    try:
+        quality = int( request.form[ 'quality' ] ) if 'quality' in request.form else None
+        compression_level = int( request.form[ 'compression_level' ] ) if 'compression_level' in request.form else None
+    except ValueError:
+        return make_error_response( 'Quality and compression level have to be integers.' )
+    if quality is not None and not 1 <= quality <= 100:
+        return make_error_response( f'Quality {quality} is not between 1 and 100.' )
+    if compression_level is not None and not 0 <= compression_level <= 9:
+        return make_error_response( f'Compression level {compression_level} is not between 0 and 9.' )
+
+    base64_encoded = stream or not accepts_multipart( request )
+    return OutputOptions(
+        image_format = image_format,
+        quality = quality,
+        compression_level = compression_level,
+        animation_format = animation_format,
+        max_size_bytes = get_output_size_budget_bytes( base64_encoded ),
+    )
+
+
+def parse_budget( request : Request ) -> Optional[ RunBudget ] | Response:
+    """
+    Returns the limits of the painting, None if there are none, or an error response if they are invalid.
+    """
+    try:
+        deadline_seconds = float( request.form[ 'deadline_seconds' ] ) if 'deadline_seconds' in request.form else None
+        max_generations = int( request.form[ 'max_generations' ] ) if 'max_generations' in request.form else None
+        max_strokes = int( request.form[ 'max_strokes' ] ) if 'max_strokes' in request.form else None
+        min_improvement_per_second = (
+            float( request.form[ 'min_improvement_per_second' ] ) if 'min_improvement_per_second' in request.form else None
+        )
+    except ValueError:
+        return make_error_response( 'Deadline, maximum generations, maximum strokes and minimum improvement have to be numbers.' )
+    # NaN passes every comparison, and would disable the deadline and its cap
+    for name, value in [
+        ( 'Deadline', deadline_seconds ),
+        ( 'Minimum improvement', min_improvement_per_second ),
+    ]:
+        if value is not None and not math.isfinite( value ):
+            return make_error_response( f'{name} has to be a finite number.' )
+    # Adapting the patience to the acceptance rate of the brushes lets hard images paint for longer
+    adaptive_patience = request.form.get( 'adaptive_patience', 'false' ).lower() == 'true'
+
+    for name, value in [
+        ( 'Deadline', deadline_seconds ),
+        ( 'Maximum generations', max_generations ),
+        ( 'Maximum strokes', max_strokes ),
+    ]:
+        if value is not None and value <= 0:
+            return make_error_response( f'{name} has to be positive.' )
+    if min_improvement_per_second is not None and min_improvement_per_second < 0:
+        return make_error_response( 'Minimum improvement can not be negative.' )
+
+    if MAX_DEADLINE_SECONDS is not None:
+        deadline_seconds = MAX_DEADLINE_SECONDS if deadline_seconds is None else min( deadline_seconds, MAX_DEADLINE_SECONDS )
+    budget = RunBudget(
+        deadline_seconds = deadline_seconds,
+        max_generations = max_generations,
+        max_strokes = max_strokes,
+        min_improvement_per_second = min_improvement_per_second,
+        adaptive_patience = adaptive_patience,
+    )
+    if budget == RunBudget():
+        return None
+    return budget
+
+
+def parse_painting_request( request : Request ) -> PaintingRequest | Response:
+    """
+    Returns the settings and image of the painting, or an error response if the request is invalid.
+    The image is decoded at its normalized size already.
+    """
+    request_too_large_message = f'Request is too large, the limit is {MAX_UPLOAD_SIZE_BYTES // ( 1024 * 1024 )} MiB.'
+    # Rejected before the form is parsed, if the client announced the size of the request
+    if request.content_length is not None and request.content_length > MAX_REQUEST_SIZE_BYTES:
+        return make_error_response( request_too_large_message, 413 )
+    # Otherwise, such as for chunked requests, the form is only parsed up to the limit, instead of spooling all of it
+    request.max_content_length = MAX_REQUEST_SIZE_BYTES
+    try:
+        request.form
+    except RequestEntityTooLarge:
+        return make_error_response( request_too_large_message, 413 )
     if 'brush_set' not in request.form:
         return make_error_response( 'No Brush Set specified in request.' )
     brush_set = request.form[ 'brush_set' ]
+    try:
+        str_to_brush_set( brush_set )
+    except KeyError:
+        return make_error_response( f'Unknown Brush Set {brush_set}.' )
+    # Painting in tiles uses all cores of the instance, instead of a single one
+    tiled = request.form.get( 'tiled', 'false' ).lower() == 'true'
+    # Painting from coarse to fine resolutions places the large early brushes more cheaply
+    pyramid = request.form.get( 'pyramid', 'false' ).lower() == 'true'
+    # Streaming sends intermediate results while painting, instead of a single response at the end
+    stream = request.form.get( 'stream', 'false' ).lower() == 'true'
+    output_options = parse_output_options( request, stream )
+    if isinstance( output_options, Response ):
+        return output_options
+    budget = parse_budget( request )
+    if isinstance( budget, Response ):
+        return budget
 
     if 'image' not in request.files :
         return make_error_response( 'No Image specified in request.' )
     try :
-        image_file = request.files[ 'image' ]
-        image_data = image_file.read()
-        np_array_raw = np.frombuffer( image_data, np.uint8 )
-        image = cv2.imdecode( np_array_raw, cv2.IMREAD_COLOR )
+        # Large uploads are spooled to disk while the form is parsed, and read from there in chunks
+        image = ingest_upload( request.files[ 'image' ].stream )
+    except UploadTooLargeError:
+        return make_error_response( f'Image is too large, the limit is {MAX_UPLOAD_SIZE_BYTES // ( 1024 * 1024 )} MiB.', 413 )
+    except ImageTooLargeError:
+        return make_error_response( f'Image has too many pixels, the limit is {MAX_IMAGE_PIXELS // ( 1000 * 1000 )} megapixels.', 413 )
+    except ImageDecodeError:
+        return make_error_response( 'Could not parse image data.' )
     except Exception:
         logger.exception('Could not parse image data.')
         return make_error_response( 'Could not parse image data.' )
 
+    return PaintingRequest(
+        image = image,
+        brush_set = brush_set,
+        tiled = tiled,
+        pyramid = pyramid,
+        stream = stream,
+        output_options = output_options,
+        budget = budget,
+    )
+
+
+def handle_request( request : Request ) -> Response:
+    configure_logging()
+
+    # Streaming responses are instrumented separately, while their events are generated
+    with instrument( 'painting' ) as instrumentation:
+        response = handle_painting_request( request )
+    if instrumentation is not None:
+        response.headers[ 'Server-Timing' ] = instrumentation.get_server_timing()
+    return response
+
+
+def handle_painting_request( request : Request ) -> Response:
+    painting_request = parse_painting_request( request )
+    if isinstance( painting_request, Response ):
+        return painting_request
+    image, brush_set = painting_request.image, painting_request.brush_set
+    tiled, pyramid = painting_request.tiled, painting_request.pyramid
+
+    output_options, budget = painting_request.output_options, painting_request.budget
+
+    if painting_request.stream:
+        return make_streaming_response( image, brush_set, tiled, pyramid, output_options, budget )
+
     try:
-        result = run_finch( image = image, brush_set_name = brush_set )
+        result = run_finch(
+            image = image,
+            brush_set_name = brush_set,
+            tiled = tiled,
+            pyramid = pyramid,
+            settings = PROD_SETTINGS,
+            output_options = output_options,
+            budget = budget,
+        )
+    except OutputTooLargeError:
+        logger.exception( 'Result too big.' )
+        return make_error_response( 'Result too big to return... Try different settings and images!' )
     except Exception:
         logger.exception( 'Processing - FAILED' )
         return make_error_response( 'Process on server failed. (The Developer is notified)' )
 
-    has_gif = isinstance( result, tuple )
-    if has_gif:
-        result_image, result_gif = result
-    else:
-        result_image = result
+    with timer( 'encode_response' ):
+        response = make_result_response( request, result )
+    response.headers[ 'X-Result-Cache' ] = get_result_cache_status( result )
+    return response
 
-    success, result_image_encoded = cv2.imencode( '.png', result_image )
-    if not success:
-        return make_error_response( 'Process succeeded, but failed to encode the result.' )
-    result_image_base64_string = base64.b64encode(result_image_encoded).decode('utf-8')
+
+def make_result_response( request : Request, result : FinchResult ) -> Response:
+    has_gif = result.animation is not None
+    image_format = result.output_options.image_format
+    animation_format = result.output_options.animation_format
+
+    if accepts_multipart( request ):
+        parts = [ ( KEY_RESULT_IMAGE, image_format.content_type, result.image_4k ) ]
+        if has_gif:
+            parts.append( ( KEY_RESULT_GIF, animation_format.content_type, result.animation ) )
+        return make_multipart_response( parts )
+
+    result_image_base64_string = base64.b64encode( result.image_4k ).decode( 'utf-8' )
 
     if not has_gif:
-        return make_response( { 'result_image' : result_image_base64_string }, 200 )
+        return make_response( {
+            KEY_RESULT_IMAGE : result_image_base64_string,
+            KEY_RESULT_IMAGE_FORMAT : image_format.value,
+        }, 200 )
 
-    result_gif_base64_string = base64.b64encode( result_gif ).decode('utf-8')
+    result_gif_base64_string = base64.b64encode( result.animation ).decode('utf-8')
     response_data = {
         KEY_RESULT_IMAGE : result_image_base64_string,
         KEY_RESULT_GIF : result_gif_base64_string,
+        KEY_RESULT_IMAGE_FORMAT : image_format.value,
+        KEY_RESULT_ANIMATION_FORMAT : animation_format.value,
     }
     log_size( response_data )
     return make_response( response_data, 200 )
 
 
+# ----------------------------------------------------------------
+# Jobs
+# Instead of waiting for the painting, clients submit a job, poll its progress, and fetch the result when it is done.
+
+def make_job_data( job : Job ) -> dict:
+    job_data = {
+        'job_id' : job.job_id,
+        'job_status' : job.status.name.lower(),
+        'generation' : job.generation_index,
+        KEY_SCORE : job.rounded_score,
+    }
+    if job.error is not None:
+        job_data[ 'error' ] = job.error
+    return job_data
+
+
+def make_unknown_job_response( job_id : str ) -> Response:
+    return make_error_response( f'Unknown job {job_id}, it might have expired.', 404 )
+
+
+def handle_submit_job( request : Request ) -> Response:
+    configure_logging()
+
+    painting_request = parse_painting_request( request )
+    if isinstance( painting_request, Response ):
+        return painting_request
+
+    try:
+        # The image is normalized already, so only that has to be sent to the worker
+        job = JOB_SCHEDULER.submit(
+            image = painting_request.image,
+            brush_set_name = painting_request.brush_set,
+            tiled = painting_request.tiled,
+            pyramid = painting_request.pyramid,
+            output_options = painting_request.output_options,
+            budget = painting_request.budget,
+        )
+    except JobQueueFullError:
+        logger.warning( 'Job queue is full.' )
+        return make_error_response( 'Too many paintings in progress, please try again later.', 429 )
+    except JobSchedulerUnavailableError:
+        logger.exception( 'Job scheduler is unavailable.' )
+        return make_error_response( 'Paintings cannot be started right now, please try again later.', 503 )
+    return make_response( make_job_data( job ), 202 )
+
+
+def handle_get_job( job_id : str ) -> Response:
+    job = JOB_SCHEDULER.get( job_id )
+    if job is None:
+        return make_unknown_job_response( job_id )
+    return make_response( make_job_data( job ), 200 )
+
+
+def handle_get_job_result( request : Request, job_id : str ) -> Response:
+    job = JOB_SCHEDULER.get( job_id )
+    if job is None:
+        return make_unknown_job_response( job_id )
+    if job.status != JobStatus.SUCCEEDED:
+        # The job data tells the client whether it is still running, or whether it failed
+        return make_response( make_job_data( job ), 409 )
+    response = make_result_response( request, job.result )
+    response.headers[ 'X-Result-Cache' ] = get_result_cache_status( job.result )
+    return response
+
+
+def handle_cancel_job( job_id : str ) -> Response:
+    job = JOB_SCHEDULER.cancel( job_id )
+    if job is None:
+        return make_unknown_job_response( job_id )
+    return make_response( make_job_data( job ), 200 )
+
+
+def handle_jobs_request( request : Request ) -> Response:
+    """
+    Entry point for the job API, dispatching on the method and path:
+    POST /jobs, GET /jobs/<id>, GET /jobs/<id>/result and DELETE /jobs/<id>.
+    """
+    path_parts = [ part for part in request.path.split( '/' ) if part ]
+    if path_parts[ :1 ] != [ 'jobs' ]:
+        return make_error_response( f'Unknown path {request.path}.', 404 )
+
+    if len( path_parts ) == 1 and request.method == 'POST':
+        return handle_submit_job( request )
+    if len( path_parts ) == 2 and request.method == 'GET':
+        return handle_get_job( path_parts[ 1 ] )
+    if len( path_parts ) == 2 and request.method == 'DELETE':
+        return handle_cancel_job( path_parts[ 1 ] )
+    if len( path_parts ) == 3 and path_parts[ 2 ] == 'result' and request.method == 'GET':
+        return handle_get_job_result( request, path_parts[ 1 ] )
+    return make_error_response( f'Unsupported request {request.method} {request.path}.', 405 )
+
+
 # ----------------------------------------------------------------
 # For local testing
 
@@ -116,5 +619,12 @@ def flask_handle_request() -> Response:
     return handle_request(flask_request)
 
 
+@app.route('/jobs', methods=['POST'])
+@app.route('/jobs/<job_id>', methods=['GET', 'DELETE'])
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def flask_handle_jobs_request( job_id : str | None = None ) -> Response:
+    return handle_jobs_request(flask_request)
+
+
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,103 @@
+import functools
+import json
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+from finch import checkpoint, run
+from finch.checkpoint import Checkpoint, CheckpointError, read_checkpoint, write_checkpoint
+from finch.context import RunSettings
+from finch.run import FinchFrame, RunBudget, run_finch, run_finch_streaming
+
+
+IMAGE_HEIGHT : int = 96
+IMAGE_WIDTH : int = 128
+SETTINGS = RunSettings( make_gif = False, log_scores = False )
+# Small enough to keep the test fast, large enough to interrupt the painting in the middle
+BUDGET = RunBudget( max_strokes = 400 )
+N_FRAMES_BEFORE_INTERRUPT : int = 5
+
+
+def _get_target_image() -> np.ndarray:
+    rng = np.random.default_rng( 1337 )
+    noise = rng.integers( 0, 256, ( 12, 16, 3 ), dtype = np.uint8 )
+    return cv2.resize( noise, ( IMAGE_WIDTH, IMAGE_HEIGHT ), interpolation = cv2.INTER_CUBIC )
+
+
+@pytest.fixture
+def checkpoint_path( tmp_path : Path, monkeypatch : pytest.MonkeyPatch ) -> Path:
+    # Checkpoint after every generation, so that there is one to resume from right after the first frames
+    monkeypatch.setattr( run, 'Checkpointer', functools.partial( checkpoint.Checkpointer, interval_seconds = 0.0 ) )
+    return tmp_path / 'painting.fckp'
+
+
+def _interrupt_painting( image : np.ndarray, checkpoint_path : Path ) -> None:
+    generator = run_finch_streaming( image, 'Canvas', settings = SETTINGS, budget = BUDGET, checkpoint_path = checkpoint_path )
+    n_frames = 0
+    for item in generator:
+        assert isinstance( item, FinchFrame ), 'Painting converged before it was interrupted.'
+        n_frames += 1
+        if n_frames == N_FRAMES_BEFORE_INTERRUPT:
+            break
+    generator.close()
+
+
+def test_resumed_painting_matches_uninterrupted_painting( checkpoint_path : Path ) -> None:
+    image = _get_target_image()
+    uninterrupted_result = run_finch( image, 'Canvas', settings = SETTINGS, budget = BUDGET )
+
+    _interrupt_painting( image, checkpoint_path )
+    interrupted_checkpoint = read_checkpoint( checkpoint_path )
+    assert not interrupted_checkpoint.is_converged
+    assert 0 < len( interrupted_checkpoint.brushes ) < len( uninterrupted_result.brushes )
+
+    resumed_result = run_finch( image, 'Canvas', settings = SETTINGS, budget = BUDGET, checkpoint_path = checkpoint_path )
+    assert resumed_result.image_4k == uninterrupted_result.image_4k
+    assert read_checkpoint( checkpoint_path ).is_converged
+
+
+def test_checkpoint_round_trip( checkpoint_path : Path ) -> None:
+    _interrupt_painting( _get_target_image(), checkpoint_path )
+    original = read_checkpoint( checkpoint_path )
+
+    copy_path = checkpoint_path.with_name( 'copy.fckp' )
+    write_checkpoint( original, copy_path )
+    assert copy_path.read_bytes() == checkpoint_path.read_bytes()
+    copy = read_checkpoint( copy_path )
+    assert copy.to_bytes() == original.to_bytes()
+    assert copy.rng_state == original.rng_state
+    assert list( copy.brushes ) == list( original.brushes )
+    # No temporary files are left behind
+    assert sorted( path.name for path in checkpoint_path.parent.iterdir() ) == [ 'copy.fckp', 'painting.fckp' ]
+
+
+def _replace_metadata( data : bytes, metadata : dict ) -> bytes:
+    header = np.frombuffer( data, dtype = checkpoint.CHECKPOINT_HEADER_DTYPE, count = 1 ).copy()
+    metadata_start = checkpoint.CHECKPOINT_HEADER_DTYPE.itemsize
+    metadata_end = metadata_start + int( header[ 0 ][ 'metadata_size' ] )
+    metadata_bytes = json.dumps( metadata ).encode()
+    header[ 0 ][ 'metadata_size' ] = len( metadata_bytes )
+    return header.tobytes() + metadata_bytes + data[ metadata_end: ]
+
+
+def test_corrupt_checkpoints_are_rejected( checkpoint_path : Path ) -> None:
+    _interrupt_painting( _get_target_image(), checkpoint_path )
+    data = checkpoint_path.read_bytes()
+    metadata_size = int( np.frombuffer( data, dtype = checkpoint.CHECKPOINT_HEADER_DTYPE, count = 1 )[ 0 ][ 'metadata_size' ] )
+    metadata_start = checkpoint.CHECKPOINT_HEADER_DTYPE.itemsize
+    metadata = json.loads( data[ metadata_start : metadata_start + metadata_size ] )
+
+    missing_key_metadata = { name : value for name, value in metadata.items() if name != 'rng' }
+    unexpected_key_metadata = { **metadata, 'state' : { **metadata[ 'state' ], 'unexpected' : 1 } }
+    mistyped_metadata = { **metadata, 'np_rng' : None }
+    for corrupt_data in [
+        data[ : metadata_start + metadata_size // 2 ],
+        data[ : -1 ],
+        _replace_metadata( data, missing_key_metadata ),
+        _replace_metadata( data, unexpected_key_metadata ),
+        _replace_metadata( data, mistyped_metadata ),
+    ]:
+        with pytest.raises( CheckpointError ):
+            Checkpoint.from_bytes( corrupt_data )
@@ -0,0 +1,68 @@
+import math
+import random
+
+import numpy as np
+
+from finch.brush import Brush
+from finch.brush_bank import BrushSet, get_brush_bank
+from finch.composite import MAX_ALPHA
+from finch.occlusion import OCCLUSION_MAX_TRANSMITTANCE, cull_occluded_brushes, scale_roi
+from finch.primitive_types import Point
+from finch.redraw import _redraw_painting
+from finch.specimen import Specimen
+from finch.stroke_log import StrokeLog
+
+
+IMAGE_HEIGHT : int = 96
+IMAGE_WIDTH : int = 128
+N_SMALL_BRUSHES : int = 100
+N_LARGE_BRUSHES : int = 20
+# Large enough to resample the brushes like the 4K redraw does, small enough to keep the test fast
+REDRAW_SCALE : float = 4.0
+
+
+def _get_specimen() -> Specimen:
+    # The bundled textures are grainy, so only a stack of large brushes covers the small brushes below it.
+    # The Oil textures are the densest ones.
+    rng = random.Random( 1337 )
+    brush_bank = get_brush_bank( BrushSet.Oil )
+    brushes = StrokeLog()
+    for brush_index in range( N_SMALL_BRUSHES + N_LARGE_BRUSHES ):
+        if brush_index < N_SMALL_BRUSHES:
+            size = rng.randrange( 2, IMAGE_WIDTH // 8 )
+        else:
+            size = rng.randrange( IMAGE_WIDTH // 2, 2 * IMAGE_WIDTH )
+        brushes.append( Brush(
+            color = ( rng.randrange( 256 ), rng.randrange( 256 ), rng.randrange( 256 ) ),
+            texture_index = brush_bank.random_texture_index( rng ),
+            position = Point( rng.randrange( IMAGE_WIDTH ), rng.randrange( IMAGE_HEIGHT ) ),
+            angle = rng.uniform( -180, 180 ),
+            size = size,
+        ) )
+    return Specimen(
+        cached_image = np.zeros( ( IMAGE_HEIGHT, IMAGE_WIDTH, 3 ), dtype = np.uint8 ),
+        brush_bank = brush_bank,
+        brushes = brushes,
+    )
+
+
+def _get_blank_image() -> np.ndarray:
+    return np.full( ( int( IMAGE_HEIGHT * REDRAW_SCALE ), int( IMAGE_WIDTH * REDRAW_SCALE ), 3 ), 255, dtype = np.uint8 )
+
+
+def test_occlusion_culling_error_is_bounded() -> None:
+    specimen = _get_specimen()
+    drawn_image = _redraw_painting( specimen.brushes, REDRAW_SCALE, _get_blank_image(), specimen.brush_bank )
+
+    culling_result = cull_occluded_brushes( specimen.brushes, IMAGE_HEIGHT, IMAGE_WIDTH, specimen.brush_bank )
+    assert culling_result.n_culled_brushes > 0 and culling_result.n_shrunk_brushes > 0
+    culled_image = _redraw_painting(
+        culling_result.brushes,
+        REDRAW_SCALE,
+        _get_blank_image(),
+        specimen.brush_bank,
+        clip_rois = [ scale_roi( roi, REDRAW_SCALE ) for roi in culling_result.visible_rois ],
+    )
+
+    max_difference = int( np.max( np.abs( drawn_image.astype( int ) - culled_image.astype( int ) ) ) )
+    assert max_difference <= math.ceil( MAX_ALPHA * OCCLUSION_MAX_TRANSMITTANCE ) + 1
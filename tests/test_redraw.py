@@ -0,0 +1,57 @@
+import random
+
+import numpy as np
+import pytest
+
+from finch import redraw
+from finch.brush import BRUSH_STAMP_CACHE, Brush
+from finch.brush_bank import BrushSet, get_brush_bank
+from finch.primitive_types import Point
+from finch.redraw import _redraw_painting, _redraw_painting_serial
+from finch.stroke_log import StrokeLog
+
+
+IMAGE_HEIGHT : int = 96
+IMAGE_WIDTH : int = 128
+N_BRUSHES : int = 300
+REDRAW_SCALE : float = 4.0
+# Small tiles and batches, so that brushes span several tiles and batches
+TEST_TILE_SIZE : int = 96
+TEST_MAX_PINNED_STAMP_BYTES : int = 1024 * 1024
+
+
+def _get_brushes() -> StrokeLog:
+    # Like a real painting, brushes get smaller over time
+    rng = random.Random( 1337 )
+    brush_bank = get_brush_bank( BrushSet.Canvas )
+    brushes = StrokeLog()
+    for brush_index in range( N_BRUSHES ):
+        brushes.append( Brush(
+            color = ( rng.randrange( 256 ), rng.randrange( 256 ), rng.randrange( 256 ) ),
+            texture_index = brush_bank.random_texture_index( rng ),
+            position = Point( rng.randrange( IMAGE_WIDTH ), rng.randrange( IMAGE_HEIGHT ) ),
+            angle = rng.uniform( -180, 180 ),
+            size = max( 1, int( IMAGE_WIDTH * ( 1 - brush_index / N_BRUSHES ) ** 3 ) ),
+        ) )
+    return brushes
+
+
+def _get_blank_image() -> np.ndarray:
+    return np.full( ( int( IMAGE_HEIGHT * REDRAW_SCALE ), int( IMAGE_WIDTH * REDRAW_SCALE ), 3 ), 255, dtype = np.uint8 )
+
+
+@pytest.mark.parametrize( 'n_workers', [ 1, 3 ] )
+def test_tiled_redraw_matches_serial_redraw( monkeypatch : pytest.MonkeyPatch, n_workers : int ) -> None:
+    monkeypatch.setattr( redraw, 'REDRAW_TILE_SIZE', TEST_TILE_SIZE )
+    monkeypatch.setattr( redraw, 'REDRAW_MAX_PINNED_STAMP_BYTES', TEST_MAX_PINNED_STAMP_BYTES )
+    # A cache that only holds a batch, like the 4K stamps of a real painting in the default cache
+    monkeypatch.setattr( BRUSH_STAMP_CACHE, 'max_size_bytes', TEST_MAX_PINNED_STAMP_BYTES )
+    brush_bank = get_brush_bank( BrushSet.Canvas )
+    serial_image = _redraw_painting_serial( _get_brushes(), REDRAW_SCALE, _get_blank_image(), brush_bank )
+
+    BRUSH_STAMP_CACHE.clear()
+    tiled_image = _redraw_painting( _get_brushes(), REDRAW_SCALE, _get_blank_image(), brush_bank, n_workers = n_workers )
+    assert np.array_equal( tiled_image, serial_image )
+    # Stamps are not evicted and rendered again for every tile that they touch
+    n_distinct_stamps = len( { ( brush.texture_index, brush.size, brush.angle ) for brush in _get_brushes() } )
+    assert BRUSH_STAMP_CACHE.n_misses <= n_distinct_stamps
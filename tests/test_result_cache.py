@@ -0,0 +1,61 @@
+from dataclasses import replace
+
+import cv2
+import numpy as np
+import pytest
+
+from finch import run
+from finch.context import RunSettings
+from finch.output import ImageFormat, OutputOptions
+from finch.result_cache import InMemoryResultCacheBackend, ResultCache
+from finch.run import RunBudget, run_finch
+
+
+IMAGE_HEIGHT : int = 96
+IMAGE_WIDTH : int = 128
+SETTINGS = RunSettings( make_gif = False, log_scores = False, use_result_cache = True )
+# JPEGs step down quickly, the higher PNG compression levels are slow at 4K
+OUTPUT_OPTIONS = OutputOptions( image_format = ImageFormat.JPEG )
+BUDGET = RunBudget( max_strokes = 200 )
+
+
+def _get_target_image() -> np.ndarray:
+    rng = np.random.default_rng( 1337 )
+    noise = rng.integers( 0, 256, ( 12, 16, 3 ), dtype = np.uint8 )
+    return cv2.resize( noise, ( IMAGE_WIDTH, IMAGE_HEIGHT ), interpolation = cv2.INTER_CUBIC )
+
+
+@pytest.fixture( autouse = True )
+def result_cache( monkeypatch : pytest.MonkeyPatch ) -> ResultCache:
+    cache = ResultCache( InMemoryResultCacheBackend( max_size_bytes = 64 * 1024 * 1024 ) )
+    monkeypatch.setattr( run, 'RESULT_CACHE', cache )
+    return cache
+
+
+def _run( output_options : OutputOptions ) -> run.FinchResult:
+    return run_finch( _get_target_image(), 'Canvas', settings = SETTINGS, output_options = output_options, budget = BUDGET )
+
+
+def test_size_budget_is_applied_to_cached_results() -> None:
+    unbudgeted_result = _run( OUTPUT_OPTIONS )
+    assert not unbudgeted_result.from_cache
+
+    budgeted_output_options = replace( OUTPUT_OPTIONS, max_size_bytes = len( unbudgeted_result.image_4k ) // 2 )
+    budgeted_result = _run( budgeted_output_options )
+    assert budgeted_result.from_cache
+    assert len( budgeted_result.image_4k ) <= budgeted_output_options.max_size_bytes
+
+
+def test_size_budget_is_not_cached( monkeypatch : pytest.MonkeyPatch ) -> None:
+    unbudgeted_result = _run( replace( OUTPUT_OPTIONS, max_size_bytes = 1024 * 1024 * 1024 ) )
+    budgeted_output_options = replace( OUTPUT_OPTIONS, max_size_bytes = len( unbudgeted_result.image_4k ) // 2 )
+
+    # Paint again with the budget, instead of finding the unbudgeted result
+    monkeypatch.setattr( run, 'RESULT_CACHE', ResultCache( InMemoryResultCacheBackend( max_size_bytes = 64 * 1024 * 1024 ) ) )
+    budgeted_result = _run( budgeted_output_options )
+    assert not budgeted_result.from_cache
+    assert len( budgeted_result.image_4k ) <= budgeted_output_options.max_size_bytes
+
+    cached_result = _run( OUTPUT_OPTIONS )
+    assert cached_result.from_cache
+    assert cached_result.image_4k == unbudgeted_result.image_4k